@@ -12,7 +12,7 @@ import './index.css'; // Your custom styles
 
 // Import API functions
 import {
-    initializeApi, getAnalysisApi, executeCodeApi, pollExecutionResultsApi,
+    initializeApi, getAnalysisApi, executeCodeApi, pollExecutionResultsApi, streamExecutionApi,
     stopExecutionApi, sendFeedbackApi, getHistoryApi, saveAnalysisApi, switchModelApi, submitApiKeyApi
 } from './api';
 
@@ -24,6 +24,8 @@ import ChatInputArea from './components/ChatInputArea';
 import ModelSwitcherModal from './components/ModelSwitcherModal';
 import ApiKeyDialog from './components/ApiKeyDialog';
 import ImageModal from './components/ImageModal';
+import ExecutionOutput from './components/ExecutionOutput';
+import FiguresDisplay from './components/FiguresDisplay';
 import alfredLogo from './assets/alfred-logo.png';
 import alfredLogoMini from './assets/alfred-logo-small.png';
 
@@ -54,6 +56,9 @@ function App() {
     const [buttonState, setButtonState] = useState('analyse'); // 'analyse', 'stop'
     const [executionId, setExecutionId] = useState(null);
     const [codeExecutionInProgress, setCodeExecutionInProgress] = useState(false);
+    const [liveOutput, setLiveOutput] = useState(''); // Output streamed while code is running
+    const [liveFigures, setLiveFigures] = useState([]);
+    const [liveResponse, setLiveResponse] = useState(''); // LLM response text streamed while it is generated
 
     const [showImageModal, setShowImageModal] = useState(false);
     const [modalImageSrc, setModalImageSrc] = useState('');
@@ -67,17 +72,18 @@ function App() {
 
     const [saveStatus, setSaveStatus] = useState({ message: '', type: '' }); // For save analysis feedback
 
-    // Refs for intervals
-    const pollIntervalRef = useRef(null);
+    // Refs for intervals and the execution long-poll loop
+    const pollLoopRef = useRef(null);
     const historyIntervalRef = useRef(null);
+    const historyCursorRef = useRef(null); // Cursor of the last history fetch (see /history)
 
     // --- Helper Functions ---
     const clearExecutionState = () => {
         setCodeExecutionInProgress(false);
         setExecutionId(null);
-        if (pollIntervalRef.current) {
-            clearInterval(pollIntervalRef.current);
-            pollIntervalRef.current = null;
+        if (pollLoopRef.current) {
+            pollLoopRef.current.cancelled = true;
+            pollLoopRef.current = null;
         }
     };
 
@@ -86,6 +92,7 @@ function App() {
         setIsLoading(false);
         setProcessingStatus('');
         setHistory([]);
+        historyCursorRef.current = null;
         setCurrentSummary('');
         setFeedbackInput('');
         clearExecutionState();
@@ -119,14 +126,21 @@ function App() {
     }, []);
 
     const fetchHistory = useCallback(async () => {
-        const response = await getHistoryApi();
-        if (response.status === 'success' && response.data?.history) {
-            // Only update if content differs to avoid unnecessary re-renders
-            if (history.length !== response.data.history.length || JSON.stringify(history) !== JSON.stringify(response.data.history)) {
-                setHistory(response.data.history);
+        // Only ask for entries added since the last fetch
+        const requestedCursor = historyCursorRef.current;
+        const response = await getHistoryApi(requestedCursor);
+        // Ignore the response if a concurrent fetch has already moved the cursor
+        if (historyCursorRef.current !== requestedCursor) return;
+        if (response.status === 'success' && response.data?.entries) {
+            const { cursor, reset, entries } = response.data;
+            historyCursorRef.current = cursor;
+            if (reset) {
+                setHistory(entries);
+            } else if (entries.length > 0) {
+                setHistory((previous) => [...previous, ...entries]);
             }
         }
-    }, [isLoading, history]);
+    }, []);
 
     // --- Effects ---
 
@@ -155,20 +169,41 @@ function App() {
         }
     }, [isInitialized, fetchHistory]); // Re-run if isInitialized changes
 
-     // Code execution polling
+    // Live output while code is running
+    useEffect(() => {
+        if (!codeExecutionInProgress || !executionId) return;
+
+        setLiveOutput('');
+        setLiveFigures([]);
+        const closeStream = streamExecutionApi(executionId, {
+            onOutput: (text) => setLiveOutput((previous) => previous + text),
+            onFigure: (figure) => setLiveFigures((previous) => [...previous, figure]),
+            onStatus: (status) => {
+                if (status === 'running') setProcessingStatus('Executing code...');
+            },
+        });
+        return closeStream;
+    }, [codeExecutionInProgress, executionId]);
+
+     // Code execution completion (long polling: the server answers as soon as the result is stored)
     useEffect(() => {
-        if (codeExecutionInProgress && executionId) {
-            pollIntervalRef.current = setInterval(async () => {
-                console.log(`Polling for execution ID: ${executionId}`);
-                const response = await pollExecutionResultsApi(executionId);
+        if (!codeExecutionInProgress || !executionId) return;
+
+        const loop = { cancelled: false };
+        pollLoopRef.current = loop;
+
+        const waitForCompletion = async () => {
+            let wait = 25;
+            while (!loop.cancelled) {
+                const response = await pollExecutionResultsApi(executionId, wait);
+                if (loop.cancelled) return;
 
                  if (response.status === 'success' && response.data) {
                      const { complete, output, figures } = response.data;
 
                      if (complete) {
                          console.log(`Execution ${executionId} complete.`);
-                         clearInterval(pollIntervalRef.current);
-                         pollIntervalRef.current = null;
+                         pollLoopRef.current = null;
                          setCodeExecutionInProgress(false);
                          await fetchHistory();
 
@@ -177,7 +212,8 @@ function App() {
 
                          // Now get the next text analysis
                          updateLoading(true, 'Analysing results...');
-                         const analysisResponse = await getAnalysisApi('text');
+                         const analysisResponse = await getAnalysisApi('text', undefined, setLiveResponse);
+                         setLiveResponse('');
                          if (analysisResponse.status === 'success' && analysisResponse.data.response) {
                             setCurrentSummary(analysisResponse.data.response);
                             setButtonState('analyse'); // Ready for next execution
@@ -187,30 +223,37 @@ function App() {
                             setButtonState('analyse'); // Allow retry
                          }
                          updateLoading(false);
+                         return;
+                     } else if (response.data.status === 'queued') {
+                         // Waiting for a free execution slot on the server; refresh the position more often
+                         setProcessingStatus(`Queued for execution (position ${response.data.position ?? '?'})...`);
+                         wait = 5;
                      } else {
-                         // Still running, maybe update status?
                          setProcessingStatus('Executing code...'); // Keep status updated
+                         wait = 25;
                      }
                 } else if (response.status === 'pending') {
-                    // Still waiting, do nothing
+                    // Temporary error, back off before asking again
+                    await new Promise((resolve) => setTimeout(resolve, 2000));
                 } else {
                      // Polling error or backend issue
                      console.error(`Polling error or invalid state for ${executionId}. Stopping poll.`);
                      alert('Error checking execution status. Please check the console.');
-                     clearInterval(pollIntervalRef.current);
-                     pollIntervalRef.current = null;
+                     pollLoopRef.current = null;
                      setCodeExecutionInProgress(false);
                      setButtonState('analyse'); // Allow user to retry
                      updateLoading(false);
+                     return;
                 }
-            }, 2000); // Poll every 2 seconds
-        }
+            }
+        };
+        waitForCompletion();
 
         // Cleanup function
         return () => {
-            if (pollIntervalRef.current) {
-                clearInterval(pollIntervalRef.current);
-                pollIntervalRef.current = null;
+            loop.cancelled = true;
+            if (pollLoopRef.current === loop) {
+                pollLoopRef.current = null;
             }
         };
     }, [codeExecutionInProgress, executionId, fetchHistory]);
@@ -270,7 +313,8 @@ function App() {
 
         // 2. Get first analysis
         updateLoading(true, 'Getting initial analysis...');
-        const analysisResponse = await getAnalysisApi('text');
+        const analysisResponse = await getAnalysisApi('text', undefined, setLiveResponse);
+        setLiveResponse('');
         if (analysisResponse.status === 'success' && analysisResponse.data?.response) {
             setCurrentSummary(analysisResponse.data.response);
             setIsInitialized(true);
@@ -298,7 +342,8 @@ function App() {
         } else if (buttonState === 'analyse') {
             // 1. Get the Code first
             updateLoading(true, 'Generating code...');
-            const codeAnalysisResponse = await getAnalysisApi('code', feedbackInput);
+            const codeAnalysisResponse = await getAnalysisApi('code', feedbackInput, setLiveResponse);
+            setLiveResponse('');
             setFeedbackInput('');
             setButtonState('analyse');
 
@@ -347,8 +392,10 @@ function App() {
         // Use the updated sendFeedbackApi with optional files parameter
         const response = await sendFeedbackApi(
             feedbackInput, 
-            uploadedFiles.length > 0 ? uploadedFiles : null // files parameter
+            uploadedFiles.length > 0 ? uploadedFiles : null, // files parameter
+            setLiveResponse
         );
+        setLiveResponse('');
     
         if (response.status === 'success') {
             setFeedbackInput('');
@@ -603,6 +650,19 @@ function App() {
                                 onToggleCodeExpand={handleToggleCodeExpand}
                                 onImageClick={handleImageClick}
                             />
+                            {liveResponse && (
+                                <div className="live-response p-3">
+                                    <pre className="p-3 border rounded bg-light" style={{ whiteSpace: 'pre-wrap', wordBreak: 'break-word' }}>
+                                        {liveResponse}
+                                    </pre>
+                                </div>
+                            )}
+                            {codeExecutionInProgress && (
+                                <div className="live-execution p-3">
+                                    <ExecutionOutput output={liveOutput} />
+                                    <FiguresDisplay figures={liveFigures} onImageClick={handleImageClick} />
+                                </div>
+                            )}
                             <ChatInputArea
                                 feedbackInput={feedbackInput}
                                 onFeedbackChange={(e) => setFeedbackInput(e.target.value)} // Pass simple handler
@@ -24,12 +24,63 @@ export const initializeApi = async (formData) => {
     }
 };
 
-export const getAnalysisApi = async (responseType, textInput) => {
-    try {
-        const response = await axios.get(`${API_BASE_URL}/get_analysis`, {
-            params: { response_type: responseType, text_input: textInput },
+// LLM requests run in the background on the server; wait for the response by long polling
+const waitForLLMResult = async (jobId) => {
+    while (true) {
+        const response = await axios.get(`${API_BASE_URL}/llm_results/${jobId}`, {
+            params: { wait: 25 },
         });
-        return { status: 'success', data: response.data };
+        if (response.data.status !== 'pending') {
+            return response.data;
+        }
+    }
+};
+
+// Follow an LLM response as it is generated (server-sent events); onText receives
+// the text so far. Resolves with the final response, fetched like waitForLLMResult.
+const streamLLMResult = (jobId, onText) => new Promise((resolve) => {
+    const source = new EventSource(`${API_BASE_URL}/llm_stream/${jobId}`);
+    let text = '';
+
+    const finish = () => {
+        source.close();
+        resolve(waitForLLMResult(jobId));
+    };
+    source.addEventListener('token', (event) => {
+        text += JSON.parse(event.data).text;
+        onText(text);
+    });
+    source.addEventListener('status', (event) => {
+        const data = JSON.parse(event.data);
+        // The server starts over if the model returned nothing
+        if (data.status === 'retrying') {
+            text = '';
+            onText(text);
+        } else if (data.status === 'queued') {
+            // Waiting for the provider's rate limit; replaced by the response once it streams
+            onText(`${text}[Waiting about ${Math.ceil(data.wait)}s for the provider's rate limit...]`);
+        }
+    });
+    source.addEventListener('done', finish);
+    source.onerror = () => {
+        // The browser reconnects (resuming via Last-Event-ID) unless the stream is gone
+        if (source.readyState === EventSource.CLOSED) {
+            finish();
+        }
+    };
+});
+
+const getLLMResult = (jobId, onText) => (onText ? streamLLMResult(jobId, onText) : waitForLLMResult(jobId));
+
+// fanout ('first' or 'compare') sends the request to several models at once (server default if null)
+export const getAnalysisApi = async (responseType, textInput, onText = null, fanout = null) => {
+    try {
+        const params = { response_type: responseType, text_input: textInput };
+        if (fanout) {
+            params.fanout = fanout;
+        }
+        const response = await axios.get(`${API_BASE_URL}/get_analysis`, { params });
+        return { status: 'success', data: await getLLMResult(response.data.job_id, onText) };
     } catch (error) {
         return handleApiError(error, 'Error getting analysis');
     }
@@ -47,9 +98,12 @@ export const executeCodeApi = async (code, executionId) => {
     }
 };
 
-export const pollExecutionResultsApi = async (executionId) => {
+// With wait > 0 the server holds the request until the execution completes (long polling)
+export const pollExecutionResultsApi = async (executionId, wait = 0) => {
     try {
-        const response = await axios.get(`${API_BASE_URL}/execution_results/${executionId}`);
+        const response = await axios.get(`${API_BASE_URL}/execution_results/${executionId}`, {
+            params: wait > 0 ? { wait } : {},
+        });
         // Don't pop alert on normal polling errors (e.g., 404 before ready)
         if (response.status >= 400) {
             console.warn(`Polling error for ${executionId}: ${response.status}`);
@@ -63,6 +117,28 @@ export const pollExecutionResultsApi = async (executionId) => {
     }
 };
 
+// Subscribe to live output and figures of a running execution (server-sent events).
+// Returns a function that closes the stream.
+export const streamExecutionApi = (executionId, { onOutput, onFigure, onStatus, onDone }) => {
+    const source = new EventSource(`${API_BASE_URL}/execution_stream/${executionId}`);
+
+    source.addEventListener('output', (event) => onOutput?.(JSON.parse(event.data).text));
+    source.addEventListener('figure', (event) => onFigure?.(JSON.parse(event.data)));
+    source.addEventListener('status', (event) => onStatus?.(JSON.parse(event.data).status));
+    source.addEventListener('done', (event) => {
+        source.close();
+        onDone?.(JSON.parse(event.data));
+    });
+    source.onerror = () => {
+        // The browser reconnects (resuming via Last-Event-ID) unless the stream is gone
+        if (source.readyState === EventSource.CLOSED) {
+            console.warn(`Execution stream for ${executionId} closed`);
+        }
+    };
+
+    return () => source.close();
+};
+
 export const stopExecutionApi = async (executionId) => {
     try {
         const response = await axios.post(`${API_BASE_URL}/stop_execution`, { execution_id: executionId });
@@ -72,11 +148,14 @@ export const stopExecutionApi = async (executionId) => {
     }
 };
 
-export const sendFeedbackApi = async (feedback, files = null) => {
+export const sendFeedbackApi = async (feedback, files = null, onText = null, fanout = null) => {
     try {
         let requestData = {
             feedback
         };
+        if (fanout) {
+            requestData.fanout = fanout;
+        }
                 
         // Convert files to base64 if present
         if (files && files.length > 0) {
@@ -107,16 +186,20 @@ export const sendFeedbackApi = async (feedback, files = null) => {
             },
         });
         
-        return { status: 'success', data: response.data };
+        return { status: 'success', data: await getLLMResult(response.data.job_id, onText) };
     } catch (error) {
         return handleApiError(error, 'Error sending feedback');
     }
 };
 
-export const getHistoryApi = async () => {
+// Fetch the history entries added after cursor. data is null if nothing changed (304).
+export const getHistoryApi = async (cursor = null) => {
     try {
-        const response = await axios.get(`${API_BASE_URL}/debug/history`);
-        return { status: 'success', data: response.data };
+        const response = await axios.get(`${API_BASE_URL}/history`, {
+            params: cursor ? { cursor } : {},
+            validateStatus: (status) => status === 200 || status === 304,
+        });
+        return { status: 'success', data: response.status === 304 ? null : response.data };
     } catch (error) {
         // Don't alert on history refresh errors, just log
         console.error("Error refreshing history:", error);
@@ -32,4 +32,7 @@ if __name__ == '__main__':
 
     debug_mode = os.environ.get('DEBUG', 'False').lower() == 'true'
 
+    # Start pre-warming kernel workers before the first request arrives
+    kernel_pool.start()
+
     app.run(host='0.0.0.0', port=5000, debug=debug_mode)
\ No newline at end of file
@@ -0,0 +1,356 @@
+"""
+End-to-end load test of an Alfred server. Each simulated user initialises a
+session with the auto-generated data, asks for a text analysis and then goes
+through rounds of code generation, code execution and feedback, as the web
+app does. Reports latency percentiles per step, executions per second and the
+server's memory (RSS, with and without its kernel processes) over time.
+
+Against the mock LLM provider, started together with the server:
+
+    python benchmarks/load_test.py --spawn --users 20 --rounds 3
+
+Against a server that is already running (pass its pid for RSS):
+
+    python benchmarks/load_test.py --url http://localhost:5000 --users 20 --server-pid 1234
+
+RSS is read from /proc, so it is only reported on Linux.
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import threading
+import subprocess
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from metrics import percentile
+
+# Long polls are held open for at most this long by the server
+POLL_WAIT = 30
+
+STEPS = ("initialize", "analysis", "code", "execution", "feedback")
+
+
+###############################################################################
+# A simulated user
+###############################################################################
+class User:
+    """One browser session: its own cookies, going through the app's requests in order."""
+    def __init__(self, url, index, args, results):
+        self.url = url.rstrip('/')
+        self.index = index
+        self.args = args
+        self.results = results
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, form=None, body=None):
+        """Send a request; returns (status code, JSON payload)."""
+        data, headers = None, {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=POLL_WAIT + 30) as response:
+                return response.status, json.loads(response.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            try:
+                return e.code, json.loads(e.read() or b'{}')
+            except ValueError:
+                return e.code, {}
+
+    def run(self):
+        args = self.args
+        form = {"model": args.model, "dataSource": "auto"}
+        if args.api_key:
+            form["apiKey"] = args.api_key
+        if not self.step("initialize", lambda: self.request('POST', '/initialize', form=form)):
+            return
+        if not self.step("analysis", lambda: self.llm_job('/get_analysis?response_type=text')):
+            return
+        for round in range(args.rounds):
+            time.sleep(args.think)
+            code = self.step("code", lambda: self.llm_job('/get_analysis?response_type=code'))
+            if not code:
+                return
+            self.step("execution", lambda: self.execute(code.get("response", ""), f"load-{self.index}-{round}"))
+            time.sleep(args.think)
+            self.step("feedback", lambda: self.llm_job('/send_feedback', body={"feedback": "Looks good, continue."}))
+
+    def step(self, name, fn):
+        """Time fn, a step returning (status code, payload). Returns the payload, or None if it failed."""
+        started = time.time()
+        try:
+            code, payload = fn()
+        except Exception as e:
+            code, payload = None, {"message": str(e)}
+        elapsed = time.time() - started
+        ok = code == 200 and payload.get("status") != "error" and not payload.get("error")
+        self.results.record(name, elapsed, ok, None if ok else f"{code}: {payload.get('message') or payload.get('error')}")
+        return payload if ok else None
+
+    def llm_job(self, path, body=None):
+        """Start an LLM job and wait for its response."""
+        code, payload = self.request('POST' if body is not None else 'GET', path, body=body)
+        if code != 202:
+            return code, payload
+        job_id = payload["job_id"]
+        while True:
+            code, payload = self.request('GET', f'/llm_results/{job_id}?wait={POLL_WAIT}')
+            if code != 202:
+                return code, payload
+
+    def execute(self, code, execution_id):
+        """Run code and wait for it to finish, resubmitting while the server's queue is full."""
+        while True:
+            status, payload = self.request('POST', '/execute_code', body={"code": code, "execution_id": execution_id})
+            if status != 429:
+                break
+            self.results.count("execution_rejections")
+            time.sleep(float(payload.get("retry_after") or 1))
+        if status != 200:
+            return status, payload
+        while True:
+            status, payload = self.request('GET', f'/execution_results/{execution_id}?wait={POLL_WAIT}')
+            if status != 200 or payload.get("complete"):
+                return status, payload
+
+###############################################################################
+# Results
+###############################################################################
+class Results:
+    def __init__(self):
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: 0 for step in STEPS}
+        self.messages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, step, seconds, ok, message=None):
+        with self.lock:
+            if ok:
+                self.latencies[step].append(seconds)
+            else:
+                self.errors[step] += 1
+                self.messages[message] = self.messages.get(message, 0) + 1
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+###############################################################################
+# Server memory over time
+###############################################################################
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def descendants(pids):
+    """All processes below pids (e.g. gunicorn workers and their kernels)."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # The command name may contain spaces; the parent pid follows it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    found, todo = [], list(pids)
+    while todo:
+        for child in children.get(todo.pop(), []):
+            found.append(child)
+            todo.append(child)
+    return found
+
+class RSSSampler(threading.Thread):
+    """
+    Samples, every interval seconds, the RSS of the server processes (those
+    given and their descendants), split into the web server and the kernel
+    processes running code.
+    """
+    def __init__(self, pids, interval):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.samples = []               # (seconds since start, server bytes, kernel bytes)
+        self.stopped = threading.Event()
+
+    def run(self):
+        started = time.time()
+        while True:
+            self.samples.append((time.time() - started, *self.measure()))
+            if self.stopped.wait(self.interval):
+                return
+
+    def measure(self):
+        # Kernels are the processes started by the web server processes' multiprocessing
+        server_pids = set(self.pids)
+        all_pids = server_pids | set(descendants(self.pids))
+        workers = {pid for pid in all_pids if kernel_process(pid) is False}
+        server = sum(rss_bytes(pid) for pid in server_pids | workers)
+        total = sum(rss_bytes(pid) for pid in all_pids)
+        return server, total - server
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.samples.append((self.samples[-1][0] + self.interval if self.samples else 0, *self.measure()))
+
+def kernel_process(pid):
+    """Whether a process is a multiprocessing child (a kernel) rather than a web worker."""
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            cmdline = f.read()
+    except OSError:
+        return None
+    return b'multiprocessing' in cmdline
+
+###############################################################################
+# Starting the mock LLM provider and the server
+###############################################################################
+def spawn(args):
+    """Start the mock LLM server and Alfred pointed at it. Returns the processes."""
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_llm_server.py'),
+                             '--port', str(args.mock_port), '--latency', str(args.mock_latency),
+                             '--token-delay', str(args.mock_token_delay), '--error-rate', str(args.mock_error_rate)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    env = dict(os.environ,
+               ALFRED_OPENAI_BASE_URL=f"{mock_url}/v1",
+               ALFRED_ANTHROPIC_BASE_URL=mock_url,
+               ALFRED_GEMINI_BASE_URL=mock_url)
+    for name in ('API_KEY_GEM', 'API_KEY_ANT', 'API_KEY_OAI'):
+        env.setdefault(name, 'mock-key')
+    # The mock has no rate limits, so neither should its clients unless asked to
+    for provider in ('GOOGLE', 'ANTHROPIC', 'OPENAI'):
+        env.setdefault(f'ALFRED_{provider}_RPM', '0')
+        env.setdefault(f'ALFRED_{provider}_TPM', '0')
+    server = subprocess.Popen(shlex.split(args.server_cmd), cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=open(args.server_log, 'w'))
+    try:
+        wait_until_up(f"{mock_url}/stats", mock)
+        wait_until_up(f"{args.url.rstrip('/')}/api/metrics", server)
+    except RuntimeError as e:
+        for process in (mock, server):
+            process.terminate()
+        sys.exit(f"{e} (see {args.server_log})")
+    return mock, server
+
+def wait_until_up(url, process, timeout=120):
+    started = time.time()
+    while time.time() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with code {process.returncode}")
+        try:
+            urllib.request.urlopen(url, timeout=5).close()
+            return
+        except (OSError, urllib.error.URLError):
+            time.sleep(0.5)
+    raise RuntimeError(f"{url} did not respond within {timeout}s")
+
+###############################################################################
+# Report
+###############################################################################
+def report(results, sampler, elapsed, args):
+    print(f"\n{args.users} users x {args.rounds} rounds against {args.url} in {elapsed:.1f}s\n")
+    print(f"{'step':<11} {'ok':>6} {'errors':>6} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'max s':>8}")
+    for step in STEPS:
+        samples = results.latencies[step]
+        values = [percentile(samples, q) for q in (50, 95, 99)] + [max(samples) if samples else None]
+        cells = " ".join(f"{value:>8.3f}" if value is not None else f"{'-':>8}" for value in values)
+        print(f"{step:<11} {len(samples):>6} {results.errors[step]:>6} {cells}")
+
+    executions = len(results.latencies["execution"])
+    print(f"\nexecutions/sec: {executions / elapsed:.2f} ({executions} executions)")
+    for name, count in sorted(results.counters.items()):
+        print(f"{name}: {count}")
+    for message, count in sorted(results.messages.items(), key=lambda item: -item[1])[:5]:
+        print(f"error x{count}: {message}")
+
+    if sampler is not None and sampler.samples:
+        print(f"\n{'time s':>8} {'server MB':>10} {'kernels MB':>11}")
+        step = max(1, len(sampler.samples) // args.rss_rows)
+        rows = sampler.samples[::step]
+        if rows[-1] is not sampler.samples[-1]:
+            rows.append(sampler.samples[-1])
+        for seconds, server, kernels in rows:
+            print(f"{seconds:>8.1f} {server / 1024**2:>10.1f} {kernels / 1024**2:>11.1f}")
+        print(f"peak: {max(s[1] for s in sampler.samples) / 1024**2:.1f} MB server, "
+              f"{max(s[1] + s[2] for s in sampler.samples) / 1024**2:.1f} MB with kernels")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"users": args.users, "rounds": args.rounds, "seconds": elapsed,
+                       "latencies": results.latencies, "errors": results.errors, "counters": results.counters,
+                       "rss": sampler.samples if sampler is not None else []}, f, indent=1)
+        print(f"\nRaw results written to {args.output}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=3, help="code, execution and feedback rounds per user")
+    parser.add_argument('--ramp-up', type=float, default=5.0, help="seconds over which the users start")
+    parser.add_argument('--think', type=float, default=0.0, help="seconds a user waits between steps")
+    parser.add_argument('--model', default='gemini')
+    parser.add_argument('--api-key', default='mock-key', help="sent with /initialize; empty uses the server's key")
+    parser.add_argument('--server-pid', type=int, nargs='*', default=[], help="server processes to measure RSS of")
+    parser.add_argument('--rss-interval', type=float, default=1.0)
+    parser.add_argument('--rss-rows', type=int, default=20, help="rows of the RSS table")
+    parser.add_argument('--output', help="write raw latencies and RSS samples to this JSON file")
+    parser.add_argument('--spawn', action='store_true', help="start the mock LLM server and Alfred first")
+    parser.add_argument('--server-cmd', default='gunicorn -c gunicorn_config.py app:app',
+                        help="command starting Alfred with --spawn, serving --url")
+    parser.add_argument('--server-log', default='load_test_server.log')
+    parser.add_argument('--mock-port', type=int, default=8001)
+    parser.add_argument('--mock-latency', type=float, default=0.5)
+    parser.add_argument('--mock-token-delay', type=float, default=0.02)
+    parser.add_argument('--mock-error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    processes = spawn(args) if args.spawn else ()
+    pids = args.server_pid + ([processes[1].pid] if processes else [])
+    sampler = RSSSampler(pids, args.rss_interval) if pids and os.path.isdir('/proc') else None
+    try:
+        if sampler is not None:
+            sampler.start()
+        results = Results()
+        users = [User(args.url, i, args, results) for i in range(args.users)]
+        threads = [threading.Thread(target=user.run, daemon=True) for user in users]
+        started = time.time()
+        for i, thread in enumerate(threads):
+            time.sleep(args.ramp_up / len(threads) if i else 0)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        if sampler is not None:
+            sampler.stop()
+        report(results, sampler, elapsed, args)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+"""
+Microbenchmarks of the backend's hot functions, each timed over a range of
+input sizes to give a scaling curve. Run from the repository root:
+
+    python benchmarks/microbench.py [--filter prompt] [--quick] [--plot curves.png]
+
+To compare commits, save the results of one and check another against them:
+
+    python benchmarks/microbench.py --save baseline.json
+    python benchmarks/microbench.py --compare baseline.json [--tolerance 0.25]
+
+The run fails (exit code 1) if a timing is more than the tolerance slower than
+the baseline, or if a benchmark scales worse than its expected exponent (the
+slope of time against size on a log-log scale). Both use the fastest of the
+samples, which is the least affected by noise.
+"""
+import os
+import io
+import sys
+import json
+import time
+import math
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('ALFRED_FIGURE_DIR', tempfile.mkdtemp(prefix='alfred-bench-figs-'))
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from flask import g
+from app import app
+from flask_routes import process_uploaded_files, debug_history, save_analysis
+from utils import *
+from kernel import render_figure
+from shared_arrays import release_shared_values
+from namespace_sync import snapshot_namespace, diff_namespace, pack_namespace_delta, apply_namespace_delta
+
+# Every sample runs the function often enough to take at least this long
+MIN_SAMPLE_SECONDS = 0.02
+
+BENCHMARKS = []
+
+
+class Benchmark:
+    """
+    A function timed at each of params. setup(param) is a generator that
+    prepares the inputs, yields the function to time and cleans up after it.
+    """
+    def __init__(self, name, params, unit, max_exponent, setup):
+        self.name = name
+        self.params = params
+        self.unit = unit
+        self.max_exponent = max_exponent
+        self.setup = setup
+
+def benchmark(name, params, unit, max_exponent):
+    def register(setup):
+        BENCHMARKS.append(Benchmark(name, params, unit, max_exponent, setup))
+        return setup
+    return register
+
+###############################################################################
+# Prompt building
+###############################################################################
+def make_figure_urls(count):
+    """URLs of count distinct figures in the figure store."""
+    urls = []
+    for i in range(count):
+        fig = plt.figure()
+        plt.plot(range(100), [x * i for x in range(100)])
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png')
+        plt.close(fig)
+        urls.append(figure_url(store_figure(buf.getvalue(), 'image/png')))
+    return urls
+
+def make_history(length, figure_every, urls):
+    """History of length entries, of which one in figure_every shows the next of urls."""
+    history = ConversationHistory()
+    for i in range(length):
+        if i % figure_every == figure_every - 1:
+            history.append({"role": "figure", "type": "figure", "iteration": i,
+                            "content": {"type": "image_url", "image_url": {"url": urls[i // figure_every % len(urls)]}}})
+        else:
+            history.append({"role": "assistant", "type": "text", "iteration": i, "content": "Some analysis. " * 40})
+    return history
+
+# Histories of up to about 60k tokens, within CONTEXT_TOKEN_BUDGET so that they are not compacted
+@benchmark("prompt.uncached", [25, 100, 400], "entries", max_exponent=1.25)
+def prompt_uncached(length):
+    # Text only, so that the time per entry is not hidden by rendering figures
+    history = make_history(length, length + 1, [])
+    yield lambda: build_llm_prompt(history, "gemini-2.0-flash", "text")
+
+@benchmark("prompt.cached", [25, 100, 400], "entries", max_exponent=0.8)
+def prompt_cached(length):
+    # The next turn of a session whose history was rendered already
+    history = make_history(length, length + 1, [])
+    cache = PromptCache()
+    build_llm_prompt(history, "gemini-2.0-flash", "text", cache=cache)
+    history.append({"role": "user", "type": "text", "iteration": length, "content": "Next step"})
+    yield lambda: build_llm_prompt(history, "gemini-2.0-flash", "text", cache=cache)
+
+@benchmark("prompt.figures", [10, 40, 160], "figures", max_exponent=1.25)
+def prompt_figures(count):
+    # Every figure distinct, as each is downsampled and encoded separately
+    history = make_history(count * 2, 2, make_figure_urls(count))
+    yield lambda: build_llm_prompt(history, "claude-sonnet-4-20250514", "text")
+
+###############################################################################
+# Parsing LLM output
+###############################################################################
+def llm_json_output(kilobytes):
+    """A "both" response of about kilobytes KB, with the invalid escapes LLMs tend to write in code."""
+    code = ("import re\\nimport numpy as np\\n"
+            "pattern = re.compile(r'\\d+\\s*ms')\\n"
+            "plt.title('$\\alpha$ vs $\\beta$')\\n"
+            "print(\\\"done\\tok\\\")\\n")
+    repeats = max(1, kilobytes * 1024 // len(code))
+    return json.dumps({"text_summary": "Summary. " * 10, "python_code": ""})[:-2] + code * repeats + '"}'
+
+@benchmark("json.fix_escapes", [10, 100, 1000], "KB", max_exponent=1.25)
+def json_fix_escapes(kilobytes):
+    output = llm_json_output(kilobytes)
+    yield lambda: fix_json_escapes(output)
+
+@benchmark("json.safe_loads", [10, 100, 1000], "KB", max_exponent=1.25)
+def json_safe_loads(kilobytes):
+    output = llm_json_output(kilobytes)
+    yield lambda: safe_json_loads(output)
+
+###############################################################################
+# Figures
+###############################################################################
+def scatter_figure(points):
+    rng = np.random.default_rng(0)
+    fig = plt.figure(figsize=(6, 4))
+    plt.scatter(rng.normal(size=points), rng.normal(size=points), s=2)
+    plt.plot(np.sort(rng.normal(size=points)))
+    return fig
+
+@benchmark("figure.base64", [1000, 10000, 100000], "points", max_exponent=1.1)
+def figure_base64(points):
+    fig = scatter_figure(points)
+    yield lambda: fig_to_base64(fig)
+    plt.close(fig)
+
+@benchmark("figure.render", [1000, 10000, 100000], "points", max_exponent=1.1)
+def figure_render(points):
+    fig = scatter_figure(points)
+    yield lambda: render_figure(fig)
+    plt.close(fig)
+
+###############################################################################
+# Uploaded files
+###############################################################################
+def upload_benchmark(file_type, write):
+    def setup(megabytes):
+        directory = tempfile.mkdtemp(prefix='alfred-bench-upload-')
+        path = os.path.join(directory, f"data.{file_type}")
+        write(path, megabytes * 1024**2)
+        states = []
+        def load():
+            states.append(AppState())
+            process_uploaded_files([{"path": path, "type": file_type}], states[-1])
+        yield load
+        for state in states:
+            release_shared_values(state.analysis_namespace.values(), {})
+        shutil.rmtree(directory)
+    return setup
+
+def write_csv(path, nbytes):
+    rows = nbytes // 60
+    rng = np.random.default_rng(0)
+    pd.DataFrame({"trial": np.arange(rows), "x": rng.normal(size=rows), "y": rng.normal(size=rows),
+                  "label": rng.choice(["left", "right"], rows)}).to_csv(path, index=False)
+
+def write_npy(path, nbytes):
+    np.save(path, np.random.default_rng(0).normal(size=(nbytes // 8 // 100, 100)))
+
+def write_json(path, nbytes):
+    records = [{"trial": i, "x": i * 0.5, "label": "left" if i % 2 else "right"} for i in range(nbytes // 45)]
+    with open(path, 'w') as f:
+        json.dump(records, f)
+
+def write_txt(path, nbytes):
+    with open(path, 'w') as f:
+        f.write("Notes about the recording session.\n" * (nbytes // 35))
+
+# Past SHARED_ARRAY_THRESHOLD, arrays and frames are also copied into shared memory
+for file_type, write in (("csv", write_csv), ("npy", write_npy), ("json", write_json), ("txt", write_txt)):
+    benchmark(f"upload.{file_type}", [1, 8, 32], "MB", max_exponent=1.4)(upload_benchmark(file_type, write))
+
+###############################################################################
+# Conversation history routes
+###############################################################################
+def analysis_state(rounds):
+    """Session after rounds of analysis, each with text, code, output and a figure."""
+    state = AppState()
+    urls = make_figure_urls(20)
+    for i in range(rounds):
+        state.conversation_history.append({"role": "assistant", "type": "text", "iteration": i,
+                                           "content": "Some analysis.\n" * 40})
+        state.conversation_history.append({"role": "assistant", "type": "code", "iteration": i,
+                                           "content": "```python\nprint(x.mean())\n```"})
+        state.conversation_history.append({"role": "computer", "type": "output", "iteration": i,
+                                           "content": "Code Output:\n" + "0.5\n" * 20})
+        state.conversation_history.append({"role": "figure", "type": "figure", "iteration": i,
+                                           "content": {"type": "image_url", "image_url": {"url": urls[i % len(urls)]}}})
+    return state
+
+@benchmark("history.debug", [100, 400, 1600], "rounds", max_exponent=1.25)
+def history_debug(rounds):
+    state = analysis_state(rounds)
+    def serialize():
+        with app.test_request_context('/debug/history'):
+            g.state = state
+            debug_history().get_data()
+    yield serialize
+
+@benchmark("history.save_analysis", [50, 200, 800], "figures", max_exponent=1.25)
+def history_save_analysis(figures):
+    state = analysis_state(figures)
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='alfred-bench-save-')
+    os.chdir(directory)
+    def save():
+        with app.test_request_context('/save_analysis', method='POST'):
+            g.state = state
+            save_analysis()
+    yield save
+    os.chdir(cwd)
+    shutil.rmtree(directory)
+
+###############################################################################
+# Namespace round trip between the kernel and the web worker
+###############################################################################
+@benchmark("namespace.roundtrip", [1, 16, 64], "MB", max_exponent=1.25)
+def namespace_roundtrip(megabytes):
+    # What an execution ships back: an array, a frame and plain Python objects, all new
+    rng = np.random.default_rng(0)
+    rows = megabytes * 1024**2 // 3 // 8
+    namespace = {
+        "spikes": rng.normal(size=rows),
+        "trials": pd.DataFrame({"x": rng.normal(size=rows // 2), "y": rng.normal(size=rows // 2)}),
+        "records": [{"trial": i, "rt": i * 0.01} for i in range(rows // 64)],
+    }
+    received = []
+    def roundtrip():
+        snapshot, blobs = snapshot_namespace(namespace)
+        changed, deleted = diff_namespace({}, snapshot)
+        delta = pack_namespace_delta(namespace, changed, deleted, blobs)
+        received.append({})
+        apply_namespace_delta(received[-1], delta)
+    yield roundtrip
+    for values in received:
+        release_shared_values(values.values(), {})
+
+###############################################################################
+# Running and reporting
+###############################################################################
+def time_benchmark(bench, param, repeat):
+    """Median and minimum seconds per call of a benchmark at one param."""
+    setup = bench.setup(param)
+    fn = next(setup)
+    try:
+        started = time.perf_counter()
+        fn()
+        calls = max(1, min(1000, int(MIN_SAMPLE_SECONDS / max(time.perf_counter() - started, 1e-9))))
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(calls):
+                fn()
+            samples.append((time.perf_counter() - started) / calls)
+    finally:
+        next(setup, None)           # clean up
+    samples.sort()
+    return samples[len(samples) // 2], samples[0]
+
+def scaling_exponent(params, seconds):
+    """Least-squares slope of log(seconds) against log(param)."""
+    xs = [math.log(p) for p in params]
+    ys = [math.log(max(s, 1e-9)) for s in seconds]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x if var_x else 0.0
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline, tolerance, min_delta):
+    """Timings more than tolerance (and min_delta seconds) slower than the baseline."""
+    regressions = []
+    for name, timings in results.items():
+        for param, seconds in timings.items():
+            before = baseline.get(name, {}).get(param)
+            if before and seconds > before * (1 + tolerance) and seconds - before > min_delta:
+                regressions.append(f"{name} at {param}: {before * 1000:.3f} -> {seconds * 1000:.3f} ms "
+                                   f"({seconds / before - 1:+.0%})")
+    return regressions
+
+def plot_curves(benchmarks, results, path):
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for i, bench in enumerate(benchmarks):
+        timings = results[bench.name]
+        params = [p for p in bench.params if str(p) in timings]
+        # Relative to the smallest size, so that curves of different units share the axes
+        ax.loglog([p / params[0] for p in params], [timings[str(p)] * 1000 for p in params], marker='o',
+                  linestyle=('-', '--', ':')[i // 10 % 3], label=bench.name)
+    ax.set_xlabel("size relative to the smallest")
+    ax.set_ylabel("ms per call")
+    ax.legend(fontsize='small')
+    fig.savefig(path, dpi=120, bbox_inches='tight')
+    plt.close(fig)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', nargs='*', default=[], help="only run benchmarks whose name contains one of these")
+    parser.add_argument('--quick', action='store_true', help="only the two smallest sizes of each benchmark")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="check the results against a file written by --save")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown against --compare")
+    parser.add_argument('--min-delta-ms', type=float, default=0.5, help="ignore slowdowns smaller than this")
+    parser.add_argument('--plot', help="save the scaling curves to this image")
+    args = parser.parse_args()
+
+    # Warnings logged by the functions under test (e.g. JSON that needs fixing) are expected
+    logging.getLogger('alfred').setLevel(logging.ERROR)
+
+    benchmarks = [bench for bench in BENCHMARKS if not args.filter or any(f in bench.name for f in args.filter)]
+    results = {}
+    failures = []
+    print(f"{'benchmark':<22} {'size':>14} {'median ms':>11} {'min ms':>10} {'exponent':>9}")
+    for bench in benchmarks:
+        params = bench.params[:2] if args.quick else bench.params
+        fastest_times = []
+        for param in params:
+            median, fastest = time_benchmark(bench, param, args.repeat)
+            fastest_times.append(fastest)
+            results.setdefault(bench.name, {})[str(param)] = fastest
+            print(f"{bench.name:<22} {f'{param} {bench.unit}':>14} {median * 1000:>11.3f} {fastest * 1000:>10.3f}")
+        exponent = scaling_exponent(params, fastest_times)
+        flag = ""
+        if exponent > bench.max_exponent:
+            flag = f"  > {bench.max_exponent}"
+            failures.append(f"{bench.name} scales as size^{exponent:.2f} (expected at most {bench.max_exponent})")
+        print(f"{'':<22} {'':>14} {'':>11} {'':>10} {exponent:>9.2f}{flag}")
+
+    if args.plot:
+        plot_curves(benchmarks, results, args.plot)
+        print(f"\nScaling curves saved to {args.plot}")
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"revision": git_revision(), "repeat": args.repeat, "results": results}, f, indent=1)
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        failures += compare(results, baseline["results"], args.tolerance, args.min_delta_ms / 1000)
+        print(f"\nCompared with {args.compare} (revision {baseline.get('revision')})")
+
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nNo regressions")
+
+if __name__ == '__main__':
+    main()
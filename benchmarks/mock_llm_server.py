@@ -0,0 +1,266 @@
+"""
+Local stand-in for the parts of the OpenAI, Anthropic and Gemini APIs that
+Alfred uses, for load tests without provider costs, rate limits or network
+noise. Responses are canned: code when the prompt asks for code, JSON for
+"both" requests and text otherwise, streamed in chunks with the configured
+latency. Run from the repository root:
+
+    python benchmarks/mock_llm_server.py [--port 8001] [--latency 0.5] [--token-delay 0.02]
+
+and point Alfred at it with
+
+    ALFRED_OPENAI_BASE_URL=http://localhost:8001/v1
+    ALFRED_ANTHROPIC_BASE_URL=http://localhost:8001
+    ALFRED_GEMINI_BASE_URL=http://localhost:8001
+
+Any API key is accepted.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, Response, request, jsonify
+from prompts import NOW_CONTINUE_CODE, NOW_CONTINUE_BOTH
+
+DEFAULT_CODE = """import numpy as np
+import matplotlib.pyplot as plt
+
+values = np.asarray(x, dtype=float).ravel() if 'x' in globals() else np.random.randn(1000)
+print(f"n={values.size} mean={values.mean():.3f} std={values.std():.3f}")
+
+plt.figure(figsize=(6, 4))
+plt.hist(values, bins=40)
+plt.title("Distribution of values")
+plt.show()
+"""
+
+WORDS = ("the data show a clear trend across conditions with some variance between "
+         "samples and a few outliers that suggest further analysis of the distribution").split()
+
+app = Flask(__name__)
+settings = argparse.Namespace(latency=0.5, jitter=0.2, token_delay=0.02, chunk_words=4, words=150,
+                              error_rate=0.0, code=DEFAULT_CODE)
+counts = {"requests": 0, "errors": 0}
+counts_lock = threading.Lock()
+
+
+###############################################################################
+# Canned responses
+###############################################################################
+def last_text(value):
+    """Last text field in a request body, where Alfred puts its instruction."""
+    if isinstance(value, dict):
+        for key in ("text", "content"):
+            if isinstance(value.get(key), str):
+                return value[key]
+        value = list(value.values())
+    if isinstance(value, list):
+        for item in reversed(value):
+            text = last_text(item)
+            if text:
+                return text
+    return None
+
+def canned_response(instruction):
+    words = " ".join(random.choice(WORDS) for _ in range(settings.words))
+    text = f"## Summary\n{words.capitalize()}.\n\n## Open questions\n1. Is the trend robust?\n2. What drives the outliers?"
+    if instruction and NOW_CONTINUE_BOTH.strip() in instruction:
+        return json.dumps({"text_summary": text, "python_code": settings.code})
+    if instruction and NOW_CONTINUE_CODE.strip() in instruction:
+        return f"```python\n{settings.code}```"
+    return text
+
+def chunks(text):
+    """Split a response into streamed chunks of about chunk_words words."""
+    words = text.split(" ")
+    return [" ".join(words[i:i + settings.chunk_words]) + (" " if i + settings.chunk_words < len(words) else "")
+            for i in range(0, len(words), settings.chunk_words)]
+
+def first_token_delay():
+    return max(0.0, settings.latency * random.uniform(1 - settings.jitter, 1 + settings.jitter))
+
+def token_counts(body, text):
+    # Roughly four characters per token
+    return max(1, len(json.dumps(body)) // 4), max(1, len(text) // 4)
+
+def timed_chunks(text):
+    """Chunks of a response, each after its delay."""
+    time.sleep(first_token_delay())
+    for i, chunk in enumerate(chunks(text)):
+        if i:
+            time.sleep(settings.token_delay)
+        yield chunk
+
+def complete(text):
+    """Wait as long as streaming the whole response would take."""
+    time.sleep(first_token_delay() + settings.token_delay * max(0, len(chunks(text)) - 1))
+
+def sse(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def injected_error():
+    """
+    With probability error_rate, a transient error response (rate limit or
+    overload, with a Retry-After) for Alfred's retries to deal with.
+    """
+    with counts_lock:
+        counts["requests"] += 1
+        if random.random() >= settings.error_rate:
+            return None
+        counts["errors"] += 1
+    code = random.choice((429, 503))
+    response = jsonify({"error": {"type": "rate_limit_error" if code == 429 else "overloaded_error",
+                                  "code": code, "message": "Injected by the mock LLM server"}})
+    response.status_code = code
+    response.headers['Retry-After'] = '1'
+    return response
+
+###############################################################################
+# OpenAI: chat completions
+###############################################################################
+@app.route('/v1/chat/completions', methods=['POST'])
+def openai_chat():
+    body = request.get_json()
+    error = injected_error()
+    if error is not None:
+        return error
+    text = canned_response(last_text(body.get("messages", [])))
+    prompt_tokens, output_tokens = token_counts(body, text)
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens,
+             "total_tokens": prompt_tokens + output_tokens}
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    model = body.get("model")
+
+    if not body.get("stream"):
+        complete(text)
+        return jsonify({"id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                        "model": model, "usage": usage,
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": text}}]})
+
+    def generate():
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        for chunk in timed_chunks(text):
+            yield sse({**base, "choices": [{"index": 0, "finish_reason": None,
+                                            "delta": {"role": "assistant", "content": chunk}}]})
+        yield sse({**base, "choices": [{"index": 0, "finish_reason": "stop", "delta": {}}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield sse({**base, "choices": [], "usage": usage})
+        yield "data: [DONE]\n\n"
+    return Response(generate(), mimetype='text/event-stream')
+
+###############################################################################
+# Anthropic: messages
+###############################################################################
+@app.route('/v1/messages', methods=['POST'])
+def anthropic_messages():
+    body = request.get_json()
+    error = injected_error()
+    if error is not None:
+        return error
+    text = canned_response(last_text(body.get("messages", [])))
+    input_tokens, output_tokens = token_counts(body, text)
+    usage = {"input_tokens": input_tokens, "output_tokens": output_tokens,
+             "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+    message = {"id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant",
+               "model": body.get("model"), "stop_reason": None, "stop_sequence": None}
+
+    if not body.get("stream"):
+        complete(text)
+        return jsonify({**message, "stop_reason": "end_turn", "usage": usage,
+                        "content": [{"type": "text", "text": text}]})
+
+    def generate():
+        yield sse({"type": "message_start", "message": {**message, "content": [], "usage": {**usage, "output_tokens": 1}}},
+                  "message_start")
+        yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                  "content_block_start")
+        for chunk in timed_chunks(text):
+            yield sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}},
+                      "content_block_delta")
+        yield sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                   "usage": {"output_tokens": output_tokens}}, "message_delta")
+        yield sse({"type": "message_stop"}, "message_stop")
+    return Response(generate(), mimetype='text/event-stream')
+
+###############################################################################
+# Gemini: generateContent, streamGenerateContent and context caches
+###############################################################################
+@app.route('/<version>/models/<path:target>', methods=['POST'])
+def gemini_generate(version, target):
+    body = request.get_json()
+    error = injected_error()
+    if error is not None:
+        return error
+    model, _, method = target.partition(':')
+    text = canned_response(last_text(body.get("contents", [])))
+    prompt_tokens, output_tokens = token_counts(body, text)
+    usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+             "totalTokenCount": prompt_tokens + output_tokens}
+    if body.get("cachedContent"):
+        usage["cachedContentTokenCount"] = prompt_tokens // 2
+
+    def candidate(part, finish_reason=None):
+        candidate = {"index": 0, "content": {"role": "model", "parts": [{"text": part}]}}
+        if finish_reason:
+            candidate["finishReason"] = finish_reason
+        return candidate
+
+    if method == "generateContent":
+        complete(text)
+        return jsonify({"candidates": [candidate(text, "STOP")], "usageMetadata": usage, "modelVersion": model})
+    if method != "streamGenerateContent":
+        return jsonify({"error": {"code": 404, "message": f"Unknown method: {method}"}}), 404
+
+    def generate():
+        for chunk in timed_chunks(text):
+            yield sse({"candidates": [candidate(chunk)], "modelVersion": model})
+        yield sse({"candidates": [candidate("", "STOP")], "usageMetadata": usage, "modelVersion": model})
+    return Response(generate(), mimetype='text/event-stream')
+
+@app.route('/<version>/cachedContents', methods=['POST'])
+def gemini_create_cache(version):
+    body = request.get_json()
+    now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    return jsonify({"name": f"cachedContents/{uuid.uuid4().hex[:16]}", "model": body.get("model"),
+                    "createTime": now, "updateTime": now,
+                    "usageMetadata": {"totalTokenCount": max(1, len(json.dumps(body)) // 4)}})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    with counts_lock:
+        return jsonify(dict(counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds until the first token")
+    parser.add_argument('--jitter', type=float, default=0.2, help="relative spread of the latency")
+    parser.add_argument('--token-delay', type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument('--chunk-words', type=int, default=4, help="words per streamed chunk")
+    parser.add_argument('--words', type=int, default=150, help="length of text responses in words")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests failing with 429 or 503")
+    parser.add_argument('--code-file', help="file with the code returned for code requests")
+    args = parser.parse_args()
+
+    for name in ('latency', 'jitter', 'token_delay', 'chunk_words', 'words', 'error_rate'):
+        setattr(settings, name, getattr(args, name))
+    if args.code_file:
+        with open(args.code_file) as f:
+            settings.code = f.read()
+
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
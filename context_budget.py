@@ -0,0 +1,105 @@
+import os
+import io
+import math
+import base64
+import logging
+from PIL import Image
+from figure_store import *
+
+logger = logging.getLogger('alfred')
+
+# Approximate number of prompt tokens the conversation history may use. Beyond
+# that, the oldest iterations are collapsed into short summaries until the
+# history fits in COMPACTION_TARGET of the budget (leaving room for it to grow,
+# so that compaction happens rarely).
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('ALFRED_CONTEXT_TOKEN_BUDGET', 100000))
+COMPACTION_TARGET = 0.75
+
+# The most recent iterations are never collapsed
+MIN_FULL_ITERATIONS = 2
+
+# Figures of this many most recent iterations are sent at full resolution,
+# older ones downsampled to at most OLD_FIGURE_SIZE pixels per side
+FIGURE_WINDOW = int(os.environ.get('ALFRED_FIGURE_WINDOW', 2))
+OLD_FIGURE_SIZE = int(os.environ.get('ALFRED_OLD_FIGURE_SIZE', 384))
+
+# Rough token estimates: characters per text token, and pixels per image token
+# (with a cap, as providers scale large images down)
+CHARS_PER_TOKEN = 4
+PIXELS_PER_TOKEN = 750
+MAX_IMAGE_TOKENS = 1600
+
+# Each entry of a collapsed iteration is shortened to this many characters
+SUMMARY_ENTRY_CHARS = 300
+
+
+###############################################################################
+# Token estimates
+###############################################################################
+def estimate_text_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def estimate_image_tokens(width, height):
+    return min(MAX_IMAGE_TOKENS, math.ceil(width * height / PIXELS_PER_TOKEN))
+
+###############################################################################
+# Figures sent at reduced resolution
+###############################################################################
+def figure_size(url):
+    """(width, height) of a history figure in pixels, or None if it cannot be read."""
+    figure = load_figure(url)
+    if figure is None:
+        return None
+    try:
+        return Image.open(io.BytesIO(figure[0])).size
+    except Exception as e:
+        logger.warning(f"Could not read figure size: {e}")
+        return None
+
+def downsample_figure(url, max_size=OLD_FIGURE_SIZE):
+    """
+    Data URL of a history figure scaled down to at most max_size pixels per
+    side (or the figure itself, if it is that small already).
+
+    Returns:
+        tuple: (data URL, (width, height)) or None if the figure cannot be read
+    """
+    figure = load_figure(url)
+    if figure is None:
+        return None
+    data, media_type = figure
+    try:
+        image = Image.open(io.BytesIO(data))
+        if max(image.size) > max_size:
+            image.thumbnail((max_size, max_size))
+            buf = io.BytesIO()
+            image_format = "JPEG" if media_type == "image/jpeg" else "PNG"
+            image.save(buf, format=image_format)
+            data, media_type = buf.getvalue(), f"image/{image_format.lower()}"
+    except Exception as e:
+        logger.warning(f"Could not downsample figure: {e}")
+        return None
+    return f"data:{media_type};base64,{base64.b64encode(data).decode('utf-8')}", image.size
+
+###############################################################################
+# Summaries of collapsed iterations
+###############################################################################
+def shorten(text, limit=SUMMARY_ENTRY_CHARS, keep_lines=False):
+    text = str(text).strip() if keep_lines else " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit] + " [...]"
+
+def summarize_iteration(iteration, entries):
+    """Text that replaces the entries of an old iteration in the prompt."""
+    lines = [f"(Iteration {iteration}, shortened to save space)"]
+    figures = 0
+    for entry in entries:
+        role = entry.get("role", "user")
+        if role == "figure":
+            figures += 1
+        elif entry.get("type") == "code":
+            lines.append(f"ASSISTANT RAN CODE:\n{shorten(entry.get('content', ''), keep_lines=True)}")
+        else:
+            lines.append(f"{role.upper()} SAYS: {shorten(entry.get('content', ''))}")
+    if figures:
+        lines.append(f"ASSISTANT SAYS: [Generated {figures} figure(s), no longer shown]")
+    return "\n".join(lines)
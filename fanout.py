@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# Default fan-out mode of LLM requests: off (''), 'first' (the first valid
+# response wins and the other requests are cancelled) or 'compare' (all
+# responses are returned side by side). Requests can choose with ?fanout=.
+FANOUT_MODE = os.environ.get('ALFRED_FANOUT', '').lower()
+FANOUT_MODES = ("first", "compare")
+
+# Models a fanned out request is sent to besides the session's own model;
+# models without an API key are skipped
+FANOUT_MODELS = [model.strip() for model in os.environ.get('ALFRED_FANOUT_MODELS', 'claude,gemini,gpt').split(',')
+                 if model.strip()]
+
+# Threads for the concurrent requests (on top of the LLM job waiting for them)
+FANOUT_MAX_WORKERS = int(os.environ.get('ALFRED_FANOUT_MAX_WORKERS', 64))
+
+fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix='alfred-fanout')
+
+
+class FanOutCancelled(Exception):
+    """Raised inside a model's request to stop it once another model's response won."""
+
+###############################################################################
+# The same request sent to several models at once
+###############################################################################
+class FanOut:
+    """
+    Sends a request to several models concurrently. calls maps each model to
+    fn(emit), which makes the request, publishes progress through emit (as an
+    LLM job does, see llm_jobs.py) and returns the response.
+
+    In 'first' mode the first valid response wins. The other requests are
+    cancelled at their next streamed token; requests that do not stream run
+    to completion and are ignored. Tokens of one model at a time are relayed:
+    the first one to stream, or the next one if that model fails.
+
+    In 'compare' mode all requests run to completion. Tokens of the primary
+    model are relayed, and it wins if its response is valid.
+    """
+    def __init__(self, calls, emit, mode="first", primary=None):
+        self.calls = calls
+        self.emit = emit
+        self.mode = mode
+        self.primary = primary
+        self.winner = None
+        self.leader = None                          # model whose tokens are relayed
+        self.texts = {model: [] for model in calls}
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+
+    def run(self):
+        """
+        Run the requests until there is a winner ('first') or all finished.
+
+        Returns:
+            dict: model -> (response, exception) of the requests that finished
+        """
+        metrics.increment(f'fanout.requests.{self.mode}')
+        futures = {fanout_executor.submit(self._call, model, fn): model for model, fn in self.calls.items()}
+        results = {}
+        for future in as_completed(futures):
+            model = futures[future]
+            results[model] = future.result()
+            if self.mode == "first" and results[model][0]:
+                self.winner = model
+                self.cancelled.set()
+                break
+
+        if self.mode == "compare":
+            valid = [model for model in results if results[model][0]]
+            if valid:
+                self.winner = self.primary if self.primary in valid else valid[0]
+        if self.winner is not None:
+            metrics.increment(f'fanout.wins.{self.winner}')
+            logger.info(f"Fanned out request to {list(self.calls)}, using the response of {self.winner}")
+        return results
+
+    def _call(self, model, fn):
+        started = time.time()
+        try:
+            response = fn(self._emitter(model))
+        except FanOutCancelled:
+            metrics.increment('fanout.cancelled')
+            return None, None
+        except Exception as e:
+            logger.warning(f"Fanned out request to {model} failed: {e}")
+            metrics.increment(f'fanout.errors.{model}')
+            self._drop_leader(model)
+            return None, e
+        metrics.observe(f'fanout.seconds.{model}', time.time() - started)
+        if not response:
+            self._drop_leader(model)
+        return response, None
+
+    def _emitter(self, model):
+        def emit(event, data):
+            if self.cancelled.is_set() and model != self.winner:
+                raise FanOutCancelled()
+            with self.lock:
+                if event == 'status' and data.get("status") == "retrying":
+                    self.texts[model] = []
+                    if self.leader == model:
+                        self.emit(event, data)
+                elif event == 'token':
+                    self.texts[model].append(data["text"])
+                    if self.mode == "compare":
+                        if model == self.primary:
+                            self.emit(event, data)
+                    elif self.leader is None:
+                        # A new leader starts with what it streamed so far
+                        self.leader = model
+                        self.emit('token', {"text": "".join(self.texts[model])})
+                    elif self.leader == model:
+                        self.emit(event, data)
+        return emit
+
+    def _drop_leader(self, model):
+        with self.lock:
+            if self.leader == model and self.winner is None:
+                # The client starts over with the next model to stream
+                self.leader = None
+                self.emit('status', {"status": "retrying"})
@@ -0,0 +1,138 @@
+import os
+import re
+import time
+import base64
+import hashlib
+import logging
+
+logger = logging.getLogger('alfred')
+
+# Rendered figures are stored once, named by the hash of their contents
+FIGURE_DIR = os.environ.get('ALFRED_FIGURE_DIR', 'figs')
+
+# URL prefix under which figures are served (see /figures/<figure_hash>)
+FIGURE_URL_PREFIX = '/figures/'
+
+# File extensions of the image formats figures can be rendered to
+FIGURE_EXTENSIONS = {'png': 'image/png', 'jpg': 'image/jpeg', 'webp': 'image/webp', 'svg': 'image/svg+xml'}
+
+# Figures not used for this many seconds, by a session in memory or otherwise,
+# are removed (see sweep_old_figures). Longer than sessions are kept on disk.
+FIGURE_RETENTION = float(os.environ.get('ALFRED_FIGURE_RETENTION', 14 * 24 * 3600))
+
+_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+###############################################################################
+# Content-addressed figure store
+###############################################################################
+def store_figure(data, media_type='image/png'):
+    """
+    Write an encoded figure to the store (if it is not there already).
+
+    Returns:
+        str: The hash the figure can be retrieved with
+    """
+    figure_hash = hashlib.sha256(data).hexdigest()
+    path = os.path.join(FIGURE_DIR, f"{figure_hash}.{figure_extension(media_type)}")
+
+    if os.path.exists(path):
+        # In use again: restart its retention period
+        os.utime(path)
+    else:
+        os.makedirs(FIGURE_DIR, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial figure
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return figure_hash
+
+def figure_extension(media_type):
+    return next((ext for ext, mt in FIGURE_EXTENSIONS.items() if mt == media_type), 'png')
+
+def find_figure(figure_hash):
+    """
+    Look up a stored figure.
+
+    Returns:
+        tuple: (path, media_type) or None if there is no such figure
+    """
+    if not isinstance(figure_hash, str) or not _HASH_PATTERN.match(figure_hash):
+        return None
+    for extension, media_type in FIGURE_EXTENSIONS.items():
+        path = os.path.join(FIGURE_DIR, f"{figure_hash}.{extension}")
+        if os.path.exists(path):
+            return path, media_type
+    return None
+
+def sweep_old_figures(live_hashes, max_age=FIGURE_RETENTION):
+    """
+    Remove figures older than max_age seconds that none of live_hashes (the
+    figures of the sessions in memory) refers to. Live figures are touched
+    once they are half that old, so that they outlast their session being
+    spilled to disk, or being in memory in another worker only.
+
+    Returns:
+        int: Number of figures removed
+    """
+    now = time.time()
+    removed = 0
+    try:
+        names = os.listdir(FIGURE_DIR)
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(FIGURE_DIR, name)
+        try:
+            age = now - os.path.getmtime(path)
+            if name.split('.', 1)[0] in live_hashes and not name.endswith('.tmp'):
+                if age > max_age / 2:
+                    os.utime(path)
+            elif age > max_age:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info(f"Removed {removed} figure(s) not used for {max_age / 86400:.0f} days")
+    return removed
+
+def figure_url(figure_hash):
+    return f"{FIGURE_URL_PREFIX}{figure_hash}"
+
+def figure_hash_from_url(url):
+    if isinstance(url, str) and url.startswith(FIGURE_URL_PREFIX):
+        return url[len(FIGURE_URL_PREFIX):]
+    return None
+
+def load_figure(url):
+    """
+    Read the figure behind a history image URL (a figure store URL or a data URL).
+
+    Returns:
+        tuple: (image bytes, media_type) or None if the figure cannot be found
+    """
+    if isinstance(url, str) and url.startswith("data:image") and ";base64," in url:
+        header, data = url.split(",", 1)
+        try:
+            return base64.b64decode(data), header[len("data:"):header.find(";")]
+        except ValueError:
+            logger.warning(f"Invalid base64 figure data: {url[:100]}")
+            return None
+
+    found = find_figure(figure_hash_from_url(url))
+    if found is None:
+        logger.warning(f"Figure not found in store: {str(url)[:100]}")
+        return None
+    path, media_type = found
+    with open(path, 'rb') as f:
+        return f.read(), media_type
+
+def figure_data_url(url):
+    """Inline data URL for a history image URL, e.g. to send the figure to an LLM."""
+    figure = load_figure(url)
+    if figure is None:
+        return None
+    data, media_type = figure
+    return f"data:{media_type};base64,{base64.b64encode(data).decode('utf-8')}"
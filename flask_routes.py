@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory, g
+from flask import Flask, render_template, request, jsonify, send_from_directory, send_file, g, Response, stream_with_context
 import os
 import numpy as np
 import pandas as pd
@@ -11,9 +11,17 @@ import zipfile
 from werkzeug.utils import secure_filename
 from utils import *
 from data_loader import *
+from kernel import *
+from shared_arrays import *
+from scheduler import *
+from streaming import *
+from llm_jobs import *
+from speculation import *
+from fanout import *
 from app import app
 from collections import defaultdict
 import shutil
+import metrics
 
 app.secret_key = os.environ.get('FLASK_SECRET', 'default_secret_key')
 
@@ -21,14 +29,25 @@ app.secret_key = os.environ.get('FLASK_SECRET', 'default_secret_key')
 def load_user_state():
     g.state = get_user_state()
 
+@app.after_request
+def publish_user_state(response):
+    # Make session fields changed by this request visible to the other workers
+    if 'state' in g:
+        g.state.publish()
+    return response
+
 logger.info("Click here to run Alfred: http://localhost:5000")
 
 @app.route('/initialize', methods=['POST'])
 def init_data():
     """Initialize dataset either with auto-generated data or user uploaded files"""
 
-    g.state.conversation_history = []
+    # The worker initialising a session owns its namespace and kernel from now on
+    ownership.claim(g.state.session_id, force=True)
+    g.state.reset_history()
     g.state.iteration_count = 0
+    shutdown_kernel(g.state)
+    release_shared_values(g.state.analysis_namespace.values(), {})
     g.state.analysis_namespace = {}
     
     api_key = request.form.get('apiKey', '')
@@ -186,9 +205,10 @@ def init_data():
                 "message": "Not uploading any data. Data access procedure should be specified in prompt."
             })
 
-def process_uploaded_files(file_info):
+def process_uploaded_files(file_info, state=None):
     """Process uploaded files and store them in the analysis_namespace"""
     
+    state = state or g.state
     processed_files = []
     
     for file in file_info:
@@ -202,7 +222,7 @@ def process_uploaded_files(file_info):
                 # Load CSV file into a pandas DataFrame
                 df = pd.read_csv(file_path)
                 var_name = f'df_{base_name}'
-                g.state.analysis_namespace[var_name] = df
+                state.analysis_namespace[var_name] = to_shared(df)         # large frames live in shared memory
                 processed_files.append((var_name, f"DataFrame with shape {df.shape}"))
                 logger.info(f"Loaded CSV file: {file_path} as {var_name}")
                 
@@ -213,7 +233,7 @@ def process_uploaded_files(file_info):
                 except:
                     arr  = np.load(file_path, allow_pickle=True)
                 var_name = f'arr_{base_name}'
-                g.state.analysis_namespace[var_name] = arr
+                state.analysis_namespace[var_name] = to_shared(arr)        # large arrays live in shared memory
                 processed_files.append((var_name, f"NumPy array with shape {arr.shape}"))
                 logger.info(f"Loaded NumPy file: {file_path} as {var_name}")
 
@@ -221,7 +241,7 @@ def process_uploaded_files(file_info):
                 with open(file_path) as f:
                     jsonfile = json.load(f)
                 var_name = f'json_{base_name}'
-                g.state.analysis_namespace[var_name] = jsonfile
+                state.analysis_namespace[var_name] = jsonfile
                 if type(jsonfile) is list:
                     processed_files.append((var_name, f"List from JSON file"))
                 elif type(jsonfile) is dict:
@@ -234,12 +254,12 @@ def process_uploaded_files(file_info):
                 with open(file_path) as f:
                     txtfile = f.read()
                 var_name = f'txt_{base_name}'
-                g.state.analysis_namespace[var_name] = txtfile
+                state.analysis_namespace[var_name] = txtfile
                 logger.info(f"Loaded text file: {file_path} as {var_name}")
-                g.state.conversation_history.append({
+                state.conversation_history.append({
                     "role": "assistant",
                     "type": "text",
-                    "iteration": g.state.iteration_count,
+                    "iteration": state.iteration_count,
                     "content": f"Text file loaded as string: \n{txtfile} \n\nAdded as variable {var_name}."
                 })
                 
@@ -254,10 +274,10 @@ def process_uploaded_files(file_info):
             data_inventory += f"- {var_name}: {description}\n"
             
         # Add this inventory to the conversation history
-        g.state.conversation_history.append({
+        state.conversation_history.append({
             "role": "assistant",
             "type": "text",
-            "iteration": g.state.iteration_count,
+            "iteration": state.iteration_count,
             "content": data_inventory
         })
         
@@ -266,244 +286,609 @@ def process_uploaded_files(file_info):
 
 @app.route('/get_analysis', methods=['GET'])
 def get_analysis():
-    """Get text from LLM based on conversation history"""
+    """Start getting text from LLM based on conversation history (see /llm_results)"""
     logger.info(f"Getting analysis with conversation history length: {len(g.state.conversation_history)}")
 
     response_type = request.args.get('response_type', 'text')
     text_input = request.args.get('text_input', '')
+    fanout = request.args.get('fanout', FANOUT_MODE)
+    if fanout and fanout not in FANOUT_MODES:
+        return jsonify({"status": "error", "message": f"Unknown fan-out mode: {fanout}"}), 400
+
+    speculation = take_speculation(g.state) if response_type == "code" and not text_input and not fanout else None
+    if speculation is not None:
+        job_id = llm_jobs.submit(g.state, "analysis", run_speculated_analysis, speculation)
+    else:
+        job_id = llm_jobs.submit(g.state, "analysis", run_analysis, response_type, text_input, fanout)
+    return jsonify({"status": "pending", "job_id": job_id}), 202
 
+def run_analysis(state, emit, response_type, text_input, fanout=None):
+    """LLM job of /get_analysis. Returns (response, status code)."""
+    model_name = state.model
     try:
-        model_name = g.state.model
-        client = get_client(model_name, g.state.api_key)
-        g.state.MODEL_NAME = set_model_name(model_name)
+        state.MODEL_NAME = set_model_name(model_name)
 
         if response_type == "code":
             # Log the user command in conversation history
             if text_input:
-                text = text_input
+                state.conversation_history.append({
+                    "role": "user", 
+                    "type": "text",
+                    "iteration": state.iteration_count,
+                    "content": text_input
+                })
             else:
-                text = "Analyse"
-            g.state.conversation_history.append({
-                "role": "user", 
-                "type": "text",
-                "iteration": g.state.iteration_count,
-                "content": text
-            })
+                state.conversation_history.append(analyse_entry(state))
         
         # Build prompt and call LLM
-        prompt = build_llm_prompt(g.state.conversation_history, g.state.MODEL_NAME, response_type=response_type)
-        llm_response = call_llm_and_parse(client, prompt, MODEL_NAME=g.state.MODEL_NAME, response_type=response_type)
-        llm_response = process_llm_response(llm_response, response_type)
+        llm_response, details = request_llm_response(state, response_type, emit, fanout)
 
         # Increment the iteration if code was generated.
         if response_type == "code":
-            g.state.iteration_count += 1
-        
-        if llm_response is None or len(llm_response) == 0:                  # try once again if LLM doesn't return anything
-            llm_response = call_llm_and_parse(client, prompt, MODEL_NAME=g.state.MODEL_NAME, response_type=response_type)
-            llm_response = process_llm_response(llm_response, response_type)
+            state.iteration_count += 1
         
         if llm_response and len(llm_response) > 0:
             logger.info(f"Successfully got analysis from {model_name}")
             if response_type == "text":
-                g.state.conversation_history.append({
+                state.conversation_history.append({
                     "role": "assistant", 
                     "type": "text",
-                    "iteration": g.state.iteration_count,
+                    "iteration": state.iteration_count,
                     "content": llm_response
                 })
-            return jsonify({
+                start_speculation(state)
+            return {
                 "status": "success",
                 "response": llm_response,
-                "conversation_length": len(g.state.conversation_history)
-            })
+                "conversation_length": len(state.conversation_history),
+                **details
+            }, 200
         else:
             logger.info(f"No response from {model_name}")
-            return jsonify({
+            return {
                 "status": "error",
                 "message": f"No response from {model_name}. Please try again."
-            })
+            }, 200
     
     except Exception as e:
         # Separately handle errors stemming from API providers.
         error_msg, err_code = API_error_handler(e, model_name)
-        return jsonify({
+        return {
             "status": "error",
             "message": error_msg
-        }), err_code
+        }, err_code
+
+def request_llm_response(state, response_type, emit, fanout=None):
+    """
+    Response of the session's model to the conversation so far or, with a
+    fan-out mode, of the first or preferred of several models (see fanout.py).
+    Exceptions of the session's model are raised if no model responded.
+
+    Returns:
+        tuple: (response, details) where details name the model that
+               responded and, in 'compare' mode, hold all models' responses
+    """
+    models = fanout_models(state) if fanout else [(state.model, state.api_key)]
+    calls = {model: model_call(state, model, api_key, response_type) for model, api_key in models}
+    if len(calls) == 1:
+        try:
+            return calls[state.model](emit), {}
+        except Exception as e:
+            fallback = fallback_model(state, e)
+            if fallback is None:
+                raise
+            logger.warning(f"{state.model} is unavailable ({e}), falling back to {fallback[0]}")
+            metrics.increment(f'llm.fallbacks.{fallback[0]}')
+            emit('status', {"status": "retrying"})
+            return model_call(state, *fallback, response_type)(emit), {"model": fallback[0]}
+
+    fan_out = FanOut(calls, emit, mode=fanout, primary=state.model)
+    results = fan_out.run()
+    if fan_out.winner is None:
+        errors = [error for model, (_, error) in sorted(results.items(), key=lambda item: item[0] != state.model)
+                  if error is not None]
+        if errors:
+            raise errors[0]
+        return None, {}
+
+    details = {"model": fan_out.winner}
+    if fanout == "compare":
+        details["responses"] = {
+            model: {"response": response} if response else {"error": str(error) if error else "No response"}
+            for model, (response, error) in results.items()
+        }
+    return results[fan_out.winner][0], details
+
+def model_call(state, model, api_key, response_type):
+    """Function of emit making the request for the conversation to a model (see generate_response)."""
+    client = get_client(model, api_key)
+    MODEL_NAME = set_model_name(model)
+    prompt = build_llm_prompt(state.conversation_history, MODEL_NAME, response_type=response_type,
+                              cache=state.prompt_cache)
+    limiter = rate_limiters.get(MODEL_PROVIDERS[model], api_key)
+    return lambda emit: generate_response(client, prompt, MODEL_NAME, response_type, emit,
+                                          limiter=limiter, session_id=state.session_id)
+
+def fallback_model(state, error):
+    """(model, API key) to use when the session's model failed with error, or None."""
+    if not (isinstance(error, CircuitOpenError) or is_transient(error)):
+        return None
+    for model in LLM_FALLBACK_MODELS:
+        api_key = get_api_key(model)
+        if model != state.model and model in MODEL_PROVIDERS and api_key:
+            return model, api_key
+    return None
+
+def fanout_models(state):
+    """(model, API key) of the session's model and the other fan-out models with a key."""
+    models = [(state.model, state.api_key)]
+    for model in FANOUT_MODELS:
+        api_key = get_api_key(model)
+        if model != state.model and model in MODEL_PROVIDERS and api_key:
+            models.append((model, api_key))
+    return models
+
+def generate_response(client, prompt, MODEL_NAME, response_type, emit, limiter=None, session_id=None):
+    """
+    Call the LLM with a prompt and post-process its response, streaming tokens
+    through emit. Transient errors and empty responses are retried (see
+    resilient_call); the client is told to start over each time. With a
+    RateLimiter, each request waits for its turn in the provider's limits
+    and the client is told the estimated wait.
+    """
+    def wait_for_rate_limit():
+        if limiter is not None:
+            limiter.acquire(session_id, prompt.tokens + estimate_text_tokens(SYSTEM_PROMPT),
+                            on_wait=lambda wait: emit('status', {"status": "queued", "wait": round(wait, 1)}))
+
+    def attempt(on_text):
+        llm_response = call_llm_and_parse(client, prompt, MODEL_NAME=MODEL_NAME, response_type=response_type,
+                                          on_text=on_text, on_request=wait_for_rate_limit)
+        llm_response = process_llm_response(llm_response, response_type)
+        if llm_response is None or len(llm_response) == 0:
+            raise EmptyResponseError(f"No response from {MODEL_NAME}")
+        return llm_response
 
-@app.route('/execute_code', methods=['POST'])
-def execute_code():
-    """Execute Python code in a separate process and capture outputs/figures"""
-    
-    code = request.json.get('code', '')
-    execution_id = request.json.get('execution_id')
-    
-    if not execution_id:
-        execution_id = str(time.time())  # Generate an ID if not provided
-    
-    logger.info(f"Starting code execution with ID: {execution_id}")
-    
-    # Initialize result storage
-    g.state.execution_results[execution_id] = {
-        'status': 'running',
-        'output': '',
-        'figures': [],
-        'error': False,
-        'complete': False
-    }
+    try:
+        return resilient_call(provider_of_model(MODEL_NAME), attempt,
+                              on_text=lambda text: emit('token', {"text": text}),
+                              on_retry=lambda attempt, delay, e: emit('status', {"status": "retrying"}))
+    except EmptyResponseError:
+        return None
+
+###############################################################################
+# Speculative code generation (see speculation.py)
+###############################################################################
+def start_speculation(state):
+    """After a text analysis, start generating the code for a plain "Analyse" if enabled."""
+    if not SPECULATIVE_CODE:
+        return
+    discard_speculation(state)
+    key = speculation_key(state)
+    state.speculation = Speculation(key, llm_jobs.submit(state, "speculative_code", run_speculative_code, key))
+    metrics.increment('speculation.started')
+
+def discard_speculation(state):
+    if state.speculation is not None:
+        state.speculation = None
+        metrics.increment('speculation.misses')
+
+def take_speculation(state):
+    """The session's speculation, if it still matches the session. Any other one is discarded."""
+    speculation, state.speculation = state.speculation, None
+    if speculation is None:
+        return None
+    if speculation.key != speculation_key(state):
+        metrics.increment('speculation.misses')
+        logger.info("Discarding speculative code, the conversation changed")
+        return None
+    metrics.increment('speculation.hits')
+    return speculation
+
+def run_speculative_code(state, emit, key):
+    """
+    LLM job generating code for a plain "Analyse" without changing the
+    session. Returns (response, status code).
+    """
+    client = get_client(state.model, state.api_key)
+    MODEL_NAME = set_model_name(state.model)
+    history = HistorySnapshot(state.conversation_history, analyse_entry(state))
+    prompt = build_llm_prompt(history, MODEL_NAME, response_type="code", cache=state.prompt_cache.copy())
+    llm_response = generate_response(client, prompt, MODEL_NAME, "code", emit,
+                                     limiter=rate_limiters.get(MODEL_PROVIDERS[state.model], state.api_key),
+                                     session_id=state.session_id)
+    if not llm_response:
+        return {"status": "error", "message": "Empty speculative response"}, 200
+    return {"status": "success", "response": llm_response}, 200
+
+def run_speculated_analysis(state, emit, speculation):
+    """
+    LLM job of /get_analysis for code requested ahead of time: waits for the
+    speculative job (relaying its tokens) and commits its response to the
+    session, as run_analysis would have. If that job failed, the request is
+    made again.
+    """
+    stream = llm_jobs.find(state.session_id, speculation.job_id)
+    index, result = 0, None
+    while stream is not None:
+        events, closed = stream.wait(index, KEEPALIVE_INTERVAL)
+        for event, data in events:
+            index += 1
+            if event == 'token' or (event == 'status' and data.get("status") == "retrying"):
+                emit(event, data)
+            elif event == 'done':
+                result = data
+        if closed:
+            break
+
+    if result is None or result["payload"].get("status") != "success":
+        metrics.increment('speculation.failed')
+        logger.info("Speculative code request failed, requesting the code again")
+        return run_analysis(state, emit, "code", "")
+
+    logger.info("Using speculative code response")
+    state.MODEL_NAME = set_model_name(state.model)
+    state.conversation_history.append(analyse_entry(state))
+    state.iteration_count += 1
+    return {
+        "status": "success",
+        "response": result["payload"]["response"],
+        "conversation_length": len(state.conversation_history)
+    }, 200
+
+@app.route('/llm_results/<job_id>', methods=['GET'])
+def get_llm_results(job_id):
+    """
+    Get the response of an LLM request started by /get_analysis or /send_feedback.
+    With ?wait=<seconds> the request is held open until the response arrives
+    (long polling), for at most that long.
+    """
+    wait = min(request.args.get('wait', 0, type=float), MAX_LONG_POLL_WAIT)
+    result = llm_jobs.result(g.state.session_id, job_id, wait)
+    if result is None:
+        return jsonify({
+            "status": "not_found",
+            "message": "No LLM request found for this job ID"
+        }), 404
 
-    user_state = g.state
-    
-    # Create a pipe for communication
-    parent_conn, child_conn = multiprocessing.Pipe()
-    
-    # Create and start the process
-    process = multiprocessing.Process(
-        target=run_code_in_process,
-        args=(code, g.state.analysis_namespace, child_conn)
-    )
-    
-    # Store the process and connection for potential cancellation
-    user_state.active_executions[execution_id] = {
-        'process': process,
-        'connection': parent_conn,
-        'start_time': time.time()
-    }
+    payload, code = result
+    return jsonify(payload), code
+
+@app.route('/llm_stream/<job_id>', methods=['GET'])
+def stream_llm_results(job_id):
+    """
+    Stream the response of an LLM request as server-sent events: 'token' events
+    with text as it arrives, then a 'done' event with the final response.
+    """
+    stream = llm_jobs.find(g.state.session_id, job_id)
+    if stream is None:
+        return jsonify({
+            "status": "not_found",
+            "message": "No LLM request found for this job ID"
+        }), 404
 
-    g.state.conversation_history.append({
-        "role": "assistant",
-        "type": "code",
-        "iteration": user_state.iteration_count,
-        "content": code
+    start = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    return Response(stream_with_context(stream.iter_sse(start)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def add_figure_result(state, figure, figure_id):
+    """
+    Store a figure rendered by the kernel (see render_figure), add it to the
+    conversation history and return its result entry.
+    """
+    media_type = IMAGE_MEDIA_TYPES.get(figure["format"], f"image/{figure['format']}")
+    url = figure_url(store_figure(figure["data"], media_type))
+
+    title = figure["title"] or f"Figure {figure_id+1}"
+    logger.info(f"Generated figure: {title} ({len(figure['data'])} bytes {figure['format']}, "
+                f"rendered in {figure['render_seconds']:.3f}s)")
+    metrics.observe('figures.render_seconds', figure["render_seconds"])
+    metrics.observe('figures.bytes', len(figure["data"]))
+
+    state.conversation_history.append({
+        "role": "figure",
+        "type": "figure",
+        "iteration": state.iteration_count,
+        "content": {
+            "type": "image_url",
+            "image_url": {
+                "url": url,
+            },
+        }
     })
-    
-    # Start the process
-    process.start()
-    
-    # Set up a background thread to handle long-running code execution
-    def process_execution_results(state, execution_id, parent_conn):
-        with app.app_context():
-            try:
-                # Wait for results with a timeout
-                if parent_conn.poll(600.0):  # 600 second timeout
-                    output_text, figures, _, had_error, new_namespace = parent_conn.recv()
-
-                    logger.info(f"Received execution results for {execution_id}")
-
-                    # Update analysis namespace
-                    state.analysis_namespace.update(dill.loads(new_namespace))
-
-                    logger.info(f"Updated analysis namespace with new variables from execution {execution_id}")
-                    
-                    # Check if execution was terminated
-                    if output_text == "TERMINATED":
-                        logger.info(f"Execution {execution_id} was terminated")
-                        state.execution_results[execution_id]['status'] = 'cancelled'
-                        state.execution_results[execution_id]['output'] = "Execution was cancelled by user."
-                        state.execution_results[execution_id]['complete'] = True
-                        return
-                    
-                    # Process figures if any
-                    figure_data = []
-                    for i, fig in enumerate(figures or []):
-                        img_str = fig_to_base64(fig)
-                        figure_data.append({
-                            "id": i,
-                            "data": img_str
-                        })
-                        
-                        # Add figure to conversation history
-                        title = fig._suptitle.get_text() if hasattr(fig, '_suptitle') and fig._suptitle else f"Figure {i+1}"
-                        logger.info(f"Generated figure: {title}")
-                        
-                        state.conversation_history.append({
-                            "role": "figure",
-                            "type": "figure",
-                            "iteration": state.iteration_count,
-                            "content": {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{img_str}",
-                                },
-                            }
-                        })
-                    
-                    logger.info(f"processed figures for execution {execution_id}")
-                    
-                    # Store the results for retrieval
-                    state.execution_results[execution_id]['status'] = 'completed'
-                    state.execution_results[execution_id]['output'] = output_text
-                    state.execution_results[execution_id]['figures'] = figure_data
-                    state.execution_results[execution_id]['error'] = had_error
-                    state.execution_results[execution_id]['complete'] = True
-
-                    logger.info(f"stored execution results for {execution_id}")
-                    
-                    # Add output to conversation history if it exists
-                    if had_error:
-                        logger.warning(f"Execution {execution_id} resulted in error")
-                        state.conversation_history.append({
-                            "role": "assistant",
-                            "type": "output",
-                            "iteration": state.iteration_count,
-                            "content": "Error while running code:\n" + output_text
-                        })
-                    elif output_text.strip():
-                        state.conversation_history.append({
-                            "role": "assistant",
-                            "type": "output",
-                            "iteration": state.iteration_count,
-                            "content": "Code Output:\n" + output_text
-                        })
-
-                    logger.info(f"Execution {execution_id} completed successfully")
-                    
-                else:
-                    # Timeout occurred
-                    logger.warning(f"Execution {execution_id} timed out")
-                    output_text = "Execution timed out after 5 minutes. Consider optimizing your code or using smaller datasets."
-                    
-                    state.execution_results[execution_id]['status'] = 'timeout'
-                    state.execution_results[execution_id]['output'] = output_text
-                    state.execution_results[execution_id]['error'] = True
-                    state.execution_results[execution_id]['complete'] = True
-                    
+    return {"id": figure_id, "url": url}
+
+def execution_key(state, execution_id):
+    return f"execution:{state.session_id}:{execution_id}"
+
+def update_execution_result(state, execution_id, **fields):
+    """Update the stored result of an execution (shared with other workers if configured)."""
+    result = state.execution_results.setdefault(execution_id, {})
+    result.update(fields)
+    if state_backend.shared:
+        state_backend.set(execution_key(state, execution_id), dict(result), ttl=EXECUTION_RESULT_TTL)
+
+def lookup_execution_result(state, execution_id):
+    """Result of an execution, which may be run by the worker owning the session."""
+    result = state.execution_results.get(execution_id)
+    if result is None and state_backend.shared:
+        result = state_backend.get(execution_key(state, execution_id))
+    return result
+
+def lookup_execution_stream(state, execution_id):
+    """Live event stream of an execution, which may be run by the worker owning the session."""
+    stream = state.execution_streams.get(execution_id)
+    if stream is None and state_backend.shared and lookup_execution_result(state, execution_id) is not None:
+        stream = RemoteEventStream(state_backend, f"events:{execution_key(state, execution_id)}")
+    return stream
+
+def finish_execution_stream(state, execution_id):
+    """Send the final result to live stream clients and close the stream."""
+    stream = state.execution_streams.get(execution_id)
+    if stream is None or stream.closed:
+        return
+    result = state.execution_results.get(execution_id, {})
+    stream.publish('done', {
+        "status": result.get('status'),
+        "output": result.get('output', ''),
+        "figures": result.get('figures', []),
+        "error": result.get('error', False),
+        "complete": True
+    })
+    stream.close()
+
+def process_execution_results(state, execution_id, code, kernel, admitted):
+    """Background job running a code execution in the session's kernel"""
+    admitted.wait()
+    stream = state.execution_streams[execution_id]
+    figure_data = []
+
+    # Forward output and figures to live stream clients while the code runs
+    def on_stream(kind, payload):
+        if kind == "output":
+            stream.publish('output', {"text": payload})
+        elif kind == "figure":
+            figure = add_figure_result(state, payload, len(figure_data))
+            figure_data.append(figure)
+            stream.publish('figure', figure)
+
+    with app.app_context():
+        try:
+            if state.execution_results[execution_id]['status'] == 'cancelled':
+                return
+            update_execution_result(state, execution_id, status='running')
+            stream.publish('status', {"status": 'running'})
+            if execution_id in state.active_executions:
+                state.active_executions[execution_id]['start_time'] = time.time()
+
+            # Run the code in the session's kernel, with a 600 second timeout
+            result = kernel.execute(code, state.analysis_namespace, execution_id, timeout=600.0,
+                                    on_stream=on_stream)
+
+            if result['status'] != 'timeout':
+                output_text = result['output']
+                figures = result['figures']
+                had_error = result['error']
+
+                logger.info(f"Received execution results for {execution_id}")
+                
+                # Check if execution was cancelled
+                if result['status'] == 'cancelled':
+                    logger.info(f"Execution {execution_id} was cancelled")
+                    update_execution_result(state, execution_id, status='cancelled',
+                                            output="Execution was cancelled by user.", complete=True)
+                    return
+
+                # Process remaining figures (those shown while running are already in figure_data)
+                for fig in figures or []:
+                    figure_data.append(add_figure_result(state, fig, len(figure_data)))
+                
+                logger.info(f"processed figures for execution {execution_id}")
+                
+                # Store the results for retrieval
+                update_execution_result(state, execution_id, status=result['status'], output=output_text,
+                                        figures=figure_data, error=had_error, complete=True)
+
+                logger.info(f"stored execution results for {execution_id}")
+                
+                # Add output to conversation history if it exists
+                if had_error:
+                    logger.warning(f"Execution {execution_id} resulted in error")
                     state.conversation_history.append({
                         "role": "assistant",
                         "type": "output",
                         "iteration": state.iteration_count,
-                        "content": "Execution timed out:\n" + output_text
+                        "content": "Error while running code:\n" + output_text
                     })
-            except Exception as e:
-                logger.error(f"Error processing execution results: {str(e)}")
-                output_text = f"Error during execution: {str(e)}"
+                elif output_text.strip():
+                    state.conversation_history.append({
+                        "role": "assistant",
+                        "type": "output",
+                        "iteration": state.iteration_count,
+                        "content": "Code Output:\n" + output_text
+                    })
+
+                logger.info(f"Execution {execution_id} completed successfully")
                 
-                state.execution_results[execution_id]['status'] = 'error'
-                state.execution_results[execution_id]['output'] = output_text
-                state.execution_results[execution_id]['error'] = True
-                state.execution_results[execution_id]['complete'] = True
+            else:
+                # Timeout occurred
+                logger.warning(f"Execution {execution_id} timed out")
+                output_text = "Execution timed out after 5 minutes. Consider optimizing your code or using smaller datasets."
+                
+                update_execution_result(state, execution_id, status='timeout', output=output_text,
+                                        error=True, complete=True)
                 
                 state.conversation_history.append({
                     "role": "assistant",
                     "type": "output",
                     "iteration": state.iteration_count,
-                    "content": f"Execution error:\n{output_text}"
+                    "content": "Execution timed out:\n" + output_text
                 })
-            finally:
-                # Clean up the process
-                if execution_id in state.active_executions:
-                    if state.active_executions[execution_id]['process'].is_alive():
-                        state.active_executions[execution_id]['process'].terminate()
-                    del state.active_executions[execution_id]
-    
-    # Start background thread for monitoring
-    thread = threading.Thread(target=process_execution_results, 
-                              args=(user_state, execution_id, parent_conn))
-    thread.daemon = True
-    thread.start()
-    
-    # Return immediately with a status that execution has started
+        except Exception as e:
+            logger.error(f"Error processing execution results: {str(e)}")
+            output_text = f"Error during execution: {str(e)}"
+            
+            update_execution_result(state, execution_id, status='error', output=output_text,
+                                    error=True, complete=True)
+            
+            state.conversation_history.append({
+                "role": "assistant",
+                "type": "output",
+                "iteration": state.iteration_count,
+                "content": f"Execution error:\n{output_text}"
+            })
+        finally:
+            # Clean up the execution entry (the kernel itself stays alive)
+            state.active_executions.pop(execution_id, None)
+            finish_execution_stream(state, execution_id)
+
+def start_execution(state, execution_id, code):
+    """
+    Queue code for execution in the session's kernel. Must run in the worker
+    owning the session.
+
+    Raises:
+        QueueFullError: if the execution queue is full
+    """
+    kernel = get_kernel(state)
+
+    # Hand the execution to the global scheduler, which runs it once a slot is
+    # free (but not before it is admitted below)
+    admitted = threading.Event()
+    try:
+        execution_scheduler.submit(state.session_id, execution_id,
+                                   lambda: process_execution_results(state, execution_id, code, kernel, admitted))
+    except QueueFullError:
+        logger.warning(f"Execution queue full - rejecting execution {execution_id}")
+        raise
+
+    # Initialize result storage only once the execution is accepted, so that
+    # rejected executions leave nothing behind in the shared backend
+    update_execution_result(state, execution_id, status='queued', output='', figures=[],
+                            error=False, complete=False)
+    stream = EventStream(state_backend, f"events:{execution_key(state, execution_id)}")
+    state.execution_streams[execution_id] = stream
+    stream.publish('status', {"status": 'queued'})
+
+    # Store the kernel for potential cancellation
+    state.active_executions[execution_id] = {
+        'kernel': kernel,
+        'start_time': time.time()
+    }
+
+    state.conversation_history.append({
+        "role": "assistant",
+        "type": "code",
+        "iteration": state.iteration_count,
+        "content": code
+    })
+    admitted.set()
+
+def cancel_execution(state, execution_id):
+    """Cancel a queued or running execution. Returns False if there is no such execution."""
+    if execution_id not in state.active_executions:
+        return False
+
+    # Get the kernel running this execution
+    execution = state.active_executions[execution_id]
+    kernel = execution['kernel']
+    
+    # Update execution result status
+    if execution_id in state.execution_results:
+        update_execution_result(state, execution_id, status='cancelled',
+                                output="Execution was cancelled by user.", complete=True)
+    
+    # Drop it from the queue, or interrupt the running cell (the kernel is
+    # restarted if it does not respond)
+    if execution_scheduler.cancel(execution_id):
+        finish_execution_stream(state, execution_id)
+    else:
+        kernel.interrupt(grace=2.0)
+    
+    # Add to conversation history
+    state.conversation_history.append({
+        "role": "assistant",
+        "type": "output",
+        "iteration": state.iteration_count,
+        "content": "Code execution was cancelled by user."
+    })
+    
+    # Clean up
+    state.active_executions.pop(execution_id, None)
+    return True
+
+###############################################################################
+# Commands forwarded by other workers to the worker owning a session
+###############################################################################
+def handle_execute_command(session_id, execution_id, code):
+    """Start a forwarded execution. Returns whether it was accepted, for the forwarding worker."""
+    state = user_states.get(session_id)
+    try:
+        start_execution(state, execution_id, code)
+    except QueueFullError as e:
+        # In case the forwarding worker stopped waiting for the reply
+        update_execution_result(state, execution_id, status='error', output=str(e), figures=[],
+                                error=True, complete=True)
+        return {"accepted": False, "message": str(e), "retry_after": e.retry_after}
+    return {"accepted": True}
+
+def handle_stop_command(session_id, execution_id):
+    cancel_execution(user_states.get(session_id), execution_id)
+
+def handle_upload_command(session_id, file_info):
+    process_uploaded_files(file_info, user_states.get(session_id))
+
+def handle_release_command(session_id):
+    """Another worker has taken over the session: drop its namespace and kernel here."""
+    state = user_states.find(session_id)
+    if state is not None:
+        shutdown_kernel(state)
+        release_shared_values(list(state.analysis_namespace.values()), {})
+        state.analysis_namespace = {}
+
+ownership.register("execute", handle_execute_command)
+ownership.register("stop", handle_stop_command)
+ownership.register("upload", handle_upload_command)
+ownership.register("release", handle_release_command)
+
+def execution_queue_full(message, retry_after):
+    """429 response for an execution rejected because the queue is full."""
+    response = jsonify({"status": "error", "message": message, "retry_after": retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+@app.route('/execute_code', methods=['POST'])
+def execute_code():
+    """Execute Python code in a separate process and capture outputs/figures"""
+    
+    code = request.json.get('code', '')
+    execution_id = request.json.get('execution_id')
+    
+    if not execution_id:
+        execution_id = str(time.time())  # Generate an ID if not provided
+    
+    logger.info(f"Starting code execution with ID: {execution_id}")
+
+    # The namespace lives in the worker owning the session; let it run the code
+    owner = ownership.claim(g.state.session_id)
+    if owner != ownership.worker_id:
+        logger.info(f"Forwarding execution {execution_id} to worker {owner}")
+        state_backend.set(execution_key(g.state, execution_id), {
+            'status': 'queued', 'output': '', 'figures': [], 'error': False, 'complete': False
+        }, ttl=EXECUTION_RESULT_TTL)
+        # Without a timely reply the execution stays queued, and a rejection shows up as its result
+        reply = ownership.request(owner, "execute", g.state.session_id, execution_id, code)
+        if reply is not None and not reply["accepted"]:
+            state_backend.delete(execution_key(g.state, execution_id))
+            return execution_queue_full(reply["message"], reply["retry_after"])
+    else:
+        try:
+            start_execution(g.state, execution_id, code)
+        except QueueFullError as e:
+            return execution_queue_full(str(e), e.retry_after)
+    
+    # Return immediately with a status that execution has been accepted
     return jsonify({
         "status": "executing",
         "message": "Code execution started",
@@ -512,27 +897,32 @@ def execute_code():
 
 @app.route('/execution_results/<execution_id>', methods=['GET'])
 def get_execution_results(execution_id):
-    """Get the results of a code execution"""
+    """
+    Get the results of a code execution. With ?wait=<seconds> the request is held
+    open until the execution completes (long polling), for at most that long.
+    """
     
-    if execution_id not in g.state.execution_results:
+    wait = min(request.args.get('wait', 0, type=float), MAX_LONG_POLL_WAIT)
+    stream = lookup_execution_stream(g.state, execution_id)
+    if wait > 0 and stream is not None:
+        stream.wait_closed(wait)
+
+    result = lookup_execution_result(g.state, execution_id)
+    if result is None:
         return jsonify({
             "status": "not_found",
             "message": "No results found for this execution ID"
         }), 404
     
-    result = g.state.execution_results[execution_id]
-    
     # If execution is complete, we can clean up the results data after sending
     if result['complete'] and result['status'] != 'running':
-        # Clone the result for response
-        response_data = dict(result)
-        
         # Clean up old results periodically (keep the last few)
         all_executions = list(g.state.execution_results.keys())
         if len(all_executions) > 10:  # Keep only last 10 results
             oldest = all_executions[0]
             if oldest != execution_id:  # Don't delete what we're returning
                 del g.state.execution_results[oldest]
+                g.state.execution_streams.pop(oldest, None)
         
         return jsonify({
             "status": result['status'],
@@ -542,16 +932,68 @@ def get_execution_results(execution_id):
             "complete": True
         })
     
+    if result['status'] == 'queued':
+        return jsonify({
+            "status": 'queued',
+            "position": execution_scheduler.position(execution_id),
+            "complete": False
+        })
+
     return jsonify({
         "status": result['status'],
         "complete": result['complete']
     })
 
+@app.route('/execution_stream/<execution_id>', methods=['GET'])
+def stream_execution(execution_id):
+    """Stream output and figures of a code execution as server-sent events"""
+
+    stream = lookup_execution_stream(g.state, execution_id)
+    if stream is None:
+        return jsonify({
+            "status": "not_found",
+            "message": "No stream found for this execution ID"
+        }), 404
+
+    start = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    return Response(stream_with_context(stream.iter_sse(start)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/figures/<figure_hash>', methods=['GET'])
+def get_figure(figure_hash):
+    """Serve a stored figure. Figures never change, so clients may cache them forever."""
+
+    figure = find_figure(figure_hash)
+    if figure is None:
+        return jsonify({
+            "status": "not_found",
+            "message": "No such figure"
+        }), 404
+
+    path, media_type = figure
+    response = send_file(os.path.abspath(path), mimetype=media_type, etag=figure_hash,
+                         conditional=True, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @app.route('/stop_execution', methods=['POST'])
 def stop_execution():
     """Stop a running code execution"""
     
     execution_id = request.json.get('execution_id')
+
+    # Executions run in the worker owning the session
+    owner = ownership.owner(g.state.session_id)
+    if execution_id and owner not in (None, ownership.worker_id):
+        result = lookup_execution_result(g.state, execution_id)
+        if result is not None and not result['complete']:
+            logger.info(f"Forwarding stop of execution {execution_id} to worker {owner}")
+            ownership.send(owner, "stop", g.state.session_id, execution_id)
+            return jsonify({
+                "status": "cancelled",
+                "message": "Execution cancelled successfully"
+            })
     
     if not execution_id or execution_id not in g.state.active_executions:
         logger.warning(f"Attempt to stop non-existent execution: {execution_id}")
@@ -563,36 +1005,7 @@ def stop_execution():
     logger.info(f"Stopping execution: {execution_id}")
     
     try:
-        # Get the process
-        execution = g.state.active_executions[execution_id]
-        process = execution['process']
-        
-        # Update execution result status
-        if execution_id in g.state.execution_results:
-            g.state.execution_results[execution_id]['status'] = 'cancelled'
-            g.state.execution_results[execution_id]['output'] = "Execution was cancelled by user."
-            g.state.execution_results[execution_id]['complete'] = True
-        
-        # Terminate the process if it's still running
-        if process.is_alive():
-            process.terminate()
-            process.join(timeout=2.0)
-            
-            # If it didn't terminate, try to kill it
-            if process.is_alive():
-                logger.warning(f"Process {execution_id} did not terminate gracefully, forcing kill")
-                os.kill(process.pid, signal.SIGKILL)
-        
-        # Add to conversation history
-        g.state.conversation_history.append({
-            "role": "assistant",
-            "type": "output",
-            "iteration": g.state.iteration_count,
-            "content": "Code execution was cancelled by user."
-        })
-        
-        # Clean up
-        del g.state.active_executions[execution_id]
+        cancel_execution(g.state, execution_id)
         
         return jsonify({
             "status": "cancelled",
@@ -606,6 +1019,51 @@ def stop_execution():
             "message": f"Error stopping execution: {str(e)}"
         }), 500
 
+def format_history_entry(entry):
+    """Format a conversation history entry for the frontend."""
+    role = entry.get("role", "")
+    content = entry.get("content", "")
+    type = entry.get("type", "text")
+
+    if role == "figure":
+        # Handle figure entries differently
+        if isinstance(content, dict) and "image_url" in content:
+            pass
+        else:
+            logger.warning(f"Unexpected content structure: {content}")
+            
+        image_url = content.get("image_url", {}).get("url", "")
+        return {
+            "role": "figure",
+            "type": "figure",
+            "iteration": entry.get("iteration", 0),
+            "content": image_url
+        }
+    elif type == "code":
+        return {
+            "role": role,
+            "type": entry.get("type", "code"),
+            "iteration": entry.get("iteration", 0),
+            "content": content
+        }
+    elif type == "output":
+        if content.startswith("Code Output:"):
+            content = content.replace("\n", "<br>")
+        return {
+            "role": role,
+            "type": entry.get("type", "output"),
+            "iteration": entry.get("iteration", 0),
+            "content": content
+        }
+    else:
+        # Handle text entries as before
+        return {
+            "role": role,
+            "type": entry.get("type", "text"),
+            "iteration": entry.get("iteration", 0),
+            "content": content.replace("\n", "<br>") if isinstance(content, str) else content
+        }
+
 @app.route('/debug/history', methods=['GET'])
 def debug_history():
     """Debug endpoint to get the full conversation history"""
@@ -613,62 +1071,51 @@ def debug_history():
     logger.debug(f"Debug History Endpoint - History length: {len(g.state.conversation_history)}")
     
     # Format conversation history for JSON response
-    formatted_history = []
-    for entry in g.state.conversation_history:
-        role = entry.get("role", "")
-        content = entry.get("content", "")
-        type = entry.get("type", "text")
-
-        if role == "figure":
-            # Handle figure entries differently
-            if isinstance(content, dict) and "image_url" in content:
-                pass
-            else:
-                logger.warning(f"Unexpected content structure: {content}")
-                
-            image_url = content.get("image_url", {}).get("url", "")
-            formatted_history.append({
-                "role": "figure",
-                "type": "figure",
-                "iteration": entry.get("iteration", 0),
-                "content": image_url
-            })
-        elif type == "code":
-            formatted_history.append({
-                "role": role,
-                "type": entry.get("type", "code"),
-                "iteration": entry.get("iteration", 0),
-                "content": content
-            })
-        elif type == "output":
-            if content.startswith("Code Output:"):
-                content = content.replace("\n", "<br>")
-            formatted_history.append({
-                "role": role,
-                "type": entry.get("type", "output"),
-                "iteration": entry.get("iteration", 0),
-                "content": content
-            })
-        else:
-            # Handle text entries as before
-            formatted_history.append({
-                "role": role,
-                "type": entry.get("type", "text"),
-                "iteration": entry.get("iteration", 0),
-                "content": content.replace("\n", "<br>") if isinstance(content, str) else content
-            })
+    formatted_history = [format_history_entry(entry) for entry in g.state.conversation_history]
     
     return jsonify({
         "history_length": len(g.state.conversation_history),
         "history": formatted_history
     })
 
+@app.route('/history', methods=['GET'])
+def get_history():
+    """
+    Get the conversation history entries added after ?cursor=<cursor>.
+
+    Responds with 304 if nothing changed since the cursor (also given as
+    If-None-Match). If the cursor is missing or outdated, the whole history is
+    returned with reset set to true.
+    """
+    history = g.state.conversation_history
+    cursor = request.args.get('cursor') or request.headers.get('If-None-Match', '').strip('"')
+
+    current = history.cursor
+    if cursor == current:
+        response = Response(status=304)
+        response.headers['ETag'] = f'"{current}"'
+        return response
+
+    entries, reset = history.entries_since(cursor)
+    response = jsonify({
+        "cursor": current,
+        "reset": reset,
+        "history_length": len(history),
+        "entries": [format_history_entry(entry) for entry in entries]
+    })
+    response.headers['ETag'] = f'"{current}"'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/send_feedback', methods=['POST'])
 def send_feedback():
     """Send user feedback and get next analysis"""
 
     feedback = request.json.get('feedback', '')
     files_data = request.json.get('files', [])
+    fanout = request.json.get('fanout', FANOUT_MODE)
+    if fanout and fanout not in FANOUT_MODES:
+        return jsonify({"status": "error", "message": f"Unknown fan-out mode: {fanout}"}), 400
     iter = g.state.iteration_count
     
     logger.info(f"Feedback route - Current history length: {len(g.state.conversation_history)}")
@@ -683,43 +1130,50 @@ def send_feedback():
     
     if files_data:
         file_info = process_fdbk_files(files_data)
-        process_uploaded_files(file_info)
+        # The variables belong in the namespace held by the worker owning the session
+        owner = ownership.claim(g.state.session_id)
+        if owner != ownership.worker_id:
+            ownership.send(owner, "upload", g.state.session_id, file_info)
+        else:
+            process_uploaded_files(file_info)
     
     logger.debug(f"Feedback route - Updated history length: {len(g.state.conversation_history)}")
     
-    # Now automatically get the next analysis
+    # Now automatically get the next analysis (see /llm_results)
+    job_id = llm_jobs.submit(g.state, "feedback", run_feedback, iter, fanout)
+    return jsonify({"status": "pending", "job_id": job_id}), 202
+
+def run_feedback(state, emit, iter, fanout=None):
+    """LLM job of /send_feedback. Returns (response, status code)."""
     try:
-        model_name = g.state.model
-        client = get_client(model_name, g.state.api_key)
-        g.state.MODEL_NAME = set_model_name(model_name)
-    
-        prompt = build_llm_prompt(g.state.conversation_history, g.state.MODEL_NAME, response_type="feedback")
-        llm_response = call_llm_and_parse(client, prompt, MODEL_NAME=g.state.MODEL_NAME, response_type="feedback")
-        llm_response = process_llm_response(llm_response, response_type="feedback")
+        state.MODEL_NAME = set_model_name(state.model)
+        llm_response, details = request_llm_response(state, "feedback", emit, fanout)
         
         logger.info("Successfully got next analysis after feedback")
 
-        g.state.conversation_history.append({
+        state.conversation_history.append({
             "role": "assistant",
             "type": "text",
             "iteration": iter,
             "content": llm_response
         })
+        start_speculation(state)
         
         # Return both the success status and the new analysis
-        return jsonify({
+        return {
             "status": "success", 
-            "history_length": len(g.state.conversation_history),
-            "response": llm_response
-        })
+            "history_length": len(state.conversation_history),
+            "response": llm_response,
+            **details
+        }, 200
     except Exception as e:
         logger.error(f"Error getting next analysis after feedback: {str(e)}")
         # If there's an error getting the next analysis, still return success for the feedback
-        return jsonify({
+        return {
             "status": "success", 
-            "history_length": len(g.state.conversation_history),
+            "history_length": len(state.conversation_history),
             "error": str(e)
-        })
+        }, 200
 
 @app.route('/api/switch_model', methods=['POST'])
 def switch_model():
@@ -736,6 +1190,41 @@ def switch_model():
         g.state.api_key = get_api_key(model)
         return jsonify({"status": "success", "message": f"Switched to model: {model}"}), 200
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics_route():
+    """Process-wide performance counters and timings"""
+    return jsonify({
+        "status": "success",
+        "kernel_pool": kernel_pool.stats(),
+        "scheduler": execution_scheduler.stats(),
+        "sessions": user_states.stats(),
+        "llm_jobs": llm_jobs.stats(),
+        "llm_clients": client_registry.stats(),
+        "llm_prompt_cache": {"hit_rate": metrics.ratio('llm.cached_input_tokens', 'llm.input_tokens')},
+        "speculation": speculation_stats(),
+        "fanout": {"mode": FANOUT_MODE, "models": FANOUT_MODELS},
+        "llm_circuits": circuit_stats(),
+        "rate_limits": rate_limiters.stats(),
+        "llm_cache": llm_cache.stats(),
+        **metrics.get_metrics()
+    })
+
+@app.route('/api/rate_limits', methods=['GET'])
+def get_rate_limits():
+    """Estimated seconds an LLM request would wait for the provider's rate limit, per model with an API key"""
+    waits = {}
+    for model in MODEL_PROVIDERS:
+        api_key = g.state.api_key if model == g.state.model else get_api_key(model)
+        if api_key:
+            limiter = rate_limiters.get(MODEL_PROVIDERS[model], api_key)
+            waits[model] = round(limiter.wait_estimate(), 1) if limiter is not None else 0.0
+    return jsonify({
+        "status": "success",
+        "model": g.state.model,
+        "wait_seconds": waits.get(g.state.model, 0.0),
+        "models": waits
+    })
+
 @app.route('/api/store_api_key', methods=['POST'])
 def store_api_key():
     data = request.json
@@ -839,14 +1328,15 @@ def save_analysis():
 
                 elif entry_type == 'figure':
                     img = content.get("image_url", {}).get("url", "")
-                    if isinstance(img, str) and img.startswith('data:image/png;base64,'):
+                    figure = load_figure(img)
+                    if figure is not None:
                         try:
-                            base64_data = img.split(',', 1)[1]
-                            image_data = base64.b64decode(base64_data)
+                            image_data, media_type = figure
+                            extension = figure_extension(media_type)
 
                             figure_counter[iteration] += 1 # Increment counter for this iteration
                             fig_num = figure_counter[iteration]
-                            filename = f"iteration_{iteration}_figure_{fig_num}.png"
+                            filename = f"iteration_{iteration}_figure_{fig_num}.{extension}"
                             figure_file_path = os.path.join(figures_dir, filename)
 
                             with open(figure_file_path, 'wb') as f_fig:
@@ -854,7 +1344,7 @@ def save_analysis():
                         except (IndexError, base64.binascii.Error, IOError) as img_err:
                             logger.warning(f"Could not process/save figure data for iteration {iteration}: {img_err}. Content: {img[:100]}...")
                     else:
-                        logger.warning(f"Skipping figure for iteration {iteration}: Image is not a valid base64 PNG data URI. Content: {str(img)[:100]}...")
+                        logger.warning(f"Skipping figure for iteration {iteration}: Image is neither a stored figure nor a base64 image data URI. Content: {str(img)[:100]}...")
 
 
         # --- 3. Save Metadata ---
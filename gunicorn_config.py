@@ -1,2 +1,23 @@
 bind = "0.0.0.0:5000"
-timeout = 120
\ No newline at end of file
+timeout = 120
+
+import os
+
+# Session state is kept in the worker process unless ALFRED_STATE_BACKEND names
+# a shared backend (sqlite:///path or redis://...), so more than one worker
+# requires one. Threads let long-lived responses (execution streams) be served
+# alongside other requests.
+workers = int(os.environ.get('ALFRED_WORKERS', 1))
+worker_class = "gthread"
+
+# Every open event stream (one per running LLM request or execution) and every
+# long poll (up to 25 s) holds a thread for as long as it is open, so a worker
+# serves at most this many of them at once, across all of its users; further
+# requests wait for a free thread. Idle threads cost little, so size this for
+# the expected number of open streams per worker (a few per active user).
+threads = int(os.environ.get('ALFRED_THREADS', 256))
+
+def post_worker_init(worker):
+    # Start pre-warming kernel workers before the first request arrives
+    from kernel import kernel_pool
+    kernel_pool.start()
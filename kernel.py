@@ -0,0 +1,660 @@
+import os
+import sys
+import io
+import time
+import signal
+import threading
+import multiprocessing
+import logging
+import importlib
+from collections import deque
+from namespace_sync import *
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# Kernels never have a display: make sure matplotlib (also when preloaded by the
+# forkserver) picks the Agg backend.
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+# Number of idle, pre-warmed kernel workers kept ready for new sessions.
+KERNEL_POOL_SIZE = int(os.environ.get('ALFRED_KERNEL_POOL_SIZE', 2))
+
+# Heavy modules imported by the forkserver (and thus already loaded in every
+# kernel). Modules that are not installed are skipped.
+KERNEL_PRELOAD = [name.strip() for name in os.environ.get(
+    'ALFRED_KERNEL_PRELOAD',
+    'numpy,pandas,matplotlib.pyplot,scipy.stats,seaborn,sklearn,statsmodels.api,'
+    'torch,umap,cv2,rastermap,one.api,brainbox.io.one,iblatlas.atlas'
+).split(',') if name.strip()]
+
+# Start method for kernel workers. forkserver forks every kernel from a clean
+# process that has the preload modules imported already.
+KERNEL_START_METHOD = os.environ.get(
+    'ALFRED_KERNEL_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+# Kernels that have not run any code for this long are shut down by the reaper.
+# Their picklable variables are still mirrored in the session namespace, so the
+# next execution simply starts a new kernel and re-seeds it.
+KERNEL_IDLE_TIMEOUT = float(os.environ.get('ALFRED_KERNEL_IDLE_TIMEOUT', 1800))
+KERNEL_REAP_INTERVAL = 60.0
+
+_kernels = set()
+_kernels_lock = threading.Lock()
+_reaper_thread = None
+
+
+# Figures are rendered in the kernel and only the encoded image crosses the pipe
+FIGURE_FORMAT = os.environ.get('ALFRED_FIGURE_FORMAT', 'png').lower()
+FIGURE_DPI = float(os.environ.get('ALFRED_FIGURE_DPI', 100))
+
+# Interval at which printed output is forwarded while a cell is running
+STREAM_FLUSH_INTERVAL = float(os.environ.get('ALFRED_STREAM_FLUSH_INTERVAL', 0.25))
+
+
+###############################################################################
+# Pipe to the web process, safe to use while a cell can be interrupted
+###############################################################################
+class KernelChannel:
+    """
+    Wraps the worker end of the pipe. Messages may be sent from the main thread
+    (figures, results) and from the output flusher thread, so sends are
+    serialised, and SIGINT is held back during a send so that an interrupt can
+    never leave a half-written message in the pipe.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        blocked = threading.current_thread() is threading.main_thread()
+        if blocked:
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+        try:
+            with self.lock:
+                self.conn.send(message)
+        finally:
+            if blocked:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGINT})
+
+    def recv(self):
+        return self.conn.recv()
+
+    def close(self):
+        self.conn.close()
+
+class StreamingOutput(io.TextIOBase):
+    """
+    stdout replacement that keeps the full output of a cell and forwards new
+    output to the web process every STREAM_FLUSH_INTERVAL seconds.
+    """
+    def __init__(self, emit):
+        self.emit = emit
+        self.parts = []
+        self.pending = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            self.parts.append(text)
+            self.pending.append(text)
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            text, self.pending = "".join(self.pending), []
+        if text:
+            self.emit("output", text)
+
+    def stop(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+
+    def getvalue(self):
+        with self.lock:
+            return "".join(self.parts)
+
+    def _flush_loop(self):
+        while not self.stopped.wait(STREAM_FLUSH_INTERVAL):
+            self.flush()
+
+###############################################################################
+# Render a figure to an encoded image
+###############################################################################
+def render_figure(fig, fmt=FIGURE_FORMAT, dpi=FIGURE_DPI):
+    """
+    Rasterize a matplotlib figure.
+
+    Returns:
+        dict: data (encoded image bytes), format, title, render_seconds
+    """
+    start_time = time.time()
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt, dpi=dpi)
+    title = fig._suptitle.get_text() if getattr(fig, '_suptitle', None) else None
+    return {
+        "data": buf.getvalue(),
+        "format": fmt,
+        "title": title,
+        "render_seconds": time.time() - start_time,
+    }
+
+###############################################################################
+# Execute a single code cell in the kernel namespace
+###############################################################################
+def run_cell(code, namespace, emit=None):
+    """
+    Run code in the given namespace, capturing stdout, figures and errors.
+
+    Args:
+        code (str): The code to execute
+        namespace (dict): Namespace the code is executed in (kept between cells)
+        emit (callable): emit(kind, payload) forwards output chunks and figures
+                         shown with plt.show() while the cell is still running
+
+    Returns:
+        tuple: (output_text, figures, error_flag, interrupted). figures are
+               rendered (see render_figure) and only contain those that were
+               not forwarded through emit already.
+    """
+    import matplotlib.pyplot as plt
+    emit = emit or (lambda kind, payload: None)
+
+    # Redirect stdout
+    old_stdout = sys.stdout
+    redirected_output = StreamingOutput(emit)
+    sys.stdout = redirected_output
+
+    # Send figures as soon as the code shows them
+    original_show = plt.show
+    shown_figures = 0
+
+    def show(*args, **kwargs):
+        nonlocal shown_figures
+        for i in plt.get_fignums():
+            fig = plt.figure(i)
+            emit("figure", render_figure(fig))
+            plt.close(fig)
+            shown_figures += 1
+
+    plt.show = show
+
+    # Close any existing figures
+    plt.close('all')
+
+    figures = []
+    error_flag = False
+    interrupted = False
+
+    try:
+        # Only allow interrupts while user code is running
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        exec(code, namespace)
+
+        # Collect figures
+        for i in plt.get_fignums():
+            fig = plt.figure(i)
+            figures.append(render_figure(fig))
+        plt.close('all')
+
+    except KeyboardInterrupt:
+        interrupted = True
+        error_flag = True
+        print("Execution was interrupted.")
+
+    except Exception as e:
+        error_flag = True
+        print(str(e))
+
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        plt.show = original_show
+
+        # Get the captured output
+        sys.stdout = old_stdout
+        redirected_output.stop()
+        output_text = redirected_output.getvalue()
+
+        # If no output was generated
+        if len(output_text) == 0 and len(figures) == 0 and shown_figures == 0:
+            output_text = "Please make sure your code prints something to stdout or generates some figures."
+
+    return output_text, figures, error_flag, interrupted
+
+###############################################################################
+# Main loop of the kernel worker process
+###############################################################################
+def kernel_main(conn, preload=(), segment_owner=None):
+    """
+    Long-lived worker that keeps the analysis namespace resident and runs code
+    cells received over the pipe until it is told to shut down.
+
+    The preload modules are imported before the worker reports ("ready",), so
+    that a kernel taken from the pool does not pay for them on its first cell.
+    Shared memory segments it creates belong to web worker segment_owner.
+
+    Messages received:
+        ("execute", execution_id, code, updates, deletions)
+        ("shutdown",)
+
+    Messages sent:
+        ("ready",)
+        ("stream", execution_id, "output" or "figure", payload)   (while a cell runs)
+        ("result", execution_id, output_text, figures, error_flag, interrupted, delta)
+
+    Only variables that were added, rebound or mutated by the cell are sent back
+    (see namespace_sync.py), together with the names of deleted variables.
+    """
+    # Interrupts are only honoured while a cell is running (see run_cell)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if segment_owner is not None:
+        set_segment_owner(segment_owner)
+    channel = KernelChannel(conn)
+    import_modules(preload)
+    channel.send(("ready",))
+
+    namespace = {}
+    snapshot = {}           # fingerprints of the namespace as last seen by the web process
+
+    while True:
+        try:
+            message = channel.recv()
+        except EOFError:
+            break
+
+        command = message[0]
+
+        if command == "execute":
+            _, execution_id, code, updates, deletions = message
+
+            # Bring in variables that were added on the web process side (e.g. uploads)
+            new_vars = apply_namespace_delta(namespace, updates)
+            for name in deletions:
+                namespace.pop(name, None)
+                snapshot.pop(name, None)
+            for name, value in new_vars.items():
+                snapshot[name] = (id(value), fingerprint_value(value)[0])
+
+            def emit(kind, payload):
+                channel.send(("stream", execution_id, kind, payload))
+
+            output_text, figures, error_flag, interrupted = run_cell(code, namespace, emit)
+
+            # Work out which variables the cell changed
+            new_snapshot, blobs = snapshot_namespace(namespace)
+            changed, deleted = diff_namespace(snapshot, new_snapshot)
+            delta = pack_namespace_delta(namespace, changed, deleted, blobs)
+            for name, value in adopt_shared_values(namespace, delta).items():
+                new_snapshot[name] = (id(value), fingerprint_value(value)[0])
+            snapshot = new_snapshot
+
+            channel.send(("result", execution_id, output_text, figures, error_flag, interrupted, delta))
+
+        elif command == "shutdown":
+            break
+
+    channel.close()
+
+def import_modules(names):
+    """Import modules by name, skipping those that are not installed."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.debug(f"Could not preload {name}: {e}")
+
+###############################################################################
+# Pool of pre-warmed kernel workers
+###############################################################################
+class KernelPool:
+    """
+    Keeps a few idle kernel workers with the heavy scientific modules already
+    imported. A session that needs a kernel takes one from the pool (a hit) or
+    starts one cold if the pool is empty (a miss). The pool is refilled by a
+    background thread.
+    """
+    def __init__(self, size=KERNEL_POOL_SIZE, preload=KERNEL_PRELOAD, start_method=KERNEL_START_METHOD):
+        self.size = size
+        self.preload = list(preload)
+        self.start_method = start_method
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.refill_needed = threading.Event()
+        self.context = None
+        self.refill_thread = None
+
+    def start(self):
+        """Start filling the pool in the background."""
+        with self.lock:
+            if self.refill_thread is not None:
+                return
+            self.refill_thread = threading.Thread(target=self._refill_loop, daemon=True)
+            self.refill_thread.start()
+        self.refill_needed.set()
+
+    def acquire(self):
+        """
+        Take a worker from the pool, or start one if none is ready.
+
+        Returns:
+            tuple: (process, connection)
+        """
+        self.start()
+        worker = None
+        with self.lock:
+            while self.idle:
+                process, connection = self.idle.popleft()
+                if process.is_alive():
+                    worker = (process, connection)
+                    break
+                connection.close()
+        self.refill_needed.set()
+
+        if worker is not None:
+            metrics.increment('kernel_pool.hits')
+        else:
+            metrics.increment('kernel_pool.misses')
+        metrics.increment('kernel_pool.acquired')
+        logger.info(f"Kernel pool {'hit' if worker else 'miss'} (hit rate {self.hit_rate():.0%})")
+
+        if worker is None:
+            worker = self._spawn()
+        return worker
+
+    def hit_rate(self):
+        return metrics.ratio('kernel_pool.hits', 'kernel_pool.acquired') or 0.0
+
+    def stats(self):
+        with self.lock:
+            idle = len(self.idle)
+        return {
+            "size": self.size,
+            "idle": idle,
+            "start_method": self.start_method,
+            "hits": metrics.get_counter('kernel_pool.hits'),
+            "misses": metrics.get_counter('kernel_pool.misses'),
+            "hit_rate": metrics.ratio('kernel_pool.hits', 'kernel_pool.acquired'),
+        }
+
+    def shutdown(self):
+        with self.lock:
+            workers, self.idle = list(self.idle), deque()
+        for process, connection in workers:
+            process.terminate()
+            connection.close()
+
+    def _get_context(self):
+        if self.context is None:
+            self.context = multiprocessing.get_context(self.start_method)
+            if self.start_method == 'forkserver':
+                self.context.set_forkserver_preload(['__main__', 'kernel'] + self.preload)
+        return self.context
+
+    def _spawn(self):
+        context = self._get_context()
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=kernel_main, args=(child_conn, self.preload, os.getpid()),
+                                  daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def _refill_loop(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+
+            while True:
+                with self.lock:
+                    if len(self.idle) >= self.size:
+                        break
+                try:
+                    started = time.time()
+                    process, connection = self._spawn()
+                    # Only hand out workers that have finished their imports
+                    if not connection.poll(300.0) or connection.recv() != ("ready",):
+                        raise RuntimeError("kernel worker did not become ready")
+                    metrics.observe('kernel_pool.warmup_seconds', time.time() - started)
+                except Exception as e:
+                    logger.error(f"Could not pre-warm kernel worker: {e}")
+                    time.sleep(5.0)
+                    continue
+                with self.lock:
+                    self.idle.append((process, connection))
+
+kernel_pool = KernelPool()
+
+###############################################################################
+# Handle on a kernel worker, owned by a single user session
+###############################################################################
+class ExecutionKernel:
+    """
+    Persistent execution kernel for one session.
+
+    The worker process keeps the namespace resident between cells. The web
+    process keeps a mirror of the picklable variables in the session's
+    analysis_namespace, which is used to re-seed the kernel after a restart.
+    """
+    def __init__(self):
+        self.process = None
+        self.connection = None
+        self.lock = threading.Lock()        # one cell at a time per kernel
+        self.busy = False
+        self.interrupted = False
+        self.last_used = time.time()
+        self.synced = {}                    # name -> id() of the value the worker already has
+
+        with _kernels_lock:
+            _kernels.add(self)
+        _start_reaper()
+
+    def start(self):
+        self.process, self.connection = kernel_pool.acquire()
+        self.synced = {}
+        self.last_used = time.time()
+        logger.info(f"Started execution kernel (pid {self.process.pid})")
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def execute(self, code, namespace, execution_id, timeout=600.0, on_stream=None):
+        """
+        Run a code cell in the kernel and update the namespace mirror.
+
+        Args:
+            code (str): The code to execute
+            namespace (dict): The session's analysis_namespace (mirror of the kernel)
+            execution_id (str): ID of this execution
+            timeout (float): Seconds to wait before the kernel is restarted
+            on_stream (callable): on_stream(kind, payload) is called for output
+                                  chunks and figures while the cell is running
+
+        Returns:
+            dict: status ('completed', 'cancelled', 'timeout' or 'error'),
+                  output, figures and error flag
+        """
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+
+            # Only send variables the worker does not already hold
+            updates = [name for name, value in namespace.items()
+                       if self.synced.get(name) != id(value)]
+            deletions = [name for name in self.synced if name not in namespace]
+            update_delta = pack_namespace_delta(namespace, updates, [])
+            if updates:
+                logger.info(f"Sending {len(update_delta['changed'])} variable(s) "
+                            f"({update_delta['nbytes']} bytes pickled, {update_delta['shared_nbytes']} bytes "
+                            f"in shared memory) to kernel for execution {execution_id}")
+
+            # interrupt() may kill the worker while the cell runs, but leaves
+            # the process and connection to this method to clean up
+            connection = self.connection
+            self.busy = True
+            self.interrupted = False
+            try:
+                connection.send(("execute", execution_id, code, update_delta, deletions))
+                adopt_shared_values(namespace, update_delta)
+                for name in deletions:
+                    del self.synced[name]
+                for name in update_delta["changed"]:
+                    self.synced[name] = id(namespace[name])
+
+                deadline = time.time() + timeout
+                while True:
+                    if not connection.poll(max(0.0, deadline - time.time())):
+                        logger.warning(f"Execution {execution_id} timed out - restarting kernel")
+                        self._stop_process()
+                        return {"status": "timeout", "output": "", "figures": [], "error": True}
+
+                    message = connection.recv()
+                    if message[0] == "result":
+                        break
+                    if message[0] == "stream" and on_stream is not None:
+                        on_stream(message[2], message[3])
+                    # anything else is e.g. ("ready",) from a cold-started worker
+                _, _, output_text, figures, had_error, interrupted, delta = message
+
+            except (EOFError, OSError, BrokenPipeError) as e:
+                # The worker died mid-cell (killed after an interrupt, or crashed)
+                self._stop_process()
+                if self.interrupted:
+                    return {"status": "cancelled", "output": "", "figures": [], "error": True}
+                logger.error(f"Kernel died during execution {execution_id}: {e}")
+                return {"status": "error", "output": f"Kernel died during execution: {e}",
+                        "figures": [], "error": True}
+
+            finally:
+                self.busy = False
+                self.last_used = time.time()
+
+            replaced = [namespace[name] for name in
+                        list(delta["changed"]) + delta["deleted"] + delta["kernel_only"] if name in namespace]
+            new_vars = apply_namespace_delta(namespace, delta)
+            release_shared_values(replaced, namespace)
+            for name, value in new_vars.items():
+                self.synced[name] = id(value)
+            for name in delta["deleted"] + delta["kernel_only"]:
+                self.synced.pop(name, None)
+
+            logger.info(f"Namespace delta for execution {execution_id}: {len(delta['changed'])} changed, "
+                        f"{len(delta['deleted'])} deleted, {len(delta['kernel_only'])} kernel-only, "
+                        f"{delta['nbytes']} bytes pickled, {delta['shared_nbytes']} bytes in shared memory")
+
+            status = "cancelled" if interrupted or self.interrupted else "completed"
+            return {"status": status, "output": output_text, "figures": figures, "error": had_error}
+
+    def interrupt(self, grace=2.0):
+        """
+        Interrupt the running cell, killing the worker if it does not respond.
+        The execution then reports the cell as cancelled and cleans up after
+        the worker, and the next one starts a new worker.
+        """
+        process = self.process
+        if not self.busy or process is None or not process.is_alive():
+            return
+        self.interrupted = True
+        os.kill(process.pid, signal.SIGINT)
+
+        deadline = time.time() + grace
+        while self.busy and time.time() < deadline:
+            time.sleep(0.05)
+
+        if self.busy:
+            # Not terminate(): the worker would report the cell as finished
+            logger.warning(f"Kernel {process.pid} did not respond to interrupt, killing it")
+            process.kill()
+            process.join(timeout=1.0)
+
+    def shutdown(self):
+        self._stop_process()
+        with _kernels_lock:
+            _kernels.discard(self)
+
+    def _stop_process(self):
+        process, connection = self.process, self.connection
+        self.process, self.connection = None, None
+        self.synced = {}
+
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join(timeout=2.0)
+            if process.is_alive():
+                logger.warning(f"Kernel {process.pid} did not terminate gracefully, forcing kill")
+                os.kill(process.pid, signal.SIGKILL)
+                process.join(timeout=1.0)
+        if connection is not None:
+            connection.close()
+
+###############################################################################
+# Kernel lookup and idle reaping
+###############################################################################
+def get_kernel(state):
+    """Fetch or create the execution kernel of a user session."""
+    if state.kernel is None:
+        state.kernel = ExecutionKernel()
+    return state.kernel
+
+def shutdown_kernel(state):
+    """Shut down the kernel of a session, e.g. when the analysis is re-initialised."""
+    if state.kernel is not None:
+        state.kernel.shutdown()
+        state.kernel = None
+
+def reap_idle_kernels(idle_timeout=KERNEL_IDLE_TIMEOUT):
+    """Stop kernel processes that have been idle for longer than idle_timeout."""
+    now = time.time()
+    with _kernels_lock:
+        kernels = list(_kernels)
+
+    for kernel in kernels:
+        if kernel.busy or not kernel.is_alive():
+            continue
+        if now - kernel.last_used > idle_timeout and kernel.lock.acquire(blocking=False):
+            try:
+                logger.info(f"Reaping idle kernel (pid {kernel.process.pid})")
+                kernel._stop_process()
+            finally:
+                kernel.lock.release()
+
+def shutdown_orphaned_kernels(live_kernels):
+    """Shut down kernels that no session refers to any more. Returns their number."""
+    with _kernels_lock:
+        orphaned = [kernel for kernel in _kernels if kernel not in live_kernels and not kernel.busy]
+
+    for kernel in orphaned:
+        logger.info(f"Shutting down orphaned kernel (pid {kernel.process.pid if kernel.process else None})")
+        kernel.shutdown()
+
+    # Join worker processes that have exited, so they do not linger as zombies
+    multiprocessing.active_children()
+    return len(orphaned)
+
+def _reaper_loop():
+    while True:
+        time.sleep(KERNEL_REAP_INTERVAL)
+        try:
+            reap_idle_kernels()
+        except Exception as e:
+            logger.error(f"Error reaping idle kernels: {e}")
+
+def _start_reaper():
+    global _reaper_thread
+    with _kernels_lock:
+        if _reaper_thread is None:
+            _reaper_thread = threading.Thread(target=_reaper_loop, daemon=True)
+            _reaper_thread.start()
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from prompts import *
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# Cache of LLM responses by prompt:
+#   off          - every request goes to the provider
+#   read-through - cached responses are reused, new ones are stored
+#   replay       - only cached responses are used; other requests fail with
+#                  LLMCacheMiss (deterministic and offline, e.g. for benchmarks)
+LLM_CACHE_MODE = os.environ.get('ALFRED_LLM_CACHE', 'off').lower()
+LLM_CACHE_MODES = ('off', 'read-through', 'replay')
+
+LLM_CACHE_DIR = os.environ.get('ALFRED_LLM_CACHE_DIR', 'llm_cache')
+
+# The least recently used responses are deleted beyond this many bytes
+LLM_CACHE_MAX_BYTES = int(os.environ.get('ALFRED_LLM_CACHE_MAX_BYTES', 256 * 1024**2))
+
+
+class LLMCacheMiss(Exception):
+    """Raised in replay mode for a prompt without a cached response."""
+
+###############################################################################
+# Keys: hashes of normalised prompts
+###############################################################################
+def prompt_key(MODEL_NAME, response_type, prompt, system_prompt=SYSTEM_PROMPT):
+    """
+    Hash identifying a request: the model, response type, system prompt and
+    the content of the prompt parts. Images are represented by the hash of
+    their data, and provider-side caching hints are left out.
+    """
+    content = {
+        "model": MODEL_NAME,
+        "response_type": response_type,
+        "system": system_prompt,
+        "parts": [_normalize(part) for part in prompt],
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def _normalize(value):
+    if hasattr(value, 'model_dump'):            # Gemini parts
+        value = value.model_dump(exclude_none=True)
+    if isinstance(value, dict):
+        return {key: _hash_data(item) if key in ("data", "url") else _normalize(item)
+                for key, item in value.items() if key != "cache_control"}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, bytes):
+        return _hash_data(value)
+    return value
+
+def _hash_data(data):
+    if isinstance(data, str):
+        data = data.encode()
+    elif not isinstance(data, bytes):
+        return _normalize(data)
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+###############################################################################
+# Size-bounded on-disk store
+###############################################################################
+class LLMResponseCache:
+    """
+    LLM responses stored as files named by their prompt_key. The least
+    recently used files (by modification time, which hits refresh) are
+    deleted once the store exceeds max_bytes.
+
+    The index of files is read from the directory on first use, so the
+    cache survives restarts and can be shared by the workers of a host.
+    """
+    def __init__(self, directory=LLM_CACHE_DIR, mode=LLM_CACHE_MODE, max_bytes=LLM_CACHE_MAX_BYTES):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode: {mode} (choose from {', '.join(LLM_CACHE_MODES)})")
+        self.directory = directory
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.index = None               # key -> size, least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def get(self, key):
+        """Cached response for a key, or None."""
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                response = json.load(f)["response"]
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            metrics.increment('llm_cache.misses')
+            return None
+        with self.lock:
+            self._load_index()
+            if key in self.index:
+                self.index.move_to_end(key)
+        metrics.increment('llm_cache.hits')
+        return response
+
+    def put(self, key, response, **info):
+        """Store a response, with info (e.g. the model) for whoever inspects the files."""
+        if self.mode != 'read-through' or not response:
+            return
+        data = json.dumps({"response": response, "created": time.time(), **info})
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        metrics.increment('llm_cache.stores')
+
+        with self.lock:
+            self._load_index()
+            self.size += len(data) - self.index.pop(key, 0)
+            self.index[key] = len(data)
+            while self.size > self.max_bytes and len(self.index) > 1:
+                old_key, old_size = self.index.popitem(last=False)
+                self.size -= old_size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+                metrics.increment('llm_cache.evictions')
+
+    def stats(self):
+        with self.lock:
+            self._load_index()
+            return {"mode": self.mode, "entries": len(self.index), "bytes": self.size, "max_bytes": self.max_bytes}
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load_index(self):
+        if self.index is not None:
+            return
+        files = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, name[:-len('.json')], stat.st_size))
+        self.index = OrderedDict((key, size) for _, key, size in sorted(files))
+        self.size = sum(self.index.values())
+
+llm_cache = LLMResponseCache()
@@ -0,0 +1,117 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import openai
+import anthropic
+from google import genai
+from google.genai import types
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# At most this many provider clients (one per provider and API key) are kept
+MAX_LLM_CLIENTS = int(os.environ.get('ALFRED_MAX_LLM_CLIENTS', 32))
+
+# Provider of each model option
+MODEL_PROVIDERS = {"gpt": "openai", "o1": "openai", "claude": "anthropic", "gemini": "google"}
+
+# Alternative API endpoints of the providers, e.g. a local stand-in for load
+# tests (see benchmarks/mock_llm_server.py); unset means the real APIs
+OPENAI_BASE_URL = os.environ.get('ALFRED_OPENAI_BASE_URL') or None
+ANTHROPIC_BASE_URL = os.environ.get('ALFRED_ANTHROPIC_BASE_URL') or None
+GEMINI_BASE_URL = os.environ.get('ALFRED_GEMINI_BASE_URL') or None
+
+
+###############################################################################
+# Process-wide registry of LLM clients
+###############################################################################
+class ClientRegistry:
+    """
+    Keeps one client per (provider, API key), so that requests reuse the
+    client's HTTP connection pool instead of paying for client construction
+    and TLS handshakes every time. The least recently used clients beyond
+    max_clients are dropped; they close their connections once no running
+    request uses them any more.
+
+    Keys are identified by their SHA-256 hash, so the registry holds no API
+    keys besides those inside the clients themselves.
+    """
+    def __init__(self, max_clients=MAX_LLM_CLIENTS):
+        self.max_clients = max_clients
+        self.clients = OrderedDict()        # (provider, key hash) -> client, least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, provider, api_key):
+        """Fetch the client for a provider and API key, or construct it."""
+        key = (provider, hashlib.sha256(api_key.encode()).hexdigest())
+        with self.lock:
+            client = self.clients.get(key)
+            if client is not None:
+                self.clients.move_to_end(key)
+                metrics.increment('llm_clients.reused')
+                return client
+
+        # Construct outside the lock; if two requests race, the first one stored wins
+        started = time.time()
+        client = construct_client(provider, api_key)
+        metrics.observe('llm_clients.construct_seconds', time.time() - started)
+        metrics.increment('llm_clients.created')
+
+        with self.lock:
+            client = self.clients.setdefault(key, client)
+            self.clients.move_to_end(key)
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+                metrics.increment('llm_clients.evicted')
+        return client
+
+    def stats(self):
+        with self.lock:
+            return {"clients": len(self.clients), "max_clients": self.max_clients}
+
+def construct_client(provider, api_key):
+    # Retries are made by resilient_call (see llm_resilience.py), not by the SDKs
+    if provider == "openai":
+        client = openai.OpenAI(api_key=api_key, max_retries=0, base_url=OPENAI_BASE_URL)
+    elif provider == "anthropic":
+        client = anthropic.Anthropic(api_key=api_key, max_retries=0, base_url=ANTHROPIC_BASE_URL)
+    elif provider == "google":
+        http_options = types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+        client = genai.Client(api_key=api_key, http_options=http_options)
+    else:
+        raise ValueError(f"Unknown LLM provider: {provider}")
+    instrument_connections(client)
+    return client
+
+###############################################################################
+# Counting HTTP requests and newly opened connections
+###############################################################################
+def instrument_connections(client):
+    """
+    Count the HTTP requests a client sends (llm_clients.http_requests) and the
+    connections it opens for them (llm_clients.connections_opened). Requests
+    without a new connection reused a pooled one.
+
+    Only httpx based clients can be instrumented; others are left as they are.
+    """
+    http_client = getattr(client, '_client', None)
+    if http_client is None:
+        http_client = getattr(getattr(client, '_api_client', None), '_httpx_client', None)
+    hooks = getattr(http_client, 'event_hooks', None)
+    if not isinstance(hooks, dict) or 'request' not in hooks:
+        return
+    hooks['request'].append(_trace_request)
+    http_client.event_hooks = hooks
+
+def _trace_request(request):
+    metrics.increment('llm_clients.http_requests')
+    request.extensions['trace'] = _trace_connection
+
+def _trace_connection(event_name, info):
+    if event_name == 'connection.connect_tcp.complete':
+        metrics.increment('llm_clients.connections_opened')
+
+client_registry = ClientRegistry()
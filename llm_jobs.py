@@ -0,0 +1,114 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from state_backend import *
+from streaming import *
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# LLM requests are network bound, so many can wait on providers at once from a
+# single process. Requests beyond this limit wait for a free thread.
+LLM_MAX_IN_FLIGHT = int(os.environ.get('ALFRED_LLM_MAX_IN_FLIGHT', 256))
+
+
+###############################################################################
+# LLM requests run as background jobs
+###############################################################################
+class LLMJobRunner:
+    """
+    Runs LLM requests on a thread pool, so that requests to the web server
+    return at once instead of holding a worker thread for the whole call.
+
+    A job is a function fn(state, emit, *args) returning (payload, status code).
+    emit(event, data) publishes progress, e.g. tokens, on the job's EventStream
+    and the result is published as its 'done' event. Clients follow the stream
+    via /llm_stream/<job_id> or long-poll /llm_results/<job_id> (from any
+    worker, if the state backend is shared). While a job runs its id is in
+    state.llm_jobs, which keeps the session from being evicted.
+    """
+    def __init__(self, backend=state_backend, max_in_flight=LLM_MAX_IN_FLIGHT):
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='alfred-llm')
+        self.streams = {}           # (session_id, job_id) -> EventStream
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def submit(self, state, kind, fn, *args):
+        """Start a job for a session. Returns its id."""
+        job_id = uuid.uuid4().hex
+        stream = EventStream(self.backend, self._key(state.session_id, job_id))
+        stream.publish('status', {"status": "pending"})
+        with self.lock:
+            self._collect()
+            self.streams[(state.session_id, job_id)] = stream
+            self.in_flight += 1
+        state.llm_jobs.add(job_id)
+        metrics.increment(f'llm_jobs.{kind}')
+        self.executor.submit(self._run, state, job_id, kind, stream, fn, args)
+        return job_id
+
+    def result(self, session_id, job_id, wait=0):
+        """
+        Result of a job, waiting up to wait seconds for it to finish.
+
+        Returns:
+            tuple: (payload, status code), with status "pending" and code 202
+                   if the job is still running, or None if there is no such job
+        """
+        stream = self.find(session_id, job_id)
+        if stream is None:
+            return None
+        if wait > 0:
+            stream.wait_closed(wait)
+        events, closed = stream.wait(0, 0)
+        for event, data in events:
+            if event == 'done':
+                return data["payload"], data["code"]
+        return {"status": "pending", "job_id": job_id}, 202
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight}
+
+    def _run(self, state, job_id, kind, stream, fn, args):
+        started = time.time()
+        try:
+            payload, code = fn(state, stream.publish, *args)
+        except Exception as e:
+            logger.error(f"Error in {kind} LLM job {job_id}: {str(e)}")
+            payload, code = {"status": "error", "message": str(e)}, 500
+        finally:
+            state.llm_jobs.discard(job_id)
+            with self.lock:
+                self.in_flight -= 1
+            metrics.observe(f'llm_jobs.{kind}_seconds', time.time() - started)
+        state.publish()
+        stream.publish('done', {"payload": payload, "code": code})
+        stream.close()
+
+    def find(self, session_id, job_id):
+        """The EventStream of a job, or None."""
+        with self.lock:
+            stream = self.streams.get((session_id, job_id))
+        if stream is None and self.backend.shared:
+            key = self._key(session_id, job_id)
+            if self.backend.read_list(key):
+                stream = RemoteEventStream(self.backend, key)
+        return stream
+
+    def _collect(self):
+        # Drop results nobody fetched for a long time
+        now = time.time()
+        for key, stream in list(self.streams.items()):
+            if stream.closed and now - stream.updated > STREAM_TTL:
+                del self.streams[key]
+
+    def _key(self, session_id, job_id):
+        return f"events:llm:{session_id}:{job_id}"
+
+llm_jobs = LLMJobRunner()
@@ -0,0 +1,304 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+import email.utils
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+import httpx
+import openai
+import anthropic
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# Attempts of an LLM request that failed with a transient error (rate limit,
+# overload, server error, lost connection), with exponential backoff and full
+# jitter between them. A Retry-After from the provider is honoured, up to
+# LLM_MAX_RETRY_AFTER seconds.
+LLM_MAX_ATTEMPTS = int(os.environ.get('ALFRED_LLM_MAX_ATTEMPTS', 4))
+LLM_BACKOFF_BASE = float(os.environ.get('ALFRED_LLM_BACKOFF_BASE', 1.0))
+LLM_BACKOFF_MAX = float(os.environ.get('ALFRED_LLM_BACKOFF_MAX', 20.0))
+LLM_MAX_RETRY_AFTER = float(os.environ.get('ALFRED_LLM_MAX_RETRY_AFTER', 60.0))
+
+# Hedging: if a request has not started responding after this percentile of
+# the provider's recent latencies, a second identical request is sent and the
+# first one to respond is used. 0 turns hedging off. Needs at least
+# LLM_HEDGE_MIN_SAMPLES latencies.
+LLM_HEDGE_PERCENTILE = float(os.environ.get('ALFRED_LLM_HEDGE_PERCENTILE', 0))
+LLM_HEDGE_MIN_SAMPLES = 20
+
+# Circuit breaker: after this many consecutive transient failures of a
+# provider, its requests fail at once for LLM_CIRCUIT_RESET seconds. Then a
+# single request is let through to probe whether the provider recovered.
+LLM_CIRCUIT_THRESHOLD = int(os.environ.get('ALFRED_LLM_CIRCUIT_THRESHOLD', 5))
+LLM_CIRCUIT_RESET = float(os.environ.get('ALFRED_LLM_CIRCUIT_RESET', 30.0))
+
+# Models to fall back to, in order, when the session's model fails with a
+# transient error or its circuit is open; models without an API key are skipped
+LLM_FALLBACK_MODELS = [model.strip() for model in os.environ.get('ALFRED_LLM_FALLBACK_MODELS', '').split(',')
+                       if model.strip()]
+
+# HTTP status codes worth retrying (529: Anthropic overloaded)
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+hedge_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ALFRED_LLM_HEDGE_WORKERS', 64)),
+                                    thread_name_prefix='alfred-hedge')
+
+
+class EmptyResponseError(Exception):
+    """The LLM returned nothing usable; worth asking again."""
+
+class CircuitOpenError(Exception):
+    """A provider's circuit breaker is open, so the request was not sent."""
+    def __init__(self, provider, retry_in):
+        super().__init__(f"Requests to {provider} are paused after repeated failures; "
+                         f"trying again in {retry_in:.0f} seconds")
+        self.provider = provider
+        self.retry_in = retry_in
+
+class HedgeCancelled(Exception):
+    """Raised inside the slower of two hedged requests to stop it."""
+
+###############################################################################
+# Classifying errors
+###############################################################################
+def error_status_code(e):
+    """HTTP status code of a provider error, or None."""
+    for code in (getattr(e, 'status_code', None), getattr(e, 'code', None),
+                 getattr(getattr(e, 'response', None), 'status_code', None)):
+        if isinstance(code, int):
+            return code
+    # Errors that only mention the status, as API_error_handler expects
+    match = re.search(r'\b(4\d\d|5\d\d)\b', str(e))
+    return int(match.group(1)) if match else None
+
+def is_transient(e):
+    if isinstance(e, (EmptyResponseError, httpx.TransportError, openai.APIConnectionError,
+                      anthropic.APIConnectionError)):
+        return True
+    return error_status_code(e) in TRANSIENT_STATUS_CODES
+
+def retry_after(e):
+    """Seconds to wait before retrying, as asked by the provider, or None."""
+    headers = getattr(getattr(e, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, e=None):
+    """Seconds to wait before retry number attempt (from 1)."""
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1)))
+    requested = retry_after(e) if e is not None else None
+    if requested is not None:
+        delay = max(delay, min(requested, LLM_MAX_RETRY_AFTER))
+    return delay
+
+###############################################################################
+# Per-provider circuit breakers
+###############################################################################
+class CircuitBreaker:
+    """
+    Counts consecutive transient failures of a provider. Once there are
+    threshold of them the circuit opens: requests are rejected for
+    reset_seconds, then one probe request is let through. Its success closes
+    the circuit, its failure opens it again.
+    """
+    def __init__(self, provider, threshold=LLM_CIRCUIT_THRESHOLD, reset_seconds=LLM_CIRCUIT_RESET):
+        self.provider = provider
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        """Raise CircuitOpenError if requests to the provider are paused."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            waited = time.time() - self.opened_at
+            if waited >= self.reset_seconds and not self.probing:
+                self.probing = True
+                return
+        metrics.increment(f'llm.circuit_rejected.{self.provider}')
+        raise CircuitOpenError(self.provider, max(0.0, self.reset_seconds - waited))
+
+    def record_success(self):
+        """Record a request that reached the provider, even if it was rejected for its content."""
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit for {self.provider} closed again")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                self.opened_at = time.time()
+                self.probing = False
+                metrics.increment(f'llm.circuit_opened.{self.provider}')
+                logger.warning(f"Circuit for {self.provider} opened after {self.failures} failures")
+
+    def stats(self):
+        with self.lock:
+            state = "closed" if self.opened_at is None else ("half_open" if self.probing else "open")
+            return {"state": state, "failures": self.failures}
+
+circuit_breakers = {}
+_breakers_lock = threading.Lock()
+
+def circuit_breaker(provider):
+    with _breakers_lock:
+        if provider not in circuit_breakers:
+            circuit_breakers[provider] = CircuitBreaker(provider)
+        return circuit_breakers[provider]
+
+def circuit_stats():
+    with _breakers_lock:
+        breakers = dict(circuit_breakers)
+    return {provider: breaker.stats() for provider, breaker in breakers.items()}
+
+###############################################################################
+# Hedged requests
+###############################################################################
+class HedgeRace:
+    """
+    Two attempts of the same request. The first to stream a token (or to
+    return, if they do not stream) leads; the other is stopped at its next
+    token.
+    """
+    def __init__(self, on_text):
+        self.on_text = on_text
+        self.leader = None
+        self.lock = threading.Lock()
+
+    def run(self, attempt, fn):
+        if self.on_text is None:
+            return fn(None)
+        def on_text(text):
+            with self.lock:
+                if self.leader is None:
+                    self.leader = attempt
+            if self.leader != attempt:
+                raise HedgeCancelled()
+            self.on_text(text)
+        return fn(on_text)
+
+def latency_metric(provider, streamed):
+    return f'llm.latency.{provider}.' + ('first_token' if streamed else 'response')
+
+def hedge_delay(provider, streamed):
+    """Seconds after which to hedge a request, or None if hedging is off or there is too little data."""
+    if LLM_HEDGE_PERCENTILE <= 0:
+        return None
+    samples = metrics.get_samples(latency_metric(provider, streamed))
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return metrics.percentile(samples, LLM_HEDGE_PERCENTILE)
+
+def timed_call(provider, fn, on_text):
+    """Call fn(on_text), recording the time to its first token or its response for hedge_delay."""
+    started = time.time()
+    first_token = []
+    def timed_on_text(text):
+        if not first_token:
+            first_token.append(time.time())
+            metrics.observe(latency_metric(provider, True), first_token[0] - started)
+        on_text(text)
+    result = fn(timed_on_text if on_text is not None else None)
+    if on_text is None:
+        metrics.observe(latency_metric(provider, False), time.time() - started)
+    return result
+
+def hedged_call(provider, fn, on_text=None):
+    """
+    Call fn(on_text) and, if it is slower than usual to respond, a second
+    copy of it (see LLM_HEDGE_PERCENTILE). Returns the result of the
+    attempt that responded first.
+    """
+    call = lambda on_text: timed_call(provider, fn, on_text)
+    delay = hedge_delay(provider, on_text is not None)
+    if delay is None:
+        return call(on_text)
+
+    race = HedgeRace(on_text)
+    first = hedge_executor.submit(race.run, 0, call)
+    done, _ = wait([first], timeout=delay)
+    if done or race.leader is not None:
+        return first.result()
+
+    metrics.increment(f'llm.hedges.{provider}')
+    second = hedge_executor.submit(race.run, 1, call)
+    error = None
+    for future in as_completed([first, second]):
+        try:
+            result = future.result()
+        except HedgeCancelled:
+            continue
+        except Exception as e:
+            # The other attempt may still succeed
+            error = error or e
+            continue
+        if future is second:
+            metrics.increment(f'llm.hedge_wins.{provider}')
+        return result
+    raise error
+
+###############################################################################
+# Retries around an LLM request
+###############################################################################
+def resilient_call(provider, fn, on_text=None, on_retry=None, max_attempts=LLM_MAX_ATTEMPTS):
+    """
+    Call fn(on_text), an LLM request to provider, retrying transient errors
+    with backoff (honouring Retry-After), hedging slow attempts and going
+    through the provider's circuit breaker. on_retry(attempt, delay, error)
+    is called before each retry, e.g. to tell the client to start over.
+
+    Raises:
+        CircuitOpenError: if the provider's circuit is open
+        Exception: the last error, if it was not transient or attempts ran out
+    """
+    breaker = circuit_breaker(provider)
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.check()
+        try:
+            result = hedged_call(provider, fn, on_text)
+        except Exception as e:
+            if not is_transient(e):
+                # The provider answered (or the request was cancelled), so it is up
+                breaker.record_success()
+                raise
+            if not isinstance(e, EmptyResponseError):
+                breaker.record_failure()
+            if attempt >= max_attempts:
+                metrics.increment(f'llm.retries_exhausted.{provider}')
+                raise
+            delay = backoff_delay(attempt, e)
+            logger.warning(f"LLM request to {provider} failed ({e}), retrying in {delay:.1f}s")
+            metrics.increment(f'llm.retries.{provider}')
+            metrics.observe('llm.retry_wait_seconds', delay)
+            if on_retry is not None:
+                on_retry(attempt, delay, e)
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        if attempt > 1:
+            metrics.increment(f'llm.retry_successes.{provider}')
+        return result
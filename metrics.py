@@ -0,0 +1,64 @@
+import math
+import threading
+from collections import defaultdict, deque
+
+# Number of most recent samples kept per timing metric
+MAX_SAMPLES = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+
+
+###############################################################################
+# Process-wide counters and timings, exposed via /api/metrics
+###############################################################################
+def increment(name, value=1):
+    """Add value to the counter called name."""
+    with _lock:
+        _counters[name] += value
+
+def observe(name, value):
+    """Record a sample (e.g. a duration in seconds) for the timing called name."""
+    with _lock:
+        _samples[name].append(value)
+
+def get_samples(name):
+    """Recent samples of the timing called name."""
+    with _lock:
+        return list(_samples.get(name, ()))
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+def percentile(samples, q):
+    """Nearest-rank percentile of a list of samples (q between 0 and 100)."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def ratio(numerator, denominator):
+    """Ratio of two counters, e.g. a cache hit rate. None if nothing was counted."""
+    with _lock:
+        num, den = _counters.get(numerator, 0), _counters.get(denominator, 0)
+    return num / den if den else None
+
+def get_metrics():
+    """Snapshot of all counters and summary statistics of all timings."""
+    with _lock:
+        counters = dict(_counters)
+        samples = {name: list(values) for name, values in _samples.items()}
+
+    timings = {}
+    for name, values in samples.items():
+        timings[name] = {
+            "count": len(values),
+            "mean": sum(values) / len(values) if values else None,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+        }
+    return {"counters": counters, "timings": timings}
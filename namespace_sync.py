@@ -0,0 +1,244 @@
+import zlib
+import types
+import pickle
+import logging
+import dill
+import numpy as np
+import pandas as pd
+from shared_arrays import *
+
+logger = logging.getLogger('alfred')
+
+# Containers are fingerprinted item by item up to this depth and length; deeper
+# or longer ones are checksummed as a whole (see _pickle_fingerprint)
+FINGERPRINT_MAX_DEPTH = 4
+FINGERPRINT_MAX_ITEMS = 10000
+
+
+###############################################################################
+# Content fingerprints of namespace variables
+###############################################################################
+def fingerprint_value(value):
+    """
+    Compute a cheap content fingerprint of a namespace variable.
+
+    Arrays and pandas objects are checksummed directly from their buffers.
+    Lists, tuples, dicts and sets are fingerprinted item by item, so that the
+    arrays they hold are checksummed rather than serialized. Other objects are
+    checksummed from a standard pickle whose array buffers are kept out of band
+    (and checksummed in place). Only objects the standard pickler cannot handle
+    are pickled with dill, which is returned as well so that it can be reused
+    if the variable has to be shipped.
+
+    Returns:
+        tuple: (fingerprint, pickled_bytes or None). The fingerprint is None if
+               the value cannot be pickled (it then only lives in the kernel).
+    """
+    if isinstance(value, types.ModuleType):
+        return ("module", value.__name__), None
+
+    try:
+        return _fingerprint(value, 0), None
+    except Exception:
+        pass
+
+    try:
+        blob = dill.dumps(value)
+    except Exception:
+        return None, None
+    return ("pickle", len(blob), zlib.crc32(blob)), blob
+
+def _fingerprint(value, depth):
+    if value is None or isinstance(value, (bool, int, float, complex)):
+        # repr, so that NaN equals itself
+        return (type(value).__name__, repr(value))
+    if isinstance(value, (str, bytes)):
+        data = value.encode('utf-8', 'surrogatepass') if isinstance(value, str) else value
+        return (type(value).__name__, len(data), zlib.crc32(data))
+
+    fingerprint = _buffer_fingerprint(value)
+    if fingerprint is not None:
+        return fingerprint
+
+    if type(value) in (list, tuple, dict, set, frozenset) and depth < FINGERPRINT_MAX_DEPTH \
+            and len(value) <= FINGERPRINT_MAX_ITEMS:
+        if isinstance(value, dict):
+            items = tuple((_fingerprint(key, depth + 1), _fingerprint(item, depth + 1)) for key, item in value.items())
+        elif isinstance(value, (set, frozenset)):
+            items = frozenset(_fingerprint(item, depth + 1) for item in value)
+        else:
+            items = tuple(_fingerprint(item, depth + 1) for item in value)
+        return (type(value).__name__, items)
+
+    return _pickle_fingerprint(value)
+
+def _pickle_fingerprint(value):
+    """Checksum of a protocol 5 pickle, with array buffers checksummed in place instead of copied."""
+    if isinstance(value, (types.FunctionType, types.MethodType, type)):
+        # The standard pickler stores these by name, so redefining one would go unnoticed
+        raise TypeError("Functions and classes are fingerprinted by their dill pickle")
+    buffers = []
+    data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    checksums = []
+    for buffer in buffers:
+        try:
+            checksums.append(zlib.crc32(buffer.raw()))
+        except BufferError:
+            # Not contiguous
+            checksums.append(zlib.crc32(memoryview(buffer).tobytes()))
+    return ("pickle5", len(data), zlib.crc32(data), tuple(checksums))
+
+def _buffer_fingerprint(value):
+    """Checksum numpy arrays and pandas objects without pickling them."""
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return ("ndarray", value.shape, value.dtype.str, _array_checksum(value))
+
+    try:
+        if isinstance(value, pd.DataFrame):
+            columns = tuple(_array_checksum(value.iloc[:, i].to_numpy())
+                            if isinstance(value.dtypes.iloc[i], np.dtype) and not value.dtypes.iloc[i].hasobject
+                            else zlib.crc32(pd.util.hash_pandas_object(value.iloc[:, i], index=False).to_numpy())
+                            for i in range(value.shape[1]))
+            index = zlib.crc32(pd.util.hash_pandas_object(value.index).to_numpy())
+            return ("DataFrame", value.shape, tuple(map(str, value.columns)), index, columns)
+        if isinstance(value, pd.Series):
+            hashed = pd.util.hash_pandas_object(value, index=True).to_numpy()
+            return ("Series", value.shape, str(value.name), zlib.crc32(hashed))
+    except Exception:
+        # e.g. unhashable objects inside an object column
+        return None
+
+    return None
+
+def _array_checksum(arr):
+    """
+    Arrays backed by shared memory are identified by their segment: in-place
+    changes are visible to the other process anyway, so they need not be read.
+    """
+    segment = backing_segment(arr)
+    if segment is not None:
+        return ("shared",) + segment
+    return zlib.crc32(np.ascontiguousarray(arr).view(np.uint8).reshape(-1))
+
+###############################################################################
+# Snapshots and deltas
+###############################################################################
+def is_synced_name(name):
+    """Dunder names such as __builtins__ are never synchronised."""
+    return not name.startswith('__')
+
+def snapshot_namespace(namespace):
+    """
+    Fingerprint every variable of the namespace.
+
+    Returns:
+        tuple: (snapshot, blobs) where snapshot maps name -> (id, fingerprint) and
+               blobs maps name -> pickled bytes for values that were pickled anyway.
+    """
+    snapshot = {}
+    blobs = {}
+    for name, value in namespace.items():
+        if not is_synced_name(name):
+            continue
+        fingerprint, blob = fingerprint_value(value)
+        snapshot[name] = (id(value), fingerprint)
+        if blob is not None:
+            blobs[name] = blob
+    return snapshot, blobs
+
+def diff_namespace(before, after):
+    """
+    Compare two snapshots.
+
+    A variable is considered changed if it was added, rebound to a different
+    object, or mutated in place (same identity but different fingerprint).
+
+    Returns:
+        tuple: (changed, deleted) lists of variable names
+    """
+    changed = [name for name, entry in after.items() if before.get(name) != entry]
+    deleted = [name for name in before if name not in after]
+    return changed, deleted
+
+def pack_namespace_delta(namespace, changed, deleted, blobs=None):
+    """
+    Serialize the changed variables of the namespace.
+
+    Args:
+        namespace (dict): Namespace the variables are taken from
+        changed (list): Names of added, rebound or mutated variables
+        deleted (list): Names of deleted variables
+        blobs (dict): Already pickled values, reused instead of pickling again
+
+    Large arrays and DataFrames are not pickled: they are moved into shared
+    memory (see shared_arrays.py) and only their handles are shipped.
+
+    Returns:
+        dict: {"changed": name -> bytes, "deleted": [...], "kernel_only": [...],
+               "shared": name -> handle, "nbytes": int, "shared_nbytes": int}
+              kernel_only lists changed variables that could not be pickled.
+    """
+    blobs = blobs or {}
+    packed = {}
+    shared = {}
+    kernel_only = []
+    for name in changed:
+        value = namespace[name]
+        exported = export_shared(value)
+        if exported is not value:
+            shared[name] = exported
+            blob = dill.dumps(exported)
+        else:
+            blob = blobs.get(name)
+        if blob is None:
+            try:
+                blob = dill.dumps(value)
+            except Exception:
+                logger.debug(f"Variable {name} could not be pickled - keeping it in the kernel only")
+                kernel_only.append(name)
+                continue
+        packed[name] = blob
+
+    return {
+        "changed": packed,
+        "deleted": list(deleted),
+        "kernel_only": kernel_only,
+        "shared": shared,
+        "nbytes": sum(len(blob) for blob in packed.values()),
+        "shared_nbytes": sum(namespace[name].nbytes if isinstance(namespace[name], np.ndarray)
+                             else int(namespace[name].memory_usage(index=False).sum())
+                             for name in shared),
+    }
+
+def apply_namespace_delta(namespace, delta):
+    """
+    Apply a delta produced by pack_namespace_delta to a namespace.
+
+    Returns:
+        dict: The deserialized changed variables
+    """
+    new_vars = {}
+    for name, blob in delta["changed"].items():
+        try:
+            new_vars[name] = import_shared(dill.loads(blob))
+        except Exception as e:
+            logger.error(f"Could not load variable {name}: {e}")
+    namespace.update(new_vars)
+    for name in list(delta["deleted"]) + list(delta["kernel_only"]):
+        namespace.pop(name, None)
+    return new_vars
+
+def adopt_shared_values(namespace, delta):
+    """
+    Rebind variables that pack_namespace_delta had to copy into shared memory to
+    that shared copy, so that the sending process does not keep a private
+    duplicate of the data.
+
+    Returns:
+        dict: The rebound variables
+    """
+    adopted = {}
+    for name, handle in delta["shared"].items():
+        if handle.copied and name in namespace:
+            adopted[name] = namespace[name] = handle.materialize()
+    return adopted
@@ -0,0 +1,144 @@
+import os
+import time
+import logging
+import threading
+from google.genai import types
+from prompts import *
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# Gemini caches a prompt prefix explicitly, which only pays off (and is only
+# allowed) for long prefixes. Caches expire after GEMINI_CACHE_TTL seconds.
+GEMINI_CACHE_MIN_TOKENS = int(os.environ.get('ALFRED_GEMINI_CACHE_MIN_TOKENS', 4096))
+GEMINI_CACHE_TTL = int(os.environ.get('ALFRED_GEMINI_CACHE_TTL', 600))
+
+
+###############################################################################
+# Anthropic: cache breakpoints
+###############################################################################
+def mark_cache_breakpoints(prompt):
+    """
+    Content of a prompt with Anthropic cache breakpoints at the ends of its
+    stable prefixes (see LLMPrompt). The prompt's parts are shared with the
+    session's PromptCache, so marked parts are copies.
+    """
+    content = list(prompt)
+    for end in sorted(set(getattr(prompt, 'cache_breakpoints', ()))):
+        if 0 < end <= len(content) and isinstance(content[end - 1], dict):
+            content[end - 1] = {**content[end - 1], "cache_control": {"type": "ephemeral"}}
+    return content
+
+###############################################################################
+# Gemini: explicit context caches of the earlier iterations
+###############################################################################
+class GeminiCacheRegistry:
+    """
+    Gemini context caches holding the system prompt and the earlier iterations
+    of a conversation (the first stable prefix of an LLMPrompt). The cache for
+    a prefix is created on first use and reused by the following calls until
+    it expires. A new iteration moves the prefix, so a new cache is created
+    and the old one is left to expire.
+    """
+    def __init__(self, min_tokens=GEMINI_CACHE_MIN_TOKENS, ttl=GEMINI_CACHE_TTL):
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.caches = {}            # (client id, model, prefix key) -> (cache name or None, expiry time)
+        self.lock = threading.Lock()
+
+    def get(self, client, MODEL_NAME, prompt):
+        """
+        Name of the cache holding the prompt's stable prefix, creating it if
+        needed.
+
+        Returns:
+            tuple: (cache name, number of prompt parts in the cache) or None if
+                   the prefix is not cached
+        """
+        prefix_key = getattr(prompt, 'prefix_key', None)
+        if prefix_key is None or prompt.prefix_tokens < self.min_tokens:
+            return None
+        length = prompt.cache_breakpoints[0]
+
+        key = (id(client), MODEL_NAME, prefix_key)
+        now = time.time()
+        with self.lock:
+            for other, (_, expires) in list(self.caches.items()):
+                if expires <= now:
+                    del self.caches[other]
+            if key in self.caches:
+                name, _ = self.caches[key]
+                return (name, length) if name else None
+
+        try:
+            started = time.time()
+            cache = client.caches.create(
+                model=MODEL_NAME,
+                config=types.CreateCachedContentConfig(
+                    contents=[types.Content(role="user", parts=list(prompt[:length]))],
+                    system_instruction=[types.Part.from_text(text=SYSTEM_PROMPT)],
+                    ttl=f"{self.ttl}s",
+                )
+            )
+            name = cache.name
+            metrics.increment('llm.gemini_caches_created')
+            metrics.observe('llm.gemini_cache_create_seconds', time.time() - started)
+        except Exception as e:
+            # Don't try again for this prefix; the request is sent uncached
+            logger.warning(f"Could not create Gemini context cache: {e}")
+            name = None
+
+        with self.lock:
+            # Expire our entry a little before the cache itself
+            self.caches[key] = (name, now + self.ttl - 30)
+        return (name, length) if name else None
+
+gemini_caches = GeminiCacheRegistry()
+
+###############################################################################
+# Token usage reported by the providers
+###############################################################################
+def usage_value(usage, *path):
+    """Field of a provider's usage object (or dict), following path; 0 if it is missing."""
+    for name in path:
+        if usage is None:
+            return 0
+        usage = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+    return usage or 0
+
+def record_llm_usage(provider, input_tokens, cached_tokens, cache_write_tokens=0, output_tokens=0):
+    """
+    Record the tokens of one LLM call. input_tokens includes the cached ones,
+    so llm.cached_input_tokens / llm.input_tokens is the prompt cache hit rate.
+    """
+    metrics.increment('llm.input_tokens', input_tokens)
+    metrics.increment('llm.cached_input_tokens', cached_tokens)
+    metrics.increment('llm.cache_write_tokens', cache_write_tokens)
+    metrics.increment('llm.output_tokens', output_tokens)
+    metrics.increment(f'llm.{provider}.input_tokens', input_tokens)
+    metrics.increment(f'llm.{provider}.cached_input_tokens', cached_tokens)
+    if input_tokens:
+        metrics.observe('llm.cached_input_fraction', cached_tokens / input_tokens)
+    logger.info(f"LLM usage: {input_tokens} input tokens ({cached_tokens} cached, {cache_write_tokens} "
+                f"written to cache), {output_tokens} output tokens")
+
+def record_anthropic_usage(usage, output_tokens=None):
+    if usage is None:
+        return
+    cached = usage_value(usage, 'cache_read_input_tokens')
+    written = usage_value(usage, 'cache_creation_input_tokens')
+    record_llm_usage("anthropic", usage_value(usage, 'input_tokens') + cached + written, cached, written,
+                     usage_value(usage, 'output_tokens') if output_tokens is None else output_tokens)
+
+def record_gemini_usage(usage):
+    if usage is None:
+        return
+    record_llm_usage("google", usage_value(usage, 'prompt_token_count'), usage_value(usage, 'cached_content_token_count'),
+                     output_tokens=usage_value(usage, 'candidates_token_count'))
+
+def record_openai_usage(usage):
+    if usage is None:
+        return
+    record_llm_usage("openai", usage_value(usage, 'prompt_tokens'),
+                     usage_value(usage, 'prompt_tokens_details', 'cached_tokens'),
+                     output_tokens=usage_value(usage, 'completion_tokens'))
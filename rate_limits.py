@@ -0,0 +1,195 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from state_backend import *
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# Requests and prompt tokens per minute allowed per provider and API key, as
+# (requests, tokens); 0 means no limit. The defaults match the free tier of
+# Gemini. Override with e.g. ALFRED_GOOGLE_RPM and ALFRED_GOOGLE_TPM.
+DEFAULT_RATE_LIMITS = {"google": (5, 250000), "anthropic": (0, 0), "openai": (0, 0)}
+
+# With a shared state backend, the limits hold across all web workers
+RATE_LIMIT_SHARED = os.environ.get('ALFRED_RATE_LIMIT_SHARED', '1').lower() in ('1', 'true', 'yes')
+
+# Waiting requests check the budget at least this often (other workers may use it)
+RATE_LIMIT_POLL_INTERVAL = 1.0
+
+# Lock on a shared budget, held for one read-modify-write
+RATE_LIMIT_LOCK_TTL = 2.0
+
+
+def configured_limits(provider):
+    requests, tokens = DEFAULT_RATE_LIMITS.get(provider, (0, 0))
+    return (int(os.environ.get(f'ALFRED_{provider.upper()}_RPM', requests)),
+            int(os.environ.get(f'ALFRED_{provider.upper()}_TPM', tokens)))
+
+###############################################################################
+# Token buckets of requests and tokens per minute
+###############################################################################
+class RateLimiter:
+    """
+    Two token buckets for one provider and API key, refilled continuously to
+    requests_per_minute requests and tokens_per_minute tokens. A request
+    takes one request and its estimated prompt tokens.
+
+    Requests that do not fit wait instead of failing. Waiting requests are
+    served round robin between sessions, in order within a session, so that
+    one busy session (e.g. fanning out) cannot starve the others.
+
+    With a backend, the buckets are kept there so all workers share them.
+    """
+    def __init__(self, name, requests_per_minute, tokens_per_minute, backend=None):
+        self.name = name
+        self.limits = (requests_per_minute, tokens_per_minute)
+        self.backend = backend
+        self.key = f"ratelimit:{name}"
+        self.levels = None                  # (requests, tokens, time) unless kept in the backend
+        self.queues = OrderedDict()         # session_id -> deque of waiting requests
+        self.condition = threading.Condition()
+
+    def acquire(self, session_id, tokens, on_wait=None):
+        """
+        Wait until a request of tokens tokens fits in the limits and take them.
+        on_wait(seconds) is called with the estimated wait if the request has
+        to wait. Returns the seconds waited.
+        """
+        started = time.time()
+        waiter = object()
+        notified = False
+        with self.condition:
+            self.queues.setdefault(session_id, deque()).append(waiter)
+            try:
+                while True:
+                    if self._head() is waiter:
+                        delay = self._take(tokens)
+                        if delay == 0:
+                            break
+                    else:
+                        delay = self._estimate(tokens)
+                    if on_wait is not None and not notified:
+                        on_wait(self.wait_estimate(tokens, queued=True))
+                        notified = True
+                    self.condition.wait(min(delay, RATE_LIMIT_POLL_INTERVAL) if delay else RATE_LIMIT_POLL_INTERVAL)
+            finally:
+                queue = self.queues[session_id]
+                queue.remove(waiter)
+                if queue:
+                    self.queues.move_to_end(session_id)
+                else:
+                    del self.queues[session_id]
+                self.condition.notify_all()
+
+        waited = time.time() - started
+        if notified:
+            metrics.increment(f'rate_limits.waits.{self.name.split(":")[0]}')
+            metrics.observe('rate_limits.wait_seconds', waited)
+        return waited
+
+    def wait_estimate(self, tokens=0, queued=False):
+        """
+        Seconds until a new request of tokens tokens would be served, given
+        the requests waiting (including it, if queued).
+        """
+        with self.condition:
+            waiting = sum(len(queue) for queue in self.queues.values()) - (1 if queued else 0)
+        requests_per_minute, tokens_per_minute = self.limits
+        requests, available, _ = self._levels()
+        estimate = 0.0
+        if requests_per_minute:
+            estimate = max(estimate, (waiting + 1 - requests) * 60 / requests_per_minute)
+        if tokens_per_minute:
+            estimate = max(estimate, (min(tokens, tokens_per_minute) - available) * 60 / tokens_per_minute)
+        return max(0.0, estimate)
+
+    def stats(self):
+        with self.condition:
+            waiting = sum(len(queue) for queue in self.queues.values())
+        return {"waiting": waiting, "wait_estimate": round(self.wait_estimate(), 2),
+                "requests_per_minute": self.limits[0], "tokens_per_minute": self.limits[1]}
+
+    def _head(self):
+        for queue in self.queues.values():
+            return queue[0]
+
+    def _estimate(self, tokens):
+        requests, available, _ = self._levels()
+        return self._delay(requests, available, tokens)
+
+    def _delay(self, requests, available, tokens):
+        """Seconds until the buckets hold one request and tokens tokens."""
+        requests_per_minute, tokens_per_minute = self.limits
+        delay = 0.0
+        if requests_per_minute and requests < 1:
+            delay = max(delay, (1 - requests) * 60 / requests_per_minute)
+        if tokens_per_minute and available < min(tokens, tokens_per_minute):
+            delay = max(delay, (min(tokens, tokens_per_minute) - available) * 60 / tokens_per_minute)
+        return delay
+
+    def _levels(self, now=None):
+        """Current (requests, tokens, time) in the buckets, refilled up to now."""
+        now = now or time.time()
+        levels = self.backend.get(self.key) if self.backend is not None else self.levels
+        requests_per_minute, tokens_per_minute = self.limits
+        if levels is None:
+            return requests_per_minute, tokens_per_minute, now
+        requests, tokens, updated = levels
+        elapsed = max(0.0, now - updated)
+        return (min(requests_per_minute, requests + elapsed * requests_per_minute / 60),
+                min(tokens_per_minute, tokens + elapsed * tokens_per_minute / 60), now)
+
+    def _take(self, tokens):
+        """Take a request and tokens if they fit. Returns 0 if they did, else the seconds until they will."""
+        if self.backend is None:
+            return self._take_locked(tokens)
+
+        lock = f"{self.key}:lock"
+        while not self.backend.set_if_absent(lock, worker_id(), ttl=RATE_LIMIT_LOCK_TTL):
+            time.sleep(0.01)
+        try:
+            return self._take_locked(tokens)
+        finally:
+            self.backend.delete(lock)
+
+    def _take_locked(self, tokens):
+        requests, available, now = self._levels()
+        delay = self._delay(requests, available, tokens)
+        if delay == 0:
+            levels = (requests - 1, available - min(tokens, self.limits[1]), now)
+            if self.backend is not None:
+                self.backend.set(self.key, levels, ttl=120)
+            else:
+                self.levels = levels
+        return delay
+
+###############################################################################
+# Process-wide registry, one limiter per provider and API key
+###############################################################################
+class RateLimiterRegistry:
+    def __init__(self, backend=state_backend):
+        self.backend = backend if backend.shared and RATE_LIMIT_SHARED else None
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def get(self, provider, api_key):
+        """Limiter of a provider and API key, or None if the provider has no limits."""
+        limits = configured_limits(provider)
+        if not any(limits):
+            return None
+        name = f"{provider}:{hashlib.sha256((api_key or '').encode()).hexdigest()[:16]}"
+        with self.lock:
+            if name not in self.limiters:
+                self.limiters[name] = RateLimiter(name, *limits, backend=self.backend)
+            return self.limiters[name]
+
+    def stats(self):
+        with self.lock:
+            limiters = dict(self.limiters)
+        return {name: limiter.stats() for name, limiter in limiters.items()}
+
+rate_limiters = RateLimiterRegistry()
@@ -0,0 +1,157 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict, deque
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# At most this many code executions run at the same time across all sessions
+MAX_CONCURRENT_EXECUTIONS = int(os.environ.get('ALFRED_MAX_CONCURRENT_EXECUTIONS', os.cpu_count() or 2))
+
+# Further executions wait in a queue of this size; beyond it requests get a 429
+MAX_QUEUED_EXECUTIONS = int(os.environ.get('ALFRED_MAX_QUEUED_EXECUTIONS', 50))
+
+
+class QueueFullError(Exception):
+    """Raised when the execution queue is full."""
+    def __init__(self, retry_after):
+        super().__init__("Too many code executions are queued. Please try again later.")
+        self.retry_after = retry_after
+
+###############################################################################
+# Global execution scheduler with admission control
+###############################################################################
+class ExecutionScheduler:
+    """
+    Admits code executions from all sessions into a bounded number of slots.
+
+    Waiting executions are kept in one queue per session and dispatched
+    round-robin across sessions, so that one user queueing many executions
+    cannot starve the others. A session never occupies more than one slot since
+    its cells run one at a time in its kernel anyway.
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT_EXECUTIONS, max_queued=MAX_QUEUED_EXECUTIONS):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queues = OrderedDict()         # session_id -> deque of (execution_id, fn, submit time)
+        self.running_sessions = set()
+        self.condition = threading.Condition()
+        self.dispatcher = None
+
+    def submit(self, session_id, execution_id, fn):
+        """
+        Queue fn() to run once a slot is free.
+
+        Raises:
+            QueueFullError: if max_queued executions are already waiting
+        """
+        with self.condition:
+            if self.queued_count() >= self.max_queued:
+                metrics.increment('scheduler.rejected')
+                raise QueueFullError(self.retry_after())
+
+            self.queues.setdefault(session_id, deque()).append((execution_id, fn, time.time()))
+            metrics.increment('scheduler.submitted')
+            self._start_dispatcher()
+            self.condition.notify_all()
+
+    def cancel(self, execution_id):
+        """Remove a queued execution. Returns False if it is not queued (any more)."""
+        with self.condition:
+            for session_id, queue in self.queues.items():
+                for job in queue:
+                    if job[0] == execution_id:
+                        queue.remove(job)
+                        if not queue:
+                            del self.queues[session_id]
+                        return True
+        return False
+
+    def position(self, execution_id):
+        """1-based position of a queued execution in dispatch order, or None."""
+        with self.condition:
+            for position, (queued_id, _) in enumerate(self._dispatch_order(), start=1):
+                if queued_id == execution_id:
+                    return position
+        return None
+
+    def queued_count(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def retry_after(self):
+        """Rough number of seconds until a queue slot frees up."""
+        durations = metrics.get_metrics()["timings"].get('scheduler.run_seconds', {})
+        mean_duration = durations.get("mean") or 10.0
+        return max(1, int(mean_duration * max(1, self.queued_count()) / self.max_concurrent))
+
+    def stats(self):
+        with self.condition:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "running": len(self.running_sessions),
+                "queued": self.queued_count(),
+                "max_queued": self.max_queued,
+            }
+
+    def _dispatch_order(self):
+        """Simulate round-robin dispatch over the per-session queues."""
+        queues = [(session_id, list(queue)) for session_id, queue in self.queues.items()]
+        # Sessions with a running execution are skipped until it finishes
+        queues.sort(key=lambda item: item[0] in self.running_sessions)
+        order = []
+        round_index = 0
+        while any(round_index < len(queue) for _, queue in queues):
+            for _, queue in queues:
+                if round_index < len(queue):
+                    order.append((queue[round_index][0], queue[round_index][1]))
+            round_index += 1
+        return order
+
+    def _next_job(self):
+        """Pop the next job round-robin, skipping sessions that already have a running job."""
+        for session_id in list(self.queues):
+            if session_id in self.running_sessions:
+                continue
+            queue = self.queues.pop(session_id)
+            job = queue.popleft()
+            if queue:
+                self.queues[session_id] = queue       # re-inserted at the end
+            return session_id, job
+        return None
+
+    def _start_dispatcher(self):
+        if self.dispatcher is None:
+            self.dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+            self.dispatcher.start()
+
+    def _dispatch_loop(self):
+        while True:
+            with self.condition:
+                next_job = None
+                while next_job is None:
+                    if len(self.running_sessions) < self.max_concurrent:
+                        next_job = self._next_job()
+                    if next_job is None:
+                        self.condition.wait()
+                session_id, (execution_id, fn, submitted) = next_job
+                self.running_sessions.add(session_id)
+
+            metrics.observe('scheduler.wait_seconds', time.time() - submitted)
+            thread = threading.Thread(target=self._run, args=(session_id, execution_id, fn), daemon=True)
+            thread.start()
+
+    def _run(self, session_id, execution_id, fn):
+        started = time.time()
+        try:
+            fn()
+        except Exception as e:
+            logger.error(f"Scheduled execution {execution_id} failed: {e}")
+        finally:
+            metrics.observe('scheduler.run_seconds', time.time() - started)
+            with self.condition:
+                self.running_sessions.discard(session_id)
+                self.condition.notify_all()
+
+execution_scheduler = ExecutionScheduler()
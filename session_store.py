@@ -0,0 +1,279 @@
+import os
+import re
+import sys
+import time
+import threading
+import logging
+from collections import OrderedDict
+import dill
+import numpy as np
+import pandas as pd
+from kernel import *
+from shared_arrays import *
+from state_backend import *
+from figure_store import *
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# At most this many sessions are kept in memory; the least recently used ones
+# beyond that are spilled to disk.
+MAX_SESSIONS = int(os.environ.get('ALFRED_MAX_SESSIONS', 100))
+
+# Sessions that have not been used for this many seconds are spilled to disk
+SESSION_IDLE_TTL = float(os.environ.get('ALFRED_SESSION_IDLE_TTL', 3600))
+
+# Approximate memory (bytes) all in-memory sessions may use together
+SESSION_MEMORY_BUDGET = int(os.environ.get('ALFRED_SESSION_MEMORY_BUDGET', 4 * 1024**3))
+
+# Where spilled sessions are written, and how long they are kept there
+SESSION_SPILL_DIR = os.environ.get('ALFRED_SESSION_SPILL_DIR', 'sessions')
+SESSION_SPILL_RETENTION = float(os.environ.get('ALFRED_SESSION_SPILL_RETENTION', 7 * 24 * 3600))
+
+# Completed execution results are dropped this many seconds after they finished
+EXECUTION_RESULT_TTL = 3600.0
+
+# Sessions used in the last few seconds are never evicted, since a request may
+# still be working with them.
+MIN_EVICTION_IDLE = 30.0
+JANITOR_INTERVAL = 60.0
+FIGURE_SWEEP_INTERVAL = 3600.0
+
+_SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+###############################################################################
+# Memory estimate of a session
+###############################################################################
+def estimate_value_size(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=False).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=False))
+    return sys.getsizeof(value)
+
+def estimate_state_size(state):
+    """Rough number of bytes held by a session: its variables, conversation and rendered prompt."""
+    size = sum(estimate_value_size(value) for value in state.analysis_namespace.values())
+    for entry in state.conversation_history:
+        content = entry.get("content", "")
+        size += len(content) if isinstance(content, str) else sys.getsizeof(content)
+    if state.prompt_cache is not None:
+        size += state.prompt_cache.estimate_size()
+    return size
+
+def history_figures(state):
+    """Hashes of the stored figures a session's conversation shows."""
+    hashes = set()
+    for entry in list(state.conversation_history):
+        if entry.get("role") == "figure":
+            figure_hash = figure_hash_from_url(entry.get("content", {}).get("image_url", {}).get("url"))
+            if figure_hash is not None:
+                hashes.add(figure_hash)
+    return hashes
+
+###############################################################################
+# Bounded session store with spilling to disk
+###############################################################################
+class SessionStore:
+    """
+    Holds the AppState of each session in memory, up to MAX_SESSIONS sessions
+    and SESSION_MEMORY_BUDGET bytes. Sessions are evicted least recently used
+    first, or once idle for SESSION_IDLE_TTL. Evicted sessions are pickled to
+    SESSION_SPILL_DIR (see AppState.__getstate__) and restored on their next
+    request. Sessions with a queued or running execution or LLM request are
+    never evicted.
+
+    A janitor thread enforces the limits and also drops finished execution
+    results, and kernels and figures that no session refers to any more.
+
+    With a shared state backend, states are attached to it and synced on every
+    access. Only the worker owning a session spills it; other workers hold
+    nothing that is not in the backend already.
+    """
+    def __init__(self, factory, backend=state_backend, max_sessions=MAX_SESSIONS, idle_ttl=SESSION_IDLE_TTL,
+                 memory_budget=SESSION_MEMORY_BUDGET, spill_dir=SESSION_SPILL_DIR):
+        self.factory = factory
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.states = OrderedDict()         # session_id -> AppState, least recently used first
+        self.last_used = {}
+        self.lock = threading.RLock()
+        self.janitor = None
+        self.figures_swept = 0.0
+
+    def get(self, session_id):
+        """Fetch the state of a session (restoring it from disk if it was spilled), or create it."""
+        self._start_janitor()
+        with self.lock:
+            state = self.states.get(session_id)
+            if state is None:
+                state = self._restore(session_id) or self.factory()
+                state.attach(self.backend, session_id)
+                self.states[session_id] = state
+            self.states.move_to_end(session_id)
+            self.last_used[session_id] = time.time()
+        state.sync()
+        return state
+
+    def find(self, session_id):
+        """The in-memory state of a session, or None."""
+        with self.lock:
+            return self.states.get(session_id)
+
+    def __contains__(self, session_id):
+        with self.lock:
+            return session_id in self.states or os.path.exists(self._spill_path(session_id))
+
+    def __len__(self):
+        with self.lock:
+            return len(self.states)
+
+    def evict(self, session_id):
+        """Spill a session to disk and free its memory, kernel and shared memory segments."""
+        started = time.time()
+        # Hold the lock while spilling, so a concurrent request for the session
+        # waits and then restores it from disk
+        with self.lock:
+            state = self.states.pop(session_id, None)
+            self.last_used.pop(session_id, None)
+            if state is None:
+                return
+            if ownership.is_owner(session_id):
+                self._spill(session_id, state)
+
+        ownership.release(session_id)
+        shutdown_kernel(state)
+        release_shared_values(list(state.analysis_namespace.values()), {})
+        metrics.increment('sessions.evicted')
+        metrics.observe('sessions.spill_seconds', time.time() - started)
+        logger.info(f"Evicted session {session_id}")
+
+    def stats(self):
+        with self.lock:
+            states = list(self.states.values())
+        return {
+            "in_memory": len(states),
+            "max_sessions": self.max_sessions,
+            "estimated_bytes": sum(estimate_state_size(state) for state in states),
+            "memory_budget": self.memory_budget,
+        }
+
+    def collect(self):
+        """Run one janitor pass."""
+        now = time.time()
+        with self.lock:
+            items = list(self.states.items())
+
+        for session_id, state in items:
+            clean_execution_entries(state, now)
+
+        # Idle sessions, then the least recently used ones while over a limit
+        sizes = {session_id: estimate_state_size(state) for session_id, state in items}
+        count, total = len(items), sum(sizes.values())
+        for session_id, state in items:
+            if not self._evictable(session_id, state, now):
+                continue
+            idle = now - self.last_used.get(session_id, now) > self.idle_ttl
+            if idle or count > self.max_sessions or total > self.memory_budget:
+                self.evict(session_id)
+                count, total = count - 1, total - sizes[session_id]
+
+        with self.lock:
+            states = list(self.states.values())
+        live_kernels = {state.kernel for state in states if state.kernel is not None}
+        shutdown_orphaned_kernels(live_kernels)
+        live_paths = set()
+        for state in states:
+            for value in list(state.analysis_namespace.values()):
+                live_paths |= shared_paths(value)
+        sweep_orphaned_segments(live_paths)
+        self._remove_old_spills(now)
+        if now - self.figures_swept > FIGURE_SWEEP_INTERVAL:
+            self.figures_swept = now
+            sweep_old_figures(set().union(*(history_figures(state) for state in states)))
+
+    def _evictable(self, session_id, state, now):
+        if state.active_executions or state.llm_jobs:
+            return False
+        return now - self.last_used.get(session_id, now) > MIN_EVICTION_IDLE
+
+    def _spill(self, session_id, state):
+        try:
+            path = self._spill_path(session_id)
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(f"{path}.tmp", 'wb') as f:
+                dill.dump(state, f)
+            os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            logger.error(f"Could not spill session {session_id} to disk: {e}")
+
+    def _restore(self, session_id):
+        path = self._spill_path(session_id)
+        if not os.path.exists(path):
+            return None
+        # The namespace on disk is only valid if no other worker has taken over the session
+        if ownership.claim(session_id) != ownership.worker_id:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                state = dill.load(f)
+            os.remove(path)
+        except Exception as e:
+            logger.error(f"Could not restore session {session_id} from disk: {e}")
+            return None
+        metrics.increment('sessions.restored')
+        logger.info(f"Restored session {session_id} from disk")
+        return state
+
+    def _spill_path(self, session_id):
+        if not _SESSION_ID_PATTERN.match(session_id):
+            session_id = "invalid"
+        return os.path.join(self.spill_dir, f"{session_id}.pkl")
+
+    def _remove_old_spills(self, now):
+        if not os.path.isdir(self.spill_dir):
+            return
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if now - os.path.getmtime(path) > SESSION_SPILL_RETENTION:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def _start_janitor(self):
+        if self.janitor is None:
+            with self.lock:
+                if self.janitor is None:
+                    self.janitor = threading.Thread(target=self._janitor_loop, daemon=True)
+                    self.janitor.start()
+
+    def _janitor_loop(self):
+        while True:
+            time.sleep(JANITOR_INTERVAL)
+            try:
+                self.collect()
+            except Exception as e:
+                logger.error(f"Error in session janitor: {e}")
+
+def clean_execution_entries(state, now):
+    """Drop execution results, streams and executions that are finished or orphaned."""
+    for execution_id, stream in list(state.execution_streams.items()):
+        result = state.execution_results.get(execution_id)
+        if stream.closed and now - stream.updated > EXECUTION_RESULT_TTL:
+            state.execution_streams.pop(execution_id, None)
+            if result is not None and result.get('complete'):
+                state.execution_results.pop(execution_id, None)
+
+    for execution_id, execution in list(state.active_executions.items()):
+        kernel = execution.get('kernel')
+        result = state.execution_results.get(execution_id)
+        finished = result is None or result.get('complete')
+        if finished and (kernel is None or not kernel.busy):
+            state.active_executions.pop(execution_id, None)
@@ -0,0 +1,308 @@
+import os
+import time
+import uuid
+import tempfile
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('alfred')
+
+# Arrays (and DataFrames) at least this large are moved into shared memory and
+# cross process boundaries as handles instead of being pickled.
+SHARED_ARRAY_THRESHOLD = int(os.environ.get('ALFRED_SHARED_ARRAY_THRESHOLD', 16 * 1024 * 1024))
+
+# Segments are memory-mapped files. /dev/shm is RAM-backed on Linux (and in Docker,
+# where it is only 64 MB unless the container sets shm_size).
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+SEGMENT_PREFIX = 'alfred_'
+
+# Segments are named alfred_<owner pid>_<id>, where the owner is the web worker
+# whose sessions use them (also for segments its kernels create). Each worker
+# only sweeps its own segments, and those of workers that have exited.
+_segment_owner = None
+
+# Where segments go when /dev/shm is full: a disk-backed directory, still shared
+# between processes through the page cache. Empty keeps such arrays unshared.
+SHARED_DISK_DIR = os.environ.get('ALFRED_SHARED_DISK_DIR', os.path.join(tempfile.gettempdir(), 'alfred_segments'))
+
+SEGMENT_DIRS = [SHM_DIR] + ([SHARED_DISK_DIR] if SHARED_DISK_DIR and SHARED_DISK_DIR != SHM_DIR else [])
+
+# Space left free in a segment directory for everything else using it
+SEGMENT_HEADROOM = int(os.environ.get('ALFRED_SHARED_HEADROOM', 64 * 1024 * 1024))
+
+
+class SharedSpaceError(OSError):
+    """No segment directory has room for an array; it stays unshared."""
+
+
+###############################################################################
+# Shared memory segments
+###############################################################################
+def is_segment_path(path):
+    return (isinstance(path, str) and os.path.dirname(path) in SEGMENT_DIRS
+            and os.path.basename(path).startswith(SEGMENT_PREFIX))
+
+def set_segment_owner(pid):
+    """Make segments created by this process (a kernel) belong to web worker pid."""
+    global _segment_owner
+    _segment_owner = pid
+
+def segment_owner(path=None):
+    """PID of the worker owning a segment (or this process's segments), or None if unknown."""
+    if path is None:
+        return _segment_owner or os.getpid()
+    owner = os.path.basename(path)[len(SEGMENT_PREFIX):].split('_', 1)[0]
+    return int(owner) if owner.isdigit() else None
+
+def free_bytes(directory):
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+def allocate_segment(nbytes):
+    """
+    Create a segment file of nbytes in the first directory with room for it.
+    The space is reserved up front, so that running out of it raises here
+    rather than killing the process with SIGBUS when the pages are touched.
+
+    Raises:
+        SharedSpaceError: if no directory has room
+    """
+    for directory in SEGMENT_DIRS:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            if free_bytes(directory) < nbytes + SEGMENT_HEADROOM:
+                continue
+        except OSError:
+            continue
+        path = os.path.join(directory, f"{SEGMENT_PREFIX}{segment_owner()}_{uuid.uuid4().hex}")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, max(nbytes, 1))
+            else:
+                os.ftruncate(fd, max(nbytes, 1))
+        except OSError:
+            # Another process took the space in the meantime
+            os.close(fd)
+            release_segment(path)
+            continue
+        os.close(fd)
+        if directory != SHM_DIR:
+            logger.warning(f"Shared memory is full, sharing {nbytes} bytes through {directory} instead")
+        return path
+    raise SharedSpaceError(f"No room to share {nbytes} bytes in {', '.join(SEGMENT_DIRS)}")
+
+def backing_segment(arr):
+    """
+    Find the shared memory segment an array is a view of.
+
+    Returns:
+        tuple: (path, byte offset) or None if the array is not a C-contiguous
+               view of an Alfred segment.
+    """
+    if not isinstance(arr, np.ndarray) or not arr.flags.c_contiguous:
+        return None
+
+    root = arr
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if not isinstance(root, np.memmap) or not is_segment_path(root.filename):
+        return None
+
+    return root.filename, arr.ctypes.data - root.ctypes.data
+
+def share_array(arr):
+    """
+    Copy an array into a new shared memory segment and return the mapped copy.
+
+    Raises:
+        SharedSpaceError: if there is no room for it (see allocate_segment)
+    """
+    path = allocate_segment(arr.nbytes)
+    shared = np.memmap(path, dtype=arr.dtype, mode='r+', shape=arr.shape)
+    shared[...] = arr
+    return shared
+
+def release_segment(path):
+    """Unlink a segment. Processes that still map it keep their (now anonymous) copy."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+###############################################################################
+# Lightweight handles that are pickled instead of the data
+###############################################################################
+class SharedArrayHandle:
+    """Picklable reference to an array living in a shared memory segment."""
+    def __init__(self, path, offset, dtype, shape, copied=False):
+        self.path = path
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+        self.copied = copied            # True if the data had to be copied into the segment
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['copied'] = False
+        return state
+
+    @classmethod
+    def from_array(cls, arr):
+        segment = backing_segment(arr)
+        copied = False
+        if segment is None or not os.path.exists(segment[0]):
+            arr = share_array(arr)
+            segment = (arr.filename, 0)
+            copied = True
+        return cls(segment[0], segment[1], arr.dtype, arr.shape, copied)
+
+    def paths(self):
+        return {self.path}
+
+    def materialize(self):
+        segment = np.memmap(self.path, dtype=np.uint8, mode='r+')
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=segment, offset=self.offset)
+
+class SharedFrameHandle:
+    """
+    Picklable DataFrame whose numeric columns live in shared memory segments.
+    Other columns, the index and the column labels are pickled as usual.
+    """
+    def __init__(self, df):
+        self.columns = df.columns
+        self.index = df.index
+        self.data = []
+        self.copied = False
+
+        try:
+            for i in range(df.shape[1]):
+                column = df.iloc[:, i]
+                if isinstance(column.dtype, np.dtype) and not column.dtype.hasobject:
+                    handle = SharedArrayHandle.from_array(column.to_numpy())
+                    self.copied = self.copied or handle.copied
+                    self.data.append(handle)
+                else:
+                    self.data.append(column.reset_index(drop=True))
+        except SharedSpaceError:
+            # Don't leave the columns copied so far behind
+            for item in self.data:
+                if isinstance(item, SharedArrayHandle) and item.copied:
+                    release_segment(item.path)
+            raise
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['copied'] = False
+        return state
+
+    def paths(self):
+        return {item.path for item in self.data if isinstance(item, SharedArrayHandle)}
+
+    def materialize(self):
+        data = {i: item.materialize() if isinstance(item, SharedArrayHandle) else item
+                for i, item in enumerate(self.data)}
+        df = pd.DataFrame(data, copy=False)
+        df.columns = self.columns
+        df.index = self.index
+        return df
+
+###############################################################################
+# Conversion of namespace values
+###############################################################################
+def export_shared(value, threshold=SHARED_ARRAY_THRESHOLD):
+    """
+    Replace a large array or DataFrame by a handle to shared memory. The data is
+    only copied if it does not already live in a segment. Other values, and
+    values there is no room to share, are returned unchanged.
+    """
+    try:
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject and value.nbytes >= threshold:
+            return SharedArrayHandle.from_array(value)
+        if isinstance(value, pd.DataFrame) and value.shape[1] > 0 \
+                and value.memory_usage(index=False, deep=False).sum() >= threshold:
+            return SharedFrameHandle(value)
+    except SharedSpaceError as e:
+        logger.warning(f"{e}; the value is pickled instead")
+    return value
+
+def import_shared(value):
+    """Inverse of export_shared: map handles back to arrays/DataFrames."""
+    if isinstance(value, (SharedArrayHandle, SharedFrameHandle)):
+        return value.materialize()
+    return value
+
+def to_shared(value, threshold=SHARED_ARRAY_THRESHOLD):
+    """Return a shared memory backed equivalent of value (used for uploaded data)."""
+    exported = export_shared(value, threshold)
+    return import_shared(exported)
+
+def shared_paths(value):
+    """Paths of the segments a namespace value is backed by."""
+    if isinstance(value, np.ndarray):
+        segment = backing_segment(value)
+        return {segment[0]} if segment else set()
+    if isinstance(value, pd.DataFrame):
+        paths = set()
+        for i in range(value.shape[1]):
+            column = value.iloc[:, i]
+            if isinstance(column.dtype, np.dtype) and not column.dtype.hasobject:
+                paths |= shared_paths(column.to_numpy())
+        return paths
+    return set()
+
+def release_shared_values(old_values, namespace):
+    """
+    Unlink the segments of values that were removed from or replaced in the
+    namespace, unless another variable of the namespace still uses them.
+    """
+    released = set()
+    for value in old_values:
+        released |= shared_paths(value)
+    if not released:
+        return
+
+    for value in namespace.values():
+        released -= shared_paths(value)
+    for path in released:
+        release_segment(path)
+    if released:
+        logger.info(f"Released {len(released)} shared memory segment(s)")
+
+def sweep_orphaned_segments(live_paths, min_age=3600.0):
+    """
+    Unlink segments older than min_age seconds that no session references:
+    segments of this worker not in live_paths (the ones its sessions use),
+    and segments of workers that have exited.
+    """
+    now = time.time()
+    removed = 0
+    for directory in SEGMENT_DIRS:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(directory, name)
+            if not name.startswith(SEGMENT_PREFIX) or path in live_paths:
+                continue
+            owner = segment_owner(path)
+            if owner is not None and owner != os.getpid() and _process_alive(owner):
+                continue
+            try:
+                if now - os.path.getmtime(path) > min_age:
+                    release_segment(path)
+                    removed += 1
+            except OSError:
+                continue
+    return removed
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
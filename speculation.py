@@ -0,0 +1,61 @@
+import os
+import logging
+import metrics
+
+logger = logging.getLogger('alfred')
+
+# Opt-in: after a text analysis, generate the code for a plain "Analyse" in the
+# background, so that it is ready when the user asks for it
+SPECULATIVE_CODE = os.environ.get('ALFRED_SPECULATIVE_CODE', '0').lower() in ('1', 'true', 'yes')
+
+# What the user sends when asking for code without feedback
+ANALYSE_COMMAND = "Analyse"
+
+
+###############################################################################
+# Code responses generated ahead of the request for them
+###############################################################################
+class Speculation:
+    """
+    A code request run ahead of time as the LLM job job_id. Its response is
+    only used if the session still matches key (see speculation_key) when the
+    user asks for code; otherwise it is discarded.
+
+    Metrics: speculation.started, speculation.hits (used), speculation.misses
+    (discarded because the session changed) and speculation.failed (used, but
+    the prefetched request failed and was repeated).
+    """
+    def __init__(self, key, job_id):
+        self.key = key
+        self.job_id = job_id
+
+def speculation_key(state):
+    """Everything a speculative code response depends on."""
+    history = state.conversation_history
+    return (getattr(history, 'epoch', None), len(history), state.iteration_count, state.model, state.api_key)
+
+def analyse_entry(state):
+    """History entry of a plain "Analyse" request."""
+    return {
+        "role": "user",
+        "type": "text",
+        "iteration": state.iteration_count,
+        "content": ANALYSE_COMMAND
+    }
+
+class HistorySnapshot(list):
+    """
+    Copy of a conversation history with hypothetical entries appended. It has
+    the history's epoch, so that a copy of the session's PromptCache only
+    renders the new entries.
+    """
+    def __init__(self, history, *entries):
+        super().__init__(history)
+        self.extend(entries)
+        self.epoch = getattr(history, 'epoch', None)
+
+def speculation_stats():
+    return {
+        "enabled": SPECULATIVE_CODE,
+        "hit_rate": metrics.ratio('speculation.hits', 'speculation.started'),
+    }
@@ -0,0 +1,413 @@
+import os
+import time
+import uuid
+import pickle
+import socket
+import sqlite3
+import threading
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger('alfred')
+
+# Where session state shared between web workers is kept:
+#   memory                    - in this process only (a single gunicorn worker)
+#   sqlite:///alfred_state.db - a SQLite file (sqlite:////abs/path.db for an
+#                               absolute path), for several workers on one host
+#   redis://host:port/db      - a Redis (compatible) server
+STATE_BACKEND_URL = os.environ.get('ALFRED_STATE_BACKEND', 'memory')
+
+# API keys entered in the browser are kept in a shared backend so that every
+# worker can use them. With 0, they stay in the worker they were entered in and
+# the other workers fall back to the keys in the environment.
+SHARE_API_KEYS = os.environ.get('ALFRED_SHARE_API_KEYS', '1').lower() in ('1', 'true', 'yes')
+
+# A worker owns the namespace and kernel of a session for as long as it keeps
+# renewing its claim. Claims of workers that died expire after OWNER_TTL seconds.
+OWNER_TTL = 30.0
+OWNER_HEARTBEAT_INTERVAL = 10.0
+COMMAND_POLL_INTERVAL = 0.2
+# How long to wait for the owner's reply to a command (see OwnershipRegistry.request)
+COMMAND_REPLY_TIMEOUT = 10.0
+
+def worker_id():
+    """Identifies this web worker process."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+###############################################################################
+# Storage primitives: expiring values and append-only lists
+###############################################################################
+class StateBackend:
+    """
+    Minimal storage interface the shared session state is built on. Values
+    are arbitrary picklable objects. shared is False if the backend is only
+    visible to the current process.
+    """
+    shared = True
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def set_if_absent(self, key, value, ttl=None):
+        """Set key only if it does not exist. Returns True if it was set."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def append(self, key, value, ttl=None):
+        """Append value to the list at key. Returns the new length of the list."""
+        raise NotImplementedError
+
+    def read_list(self, key, start=0):
+        """Items of the list at key from index start on."""
+        raise NotImplementedError
+
+    def pop_list(self, key):
+        """Atomically remove and return all items of the list at key."""
+        raise NotImplementedError
+
+class MemoryBackend(StateBackend):
+    """Process-local backend, used when there is a single web worker."""
+    shared = False
+
+    def __init__(self):
+        self.values = {}
+        self.lists = defaultdict(list)
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def _expired(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires < time.time():
+            self.values.pop(key, None)
+            self.lists.pop(key, None)
+            self.expires.pop(key, None)
+            return True
+        return False
+
+    def _set_ttl(self, key, ttl):
+        if ttl is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = time.time() + ttl
+
+    def get(self, key):
+        with self.lock:
+            self._expired(key)
+            return self.values.get(key)
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.values[key] = value
+            self._set_ttl(key, ttl)
+
+    def set_if_absent(self, key, value, ttl=None):
+        with self.lock:
+            self._expired(key)
+            if key in self.values:
+                return False
+            self.values[key] = value
+            self._set_ttl(key, ttl)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+            self.lists.pop(key, None)
+            self.expires.pop(key, None)
+
+    def append(self, key, value, ttl=None):
+        with self.lock:
+            self._expired(key)
+            self.lists[key].append(value)
+            if ttl is not None:
+                self._set_ttl(key, ttl)
+            return len(self.lists[key])
+
+    def read_list(self, key, start=0):
+        with self.lock:
+            self._expired(key)
+            return list(self.lists.get(key, [])[start:])
+
+    def pop_list(self, key):
+        with self.lock:
+            return self.lists.pop(key, [])
+
+class SQLiteBackend(StateBackend):
+    """Backend in a SQLite file that all workers on a host can open."""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self._write() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS lists (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                       "key TEXT, value BLOB, expires REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS lists_key ON lists (key, seq)")
+
+    def _connect(self):
+        """Connection of the current thread (in autocommit mode)."""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return db
+
+    def _write(self):
+        return _Transaction(self._connect())
+
+    def get(self, key):
+        row = self._connect().execute("SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                                      (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        with self._write() as db:
+            db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                       (key, pickle.dumps(value), _expiry(ttl)))
+
+    def set_if_absent(self, key, value, ttl=None):
+        with self._write() as db:
+            db.execute("DELETE FROM kv WHERE key = ? AND expires <= ?", (key, time.time()))
+            cursor = db.execute("INSERT OR IGNORE INTO kv VALUES (?, ?, ?)",
+                                (key, pickle.dumps(value), _expiry(ttl)))
+            return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self._write() as db:
+            db.execute("DELETE FROM kv WHERE key = ?", (key,))
+            db.execute("DELETE FROM lists WHERE key = ?", (key,))
+
+    def append(self, key, value, ttl=None):
+        with self._write() as db:
+            db.execute("DELETE FROM lists WHERE key = ? AND expires <= ?", (key, time.time()))
+            db.execute("INSERT INTO lists (key, value, expires) VALUES (?, ?, ?)",
+                       (key, pickle.dumps(value), _expiry(ttl)))
+            if ttl is not None:
+                db.execute("UPDATE lists SET expires = ? WHERE key = ?", (_expiry(ttl), key))
+            return db.execute("SELECT COUNT(*) FROM lists WHERE key = ?", (key,)).fetchone()[0]
+
+    def read_list(self, key, start=0):
+        rows = self._connect().execute("SELECT value FROM lists WHERE key = ? AND (expires IS NULL OR expires > ?) "
+                                       "ORDER BY seq LIMIT -1 OFFSET ?", (key, time.time(), start)).fetchall()
+        return [pickle.loads(row[0]) for row in rows]
+
+    def pop_list(self, key):
+        # Cheap check first: this is polled frequently and usually empty
+        if self._connect().execute("SELECT 1 FROM lists WHERE key = ? LIMIT 1", (key,)).fetchone() is None:
+            return []
+        with self._write() as db:
+            rows = db.execute("SELECT value FROM lists WHERE key = ? ORDER BY seq", (key,)).fetchall()
+            db.execute("DELETE FROM lists WHERE key = ?", (key,))
+        return [pickle.loads(row[0]) for row in rows]
+
+class _Transaction:
+    """Runs the statements of a with-block in one immediate SQLite transaction."""
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+def _expiry(ttl):
+    return None if ttl is None else time.time() + ttl
+
+class RedisBackend(StateBackend):
+    """
+    Backend on a Redis server. Only plain GET/SET/DEL/RPUSH/LRANGE/EXPIRE and
+    MULTI are used, so any Redis compatible server (or stand-in) will do.
+    """
+    def __init__(self, url, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError("The redis package is required for ALFRED_STATE_BACKEND=redis://...")
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    def get(self, key):
+        value = self.client.get(key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, pickle.dumps(value), px=_milliseconds(ttl))
+
+    def set_if_absent(self, key, value, ttl=None):
+        return bool(self.client.set(key, pickle.dumps(value), px=_milliseconds(ttl), nx=True))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def append(self, key, value, ttl=None):
+        pipe = self.client.pipeline()
+        pipe.rpush(key, pickle.dumps(value))
+        if ttl is not None:
+            pipe.pexpire(key, _milliseconds(ttl))
+        return pipe.execute()[0]
+
+    def read_list(self, key, start=0):
+        return [pickle.loads(value) for value in self.client.lrange(key, start, -1)]
+
+    def pop_list(self, key):
+        pipe = self.client.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        values, _ = pipe.execute()
+        return [pickle.loads(value) for value in values]
+
+def _milliseconds(ttl):
+    return None if ttl is None else int(ttl * 1000)
+
+def create_backend(url=STATE_BACKEND_URL):
+    """Create the backend configured by a URL (see STATE_BACKEND_URL)."""
+    if url == 'memory':
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):] or 'alfred_state.db')
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    raise ValueError(f"Unknown state backend: {url}")
+
+state_backend = create_backend()
+
+###############################################################################
+# Namespace ownership: each session's kernel lives in exactly one worker
+###############################################################################
+class OwnershipRegistry:
+    """
+    Pins the namespace (and kernel) of a session to the worker that claimed
+    it. Other workers forward namespace operations to the owner as commands,
+    which the owner's listener thread passes to the registered handlers.
+    Claims are renewed on a thread of their own, so that slow commands (e.g.
+    processing an upload) cannot let them expire.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.owned = set()
+        self.handlers = {}              # command name -> fn(session_id, *args)
+        self.lock = threading.Lock()
+        self.threads = None
+
+    @property
+    def worker_id(self):
+        return worker_id()
+
+    def owner(self, session_id):
+        if not self.backend.shared:
+            return self.worker_id
+        return self.backend.get(f"owner:{session_id}")
+
+    def is_owner(self, session_id):
+        return self.owner(session_id) == self.worker_id
+
+    def claim(self, session_id, force=False):
+        """
+        Make this worker the owner of a session, unless another live worker
+        owns it (or force is set). Returns the owner.
+        """
+        if not self.backend.shared:
+            return self.worker_id
+
+        key = f"owner:{session_id}"
+        previous = self.backend.get(key)
+        if previous == self.worker_id:
+            return self.worker_id
+        if force:
+            self.backend.set(key, self.worker_id, ttl=OWNER_TTL)
+            if previous is not None:
+                self.send(previous, "release", session_id)
+        elif not self.backend.set_if_absent(key, self.worker_id, ttl=OWNER_TTL):
+            return self.backend.get(key)
+
+        with self.lock:
+            self.owned.add(session_id)
+        self._start()
+        logger.info(f"Worker {self.worker_id} now owns session {session_id}")
+        return self.worker_id
+
+    def release(self, session_id):
+        with self.lock:
+            self.owned.discard(session_id)
+        if self.backend.shared and self.backend.get(f"owner:{session_id}") == self.worker_id:
+            self.backend.delete(f"owner:{session_id}")
+
+    def send(self, worker_id, command, session_id, *args):
+        """Queue a command for the worker owning a session."""
+        self.backend.append(f"commands:{worker_id}", (command, session_id, None) + args, ttl=3600)
+
+    def request(self, worker_id, command, session_id, *args, timeout=COMMAND_REPLY_TIMEOUT):
+        """
+        Queue a command and wait for the value its handler returns. Returns
+        None if the worker does not reply within timeout (the command may
+        still run later).
+        """
+        reply_key = f"reply:{uuid.uuid4().hex}"
+        self.backend.append(f"commands:{worker_id}", (command, session_id, reply_key) + args, ttl=3600)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            replies = self.backend.read_list(reply_key)
+            if replies:
+                self.backend.delete(reply_key)
+                return replies[0]
+            time.sleep(COMMAND_POLL_INTERVAL / 2)
+        return None
+
+    def register(self, command, handler):
+        self.handlers[command] = handler
+
+    def _start(self):
+        with self.lock:
+            if self.threads is None:
+                self.threads = [threading.Thread(target=self._heartbeat_loop, daemon=True),
+                                threading.Thread(target=self._command_loop, daemon=True)]
+                for thread in self.threads:
+                    thread.start()
+
+    def _heartbeat_loop(self):
+        while True:
+            with self.lock:
+                owned = list(self.owned)
+            for session_id in owned:
+                key = f"owner:{session_id}"
+                try:
+                    if self.backend.get(key) == self.worker_id:
+                        self.backend.set(key, self.worker_id, ttl=OWNER_TTL)
+                    else:
+                        with self.lock:
+                            self.owned.discard(session_id)
+                except Exception as e:
+                    logger.error(f"Could not renew the claim of worker {self.worker_id} on session {session_id}: {e}")
+            time.sleep(OWNER_HEARTBEAT_INTERVAL)
+
+    def _command_loop(self):
+        while True:
+            try:
+                commands = self.backend.pop_list(f"commands:{self.worker_id}")
+            except Exception as e:
+                logger.error(f"Could not read commands for worker {self.worker_id}: {e}")
+                commands = []
+            for command, session_id, reply_key, *args in commands:
+                handler = self.handlers.get(command)
+                if handler is None:
+                    logger.warning(f"Unknown command for worker {self.worker_id}: {command}")
+                    continue
+                try:
+                    reply = handler(session_id, *args)
+                except Exception as e:
+                    logger.error(f"Error handling command {command} for session {session_id}: {e}")
+                    continue
+                if reply_key is not None:
+                    self.backend.append(reply_key, reply, ttl=COMMAND_REPLY_TIMEOUT * 6)
+            time.sleep(COMMAND_POLL_INTERVAL)
+
+ownership = OwnershipRegistry(state_backend)
@@ -0,0 +1,124 @@
+import json
+import time
+import threading
+
+# Seconds between keep-alive comments on idle server-sent event streams
+KEEPALIVE_INTERVAL = 15.0
+
+# Upper limit for the wait parameter of long-polling requests
+MAX_LONG_POLL_WAIT = 30.0
+
+# Events written to a shared state backend expire after this many seconds
+STREAM_TTL = 3600.0
+
+# How often streams of other web workers are read from the backend
+REMOTE_POLL_INTERVAL = 0.25
+
+
+###############################################################################
+# Buffer of events that can be replayed to (re)connecting SSE clients
+###############################################################################
+class EventStream:
+    """
+    Append-only list of (event, data) pairs published by a background job and
+    consumed by any number of server-sent event responses. Clients can resume
+    from an event index (the SSE Last-Event-ID).
+
+    With a shared state backend, events are also written to the backend under
+    key, so that other web workers can serve the stream (see RemoteEventStream).
+    """
+    def __init__(self, backend=None, key=None):
+        self.events = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.updated = time.time()
+        self.backend = backend if backend is not None and backend.shared else None
+        self.key = key
+
+    def publish(self, event, data):
+        with self.condition:
+            self.events.append((event, data))
+            self.updated = time.time()
+            self.condition.notify_all()
+        if self.backend is not None:
+            self.backend.append(self.key, (event, data), ttl=STREAM_TTL)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.updated = time.time()
+            self.condition.notify_all()
+        if self.backend is not None:
+            self.backend.set(f"{self.key}:closed", True, ttl=STREAM_TTL)
+
+    def wait(self, index, timeout):
+        """
+        Wait until there are events after index or the stream is closed.
+
+        Returns:
+            tuple: (new events, closed flag)
+        """
+        with self.condition:
+            if len(self.events) <= index and not self.closed:
+                self.condition.wait(timeout)
+            return self.events[index:], self.closed
+
+    def wait_closed(self, timeout):
+        """Wait until the stream is closed. Returns the closed flag."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed, timeout)
+            return self.closed
+
+    def iter_sse(self, start=0):
+        """Generate the stream formatted as server-sent events, with keep-alives."""
+        index = start
+        while True:
+            events, closed = self.wait(index, KEEPALIVE_INTERVAL)
+            for event, data in events:
+                index += 1
+                yield format_sse(event, data, event_id=index)
+            if closed and not events:
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+
+class RemoteEventStream(EventStream):
+    """Read-only view of an EventStream published by another web worker."""
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    @property
+    def closed(self):
+        return bool(self.backend.get(f"{self.key}:closed"))
+
+    def wait(self, index, timeout):
+        deadline = time.time() + timeout
+        while True:
+            closed = self.closed
+            events = self.backend.read_list(self.key, index)
+            if events or closed or time.time() >= deadline:
+                return events, closed
+            time.sleep(REMOTE_POLL_INTERVAL)
+
+    def wait_closed(self, timeout):
+        deadline = time.time() + timeout
+        while not self.closed and time.time() < deadline:
+            time.sleep(REMOTE_POLL_INTERVAL)
+        return self.closed
+
+def format_sse(event, data, event_id=None):
+    """Format one server-sent event with a JSON payload."""
+    message = ""
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    message += f"event: {event}\n"
+    message += f"data: {json.dumps(data)}\n\n"
+    return message
+
+def parse_last_event_id(value):
+    """Index to resume a stream from, taken from the Last-Event-ID header."""
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+
+# Small pool and preload, so that kernel workers start quickly
+os.environ.setdefault('ALFRED_KERNEL_PRELOAD', 'numpy')
+os.environ.setdefault('ALFRED_KERNEL_POOL_SIZE', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kernel import ExecutionKernel
+
+# Ignores SIGINT, so that only killing the worker stops the cell
+BLOCKING_CELL = """
+import signal, time
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+print("blocking", flush=True)
+time.sleep(60)
+"""
+
+
+def run_in_thread(kernel, code, namespace, execution_id):
+    started = threading.Event()
+    result = {}
+
+    def on_stream(kind, payload):
+        started.set()
+
+    def run():
+        result.update(kernel.execute(code, namespace, execution_id, timeout=30.0, on_stream=on_stream))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, started, result
+
+
+def test_interrupt_kills_kernel_blocking_sigint():
+    kernel = ExecutionKernel()
+    namespace = {"a": 1}
+    try:
+        thread, started, result = run_in_thread(kernel, BLOCKING_CELL, namespace, "blocked")
+        assert started.wait(60.0)
+
+        kernel.interrupt(grace=0.5)
+        thread.join(10.0)
+        assert not thread.is_alive()
+        assert result["status"] == "cancelled"
+        assert kernel.process is None and kernel.connection is None
+
+        # The next cell runs in a new worker, re-seeded from the namespace mirror
+        result = kernel.execute("b = a + 1", namespace, "after", timeout=60.0)
+        assert result["status"] == "completed"
+        assert namespace["b"] == 2
+    finally:
+        kernel.shutdown()
+
+
+def test_interrupt_stops_cell_honouring_sigint():
+    kernel = ExecutionKernel()
+    try:
+        code = 'import time\nprint("sleeping", flush=True)\ntime.sleep(60)'
+        thread, started, result = run_in_thread(kernel, code, {}, "sleeping")
+        assert started.wait(60.0)
+
+        kernel.interrupt(grace=5.0)
+        thread.join(10.0)
+        assert result["status"] == "cancelled"
+        assert kernel.is_alive()
+    finally:
+        kernel.shutdown()
@@ -7,13 +7,25 @@ import json
 import openai
 import anthropic
 from google import genai
-from google.genai import types
 import re
 import base64
 import logging
 import signal
+import threading
+import time
 import dill
 from prompts import *
+from figure_store import *
+from session_store import *
+from state_backend import *
+from llm_clients import *
+from context_budget import *
+from prompt_caching import *
+from llm_resilience import *
+from rate_limits import *
+from llm_cache import *
+import metrics
+from google.genai import types                  # after the star imports, which bring in the types module
 from werkzeug.utils import secure_filename
 
 # Configure logging
@@ -28,9 +40,139 @@ logger = logging.getLogger('alfred')
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
 ALLOWED_EXTENSIONS = {'csv', 'npy', 'json'}
-user_states = {}
 
 
+###############################################################################
+# Conversation history that clients can follow incrementally
+###############################################################################
+class ConversationHistory(list):
+    """
+    List of conversation entries with a cursor for incremental reads.
+
+    The history is normally only appended to. The cursor "<epoch>:<length>"
+    then identifies everything a client has seen. Any other change starts a
+    new epoch, so clients holding an old cursor re-read the whole history.
+
+    When attached to a shared state backend, appends are written to the backend
+    and sync() pulls in entries that other web workers appended.
+    """
+    # Unpickling appends the entries before __setstate__ runs
+    backend = None
+    key = None
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.epoch = uuid.uuid4().hex[:12]
+        self.backend = None
+        self.key = None
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        return {"epoch": self.epoch}
+
+    def __setstate__(self, state):
+        self.epoch = state["epoch"]
+        self.backend = None
+        self.key = None
+        self.lock = threading.RLock()
+
+    @property
+    def cursor(self):
+        return f"{self.epoch}:{len(self)}"
+
+    def entries_since(self, cursor):
+        """
+        Entries after a cursor.
+
+        Returns:
+            tuple: (entries, reset) where reset is True if the cursor is from
+                   another epoch (or missing) and entries is the full history
+        """
+        epoch, _, length = (cursor or "").partition(":")
+        if epoch != self.epoch or not length.isdigit() or int(length) > len(self):
+            return list(self), True
+        return self[int(length):], False
+
+    def attach(self, backend, session_id, publish=False):
+        """
+        Share the history through a state backend (see state_backend.py).
+        With publish, this history replaces the one in the backend.
+        """
+        if not backend.shared:
+            return
+        self.backend = backend
+        self.key = f"history:{session_id}"
+        if publish:
+            self._publish()
+        else:
+            self.sync()
+
+    def sync(self):
+        """Pull in entries appended by other workers."""
+        if self.backend is None:
+            return
+        with self.lock:
+            epoch = self.backend.get(f"{self.key}:epoch")
+            if epoch is None:
+                self._publish()
+            elif epoch != self.epoch:
+                super().clear()
+                super().extend(self.backend.read_list(f"{self.key}:{epoch}"))
+                self.epoch = epoch
+            else:
+                super().extend(self.backend.read_list(f"{self.key}:{epoch}", len(self)))
+
+    def append(self, entry):
+        if self.backend is None:
+            super().append(entry)
+            return
+        with self.lock:
+            self.backend.append(f"{self.key}:{self.epoch}", entry)
+            self.sync()
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def __iadd__(self, entries):
+        self.extend(entries)
+        return self
+
+    def _publish(self):
+        for entry in self:
+            self.backend.append(f"{self.key}:{self.epoch}", entry)
+        self.backend.set(f"{self.key}:epoch", self.epoch)
+
+    def _new_epoch(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        if self.backend is not None:
+            self._publish()
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._new_epoch()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._new_epoch()
+
+    def insert(self, index, value):
+        super().insert(index, value)
+        self._new_epoch()
+
+    def pop(self, index=-1):
+        value = super().pop(index)
+        self._new_epoch()
+        return value
+
+    def remove(self, value):
+        super().remove(value)
+        self._new_epoch()
+
+    def clear(self):
+        super().clear()
+        self._new_epoch()
+
 ###############################################################################
 # Class to contain the state of the application
 ###############################################################################
@@ -39,16 +181,114 @@ class AppState:
     Centralized container for application state.
     This contains variables that are needed throughout the application but
     are specific to an instance.
+
+    With a shared state backend, the conversation history and the fields in
+    SHARED_FIELDS are shared between web workers. Each field has its own key,
+    and publish() only writes the fields changed since they were last synced,
+    so that it does not undo changes other workers made in the meantime. The
+    analysis namespace and kernel stay in the worker that owns the session
+    (see OwnershipRegistry).
     """
+    SHARED_FIELDS = ('iteration_count', 'api_key', 'model', 'MODEL_NAME') if SHARE_API_KEYS else \
+                    ('iteration_count', 'model', 'MODEL_NAME')
+
     def __init__(self):
-        self.conversation_history = []
+        self.conversation_history = ConversationHistory()
         self.active_executions = {}
         self.execution_results = {}
+        self.execution_streams = {}     # execution_id -> EventStream of live output (see streaming.py)
+        self.llm_jobs = set()           # ids of running LLM requests (see llm_jobs.py)
+        self.prompt_cache = PromptCache()   # history rendered for prompts (see build_llm_prompt)
+        self.speculation = None         # code requested ahead of time (see speculation.py)
         self.iteration_count = 0
         self.analysis_namespace = {}
+        self.kernel = None              # persistent execution kernel (see kernel.py)
         self.api_key = None
         self.model = "gemini"           # default model
         self.MODEL_NAME = "gemini-2.5-pro-exp-03-25"
+        self.session_id = None
+        self.backend = None
+        self.synced = {}                # shared field -> value last read from or written to the backend
+
+    def attach(self, backend, session_id):
+        """Share this state through a state backend."""
+        self.session_id = session_id
+        self.backend = backend if backend.shared else None
+        self.conversation_history.attach(backend, session_id)
+
+    def reset_history(self):
+        """Start a new, empty conversation (replacing the shared one)."""
+        self.conversation_history = ConversationHistory()
+        if self.backend is not None:
+            self.conversation_history.attach(self.backend, self.session_id, publish=True)
+
+    def sync(self):
+        """Pull in changes other workers made to the shared fields and history."""
+        if self.backend is None:
+            return
+        for name in self.SHARED_FIELDS:
+            value = self.backend.get(self._field_key(name))
+            if value is None or self._changed(name):
+                # Not set anywhere yet, or changed here and not yet published
+                self.synced.setdefault(name, getattr(self, name))
+                continue
+            setattr(self, name, value)
+            self.synced[name] = value
+        self.conversation_history.sync()
+
+    def publish(self):
+        """Write the shared fields changed since the last sync to the backend."""
+        if self.backend is None:
+            return
+        for name in self.SHARED_FIELDS:
+            if self._changed(name):
+                value = getattr(self, name)
+                self.backend.set(self._field_key(name), value)
+                self.synced[name] = value
+
+    def _changed(self, name):
+        return name in self.synced and getattr(self, name) != self.synced[name]
+
+    def _field_key(self, name):
+        return f"session:{self.session_id}:{name}"
+
+    def __getstate__(self):
+        """
+        State written when the session is spilled to disk. Kernels and running
+        executions are not kept, and variables that cannot be pickled are dropped.
+        The API key is not written either: after a restore it is read from the
+        shared backend (see SHARE_API_KEYS), or the environment.
+        """
+        state = dict(self.__dict__)
+        state['api_key'] = None
+        state['synced'] = {name: value for name, value in self.synced.items() if name != 'api_key'}
+        state['kernel'] = None
+        state['backend'] = None
+        state['active_executions'] = {}
+        state['execution_results'] = {}
+        state['execution_streams'] = {}
+        state['llm_jobs'] = set()
+        state['prompt_cache'] = None
+        state['speculation'] = None
+
+        namespace = {}
+        for name, value in self.analysis_namespace.items():
+            try:
+                namespace[name] = dill.dumps(value)
+            except Exception as e:
+                logger.warning(f"Variable {name} cannot be saved with the session and is dropped: {e}")
+        state['analysis_namespace'] = namespace
+        return state
+
+    def __setstate__(self, state):
+        state['analysis_namespace'] = {name: dill.loads(blob) for name, blob in state['analysis_namespace'].items()}
+        state['prompt_cache'] = PromptCache()
+        state['speculation'] = None
+        state.setdefault('synced', {})
+        self.__dict__.update(state)
+
+# States of all sessions, bounded in number and memory (see session_store.py)
+user_states = SessionStore(AppState)
 
 ###############################################################################
 # Get state that is specific to the user session
@@ -60,10 +300,8 @@ def get_user_state():
         session['session_id'] = str(uuid.uuid4())
     session_id = session['session_id']
     
-    # If this session does not have a state yet, create one
-    if session_id not in user_states:
-        user_states[session_id] = AppState()
-    return user_states[session_id]
+    # Fetch the state (restored from disk if it was evicted), or create one
+    return user_states.get(session_id)
 
 ###############################################################################
 # Pydantic model for the LLM's structured output (no longer used!)
@@ -100,35 +338,261 @@ def extract_base64_from_data_url(data_url):
     base64_start = data_url.find("base64,") + len("base64,")
     return data_url[base64_start:]
 
+def extract_media_type_from_data_url(data_url):
+    if data_url.startswith("data:") and ";" in data_url:
+        return data_url[len("data:"):data_url.find(";")]
+    return "image/png"
+
+# Media types of the image formats figures can be rendered to
+IMAGE_MEDIA_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp',
+                     'svg': 'image/svg+xml'}
+
 ###############################################################################
 # Build the prompt for the LLM
 ###############################################################################
-def build_llm_prompt(conversation_history, MODEL_NAME, response_type):
+class LLMPrompt(list):
     """
-    Build a prompt for the LLM, incorporating the current conversation history.
-    For text entries, we maintain the existing format.
-    For figure entries, we handle them specially to be passed as images.
+    Content parts of a prompt, laid out for provider-side prompt caching: the
+    parts before cache_breakpoints[0] (earlier iterations) and before
+    cache_breakpoints[1] (the whole history) are the same as in the previous
+    prompt of the session, as long as the history was only appended to and
+    no figure moved out of the full resolution window (see FIGURE_WINDOW)
+    in between. prefix_key identifies the content of the first of these
+    prefixes and prefix_tokens estimates its size; tokens estimates the size
+    of the whole prompt.
     """
-    content_parts = []
-    history_text = []
+    def __init__(self, parts, cache_breakpoints=(), prefix_key=None, prefix_tokens=0, tokens=0):
+        super().__init__(parts)
+        self.tokens = tokens
+        self.cache_breakpoints = cache_breakpoints
+        self.prefix_key = prefix_key
+        self.prefix_tokens = prefix_tokens
 
-    user_entries = 0
-    
-    # First build the text history for context
-    for entry in conversation_history:
-        role = entry.get("role", "user")
-        content = entry.get("content", "")
+class PromptCache:
+    """
+    Parts of the prompt rendered from the conversation history so far, per
+    provider: a text part for each entry and an image part for each figure.
+    build_llm_prompt only renders the entries added since its last call. The
+    cache starts over if the history changed in any other way (a new history
+    epoch, see ConversationHistory).
 
-        if role == "user":
-            user_entries += 1
-        
-        # Add special handling for figure entries in the text representation
-        if role == "figure":
-            history_text.append(f"ASSISTANT SAYS: [Generated a figure]")
-        else:
-            history_text.append(f"{role.upper()} SAYS: {content}")
+    The cache also keeps the prompt within a token budget (see
+    context_budget.py). Figures of older iterations are downsampled, and once
+    the budget is exceeded the oldest iterations are collapsed into summaries,
+    which are kept from then on. Rendered figures and parts that are no longer
+    part of the prompt are dropped.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, epoch):
+        self.epoch = epoch
+        self.length = 0                 # number of history entries rendered
+        self.entries = []               # (iteration, text tokens, figure URL or None) of each entry
+        self.lines = []                 # text of each entry
+        self.user_entries = 0
+        self.compacted = 0              # entries before this are only included in summaries
+        self.summaries = []             # summary of each collapsed iteration
+        self.summary_tokens = 0
+        self.text_tokens = 0            # tokens of the text of the entries from self.compacted on
+        self.figures = {}               # (url, full resolution) -> (data URL, tokens) or None
+        self.parts = {}                 # provider -> {entry index or (url, full resolution): prompt part}
+        self.pruned = None              # (compacted, latest iteration) when figures and parts were last pruned
+
+    def copy(self):
+        """Independent copy sharing the rendered parts, e.g. to build a hypothetical prompt."""
+        with self.lock:
+            copy = PromptCache()
+            copy.__dict__.update({name: value for name, value in self.__dict__.items() if name != 'lock'})
+            copy.entries, copy.lines, copy.summaries = list(self.entries), list(self.lines), list(self.summaries)
+            copy.figures = dict(self.figures)
+            copy.parts = {provider: dict(parts) for provider, parts in self.parts.items()}
+        return copy
+
+    def update(self, conversation_history, budget=CONTEXT_TOKEN_BUDGET):
+        """
+        Render the entries added to the history since the last update, and
+        collapse old iterations while the prompt exceeds the budget.
+
+        Returns:
+            int: Estimated number of tokens of the rendered history
+        """
+        epoch = getattr(conversation_history, "epoch", None)
+        if epoch != self.epoch or len(conversation_history) < self.length:
+            self.reset(epoch)
+
+        for entry in conversation_history[self.length:]:
+            role = entry.get("role", "user")
+            content = entry.get("content", "")
 
-    history_text_str = "\n".join(history_text)
+            if role == "user":
+                self.user_entries += 1
+            
+            # Add special handling for figure entries in the text representation
+            if role == "figure":
+                line = f"ASSISTANT SAYS: [Generated a figure]"
+                url = content["image_url"]["url"]
+            else:
+                line = f"{role.upper()} SAYS: {content}"
+                url = None
+            tokens = estimate_text_tokens(line)
+            self.entries.append((entry.get("iteration", 0), tokens, url))
+            self.lines.append(line)
+            self.text_tokens += tokens
+        self.length = len(conversation_history)
+
+        tokens = self.summary_tokens + self.text_tokens + self._image_tokens()
+        if tokens > budget:
+            tokens = self._compact(conversation_history, budget * COMPACTION_TARGET, tokens)
+        self._prune()
+        return tokens
+
+    def estimate_size(self):
+        """Rough number of bytes held by the cache: rendered text and figure data URLs."""
+        text = sum(map(len, self.lines)) + sum(map(len, self.summaries))
+        figures = sum(len(figure[0]) for figure in list(self.figures.values()) if figure is not None)
+        # The parts of each provider hold another copy of the text and figure data
+        return (text + figures) * (1 + len(self.parts))
+
+    def history_parts(self, MODEL_NAME):
+        """
+        Prompt parts of the history in chronological order, for a model's
+        provider: the summaries of collapsed iterations, then the text of each
+        entry with figures right after their entry.
+
+        Returns:
+            tuple: (parts, stable_length, prefix_key, prefix_tokens) where the
+                   first stable_length parts cover the iterations before the
+                   latest one, prefix_key identifies their content and
+                   prefix_tokens estimates their size
+        """
+        cached = self.parts.setdefault(provider_of_model(MODEL_NAME), {})
+        parts = []
+        tokens = 0
+        if self.summaries:
+            key = ("summaries", len(self.summaries))
+            if key not in cached:
+                cached[key] = build_text_part("\n".join(self.summaries) + "\n", MODEL_NAME)
+            parts.append(cached[key])
+            tokens += self.summary_tokens
+
+        latest = self.entries[-1][0] if self.entries else 0
+        stable_length, stable_entries, prefix_tokens = len(parts), self.compacted, tokens
+        for index in range(self.compacted, len(self.entries)):
+            iteration, text_tokens, url = self.entries[index]
+            if index not in cached:
+                cached[index] = build_text_part(self.lines[index] + "\n", MODEL_NAME)
+            parts.append(cached[index])
+            tokens += text_tokens
+
+            if url is not None:
+                key = (url, iteration > latest - FIGURE_WINDOW)
+                figure = self._figure(*key)
+                if figure is not None:
+                    if key not in cached:
+                        cached[key] = build_image_part(figure[0], MODEL_NAME)
+                    parts.append(cached[key])
+                    tokens += figure[1]
+
+            if iteration < latest:
+                stable_length, stable_entries, prefix_tokens = len(parts), index + 1, tokens
+
+        # Entries never change within an epoch, so this determines the content of the prefix
+        prefix_key = (self.epoch, self.compacted, stable_entries, latest) if self.epoch else None
+        return parts, stable_length, prefix_key, prefix_tokens
+
+    def _shown_figures(self):
+        """(url, full resolution) of the figures not collapsed into summaries."""
+        latest = self.entries[-1][0] if self.entries else 0
+        return [(url, iteration > latest - FIGURE_WINDOW)
+                for iteration, _, url in self.entries[self.compacted:] if url is not None]
+
+    def _prune(self):
+        """
+        Drop the figures and parts of entries collapsed into summaries, and
+        full resolution figures that left the figure window. This only needs
+        doing when compaction or a new iteration changed what is shown.
+        """
+        latest = self.entries[-1][0] if self.entries else 0
+        if self.pruned == (self.compacted, latest):
+            return
+        self.pruned = (self.compacted, latest)
+        shown = set(self._shown_figures())
+        self.figures = {key: figure for key, figure in self.figures.items() if key in shown}
+        summaries = ("summaries", len(self.summaries))
+        for provider, cached in self.parts.items():
+            self.parts[provider] = {key: part for key, part in cached.items()
+                                    if key in shown or key == summaries or
+                                    (isinstance(key, int) and key >= self.compacted)}
+
+    def _figure(self, url, full_resolution):
+        """(data URL, estimated tokens) of a figure, or None if it cannot be read."""
+        key = (url, full_resolution)
+        if key not in self.figures:
+            if not full_resolution:
+                figure = downsample_figure(url)
+            else:
+                data_url = url if isinstance(url, str) and url.startswith("data:image") else figure_data_url(url)
+                figure = (data_url, figure_size(url)) if data_url is not None else None
+            if figure is None or figure[1] is None:
+                self.figures[key] = None
+            else:
+                self.figures[key] = (figure[0], estimate_image_tokens(*figure[1]))
+        return self.figures[key]
+
+    def _image_tokens(self):
+        return sum(figure[1] for figure in map(lambda key: self._figure(*key), self._shown_figures()) if figure)
+
+    def _compact(self, conversation_history, target, tokens):
+        """Collapse the oldest iterations into summaries until the history fits in target tokens."""
+        latest = self.entries[-1][0]
+        collapsed = []
+        while tokens > target and self.compacted < len(self.entries):
+            iteration = self.entries[self.compacted][0]
+            if iteration > latest - MIN_FULL_ITERATIONS:
+                break
+            end = self.compacted
+            while end < len(self.entries) and self.entries[end][0] <= iteration:
+                end += 1
+
+            summary = summarize_iteration(iteration, conversation_history[self.compacted:end])
+            self.summaries.append(summary)
+            self.summary_tokens += estimate_text_tokens(summary)
+            self.text_tokens -= sum(entry[1] for entry in self.entries[self.compacted:end])
+            self.compacted = end
+            collapsed.append(iteration)
+            tokens = self.summary_tokens + self.text_tokens + self._image_tokens()
+
+        if collapsed:
+            metrics.increment('llm.prompt_compactions')
+            logger.info(f"Shortened iterations {collapsed} of the conversation to fit the context budget")
+        return tokens
+
+# Introduction of the conversation in the prompt
+PROMPT_INTRO = (
+    "Below is the conversation so far, including user feedback and "
+    "assistant's previous analysis or error messages (if any). Then "
+    "provide your new output:\n\n"
+)
+
+def build_llm_prompt(conversation_history, MODEL_NAME, response_type, cache=None, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Build a prompt for the LLM, incorporating the current conversation history.
+    Entries are laid out in order, figures as images right after their entry,
+    followed by the instruction for this response. Everything before the
+    instruction is kept identical across calls, so providers can cache it
+    (see LLMPrompt).
+    With a PromptCache (the session's), only entries added since the previous
+    prompt are rendered. The history is kept within budget tokens (see
+    PromptCache.update).
+    """
+    started = time.time()
+    cache = cache or PromptCache()
+    with cache.lock:
+        history_tokens = cache.update(conversation_history, budget)
+        history, stable_length, prefix_key, prefix_tokens = cache.history_parts(MODEL_NAME)
+        user_entries = cache.user_entries
 
     if response_type == "code":
         now_cont = NOW_CONTINUE_CODE
@@ -142,141 +606,88 @@ def build_llm_prompt(conversation_history, MODEL_NAME, response_type):
         else:
             now_cont = NOW_CONTINUE_TEXT
     
-    # Create the text prompt
-    text_prompt = (
-        "Below is the conversation so far, including user feedback and "
-        "assistant's previous analysis or error messages (if any). Then "
-        "provide your new output:\n\n"
-        f"{history_text_str}\n\n"
-        f"{now_cont}\n"
-    )
-    
-    # Add the text as the first content part
-    content_parts.append({
-        "type": "text",
-        "text": text_prompt
-    })
-    
-    # Now add any figures from the conversation
-    for entry in conversation_history:
-        if entry.get("role") == "figure":
-            fig_content = entry.get("content")          # this is a dictionary
-            url_dict = fig_content["image_url"]
-            fig_content = url_dict["url"]
-            
-            # If the content is a matplotlib figure
-            if isinstance(fig_content, plt.Figure):
-                base64_img = fig_to_base64(fig_content)
-            
-            # If the content is a base64 string already
-            elif isinstance(fig_content, str) and fig_content.startswith("data:image"):
-                base64_img = fig_content
-            
-            if MODEL_NAME.startswith('claude'):
-                if base64_img.startswith("data:image"):
-                    content_parts.append({
-                        "type": "image",
-                        "source":{
-                            "type": "base64",
-                            "media_type":"image/png",
-                            "data": extract_base64_from_data_url(base64_img)
-                        }
-                    })
-                else:
-                    content_parts.append({
-                        "type": "image",
-                        "source":{
-                            "type": "base64",
-                            "media_type":"image/png",
-                            "data": base64_img
-                        }
-                    })
-
-            elif MODEL_NAME.startswith('gemini'):
-                content_parts.append(types.Part.from_bytes(
-                        mime_type = 'image/png',
-                        data = base64.b64decode(extract_base64_from_data_url(base64_img))
-                    )
-                )
+    parts = [build_text_part(PROMPT_INTRO, MODEL_NAME)] + history + [build_text_part(f"\n{now_cont}\n", MODEL_NAME)]
+    prompt_tokens = history_tokens + estimate_text_tokens(PROMPT_INTRO + now_cont)
+    prompt = LLMPrompt(parts, cache_breakpoints=(1 + stable_length, 1 + len(history)), prefix_key=prefix_key,
+                       prefix_tokens=prefix_tokens, tokens=prompt_tokens)
+    metrics.observe('llm.prompt_build_seconds', time.time() - started)
+    metrics.observe('llm.prompt_tokens', prompt_tokens)
+    logger.info(f"Built prompt of about {prompt_tokens} tokens in {len(prompt)} parts")
+    return prompt
 
-            else:
-                if base64_img.startswith("data:image"):
-                    content_parts.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": fig_content
-                        }
-                    })
-                else:
-                    content_parts.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{base64_img}"
-                        }
-                    })
-    
-    return content_parts
+def provider_of_model(MODEL_NAME):
+    if MODEL_NAME.startswith('claude'):
+        return "anthropic"
+    elif MODEL_NAME.startswith('gemini'):
+        return "google"
+    return "openai"
 
-###############################################################################
-# Execute code in shared namespace, capturing stdout, figures, and errors
-###############################################################################
-def run_code_in_process(code, analysis_namespace, pipe_conn):
-    """
-    Run code in a separate process.
-    
-    Args:
-        code (str): The code to execute
-        analysis_namespace (dict): Shared namespace for analysis
-        pipe_conn (multiprocessing.Connection): Pipe connection to send results back
-    """
-    # We need to redirect stdout to capture output
-    import sys, io
-    import matplotlib.pyplot as plt
-    
-    # Configure signal handling for graceful termination
-    def handle_terminate(signum, frame):
-        pipe_conn.send(("TERMINATED", None, None, True))
-        pipe_conn.close()
-        sys.exit(0)
-    
-    signal.signal(signal.SIGTERM, handle_terminate)
-    
-    # Redirect stdout
-    old_stdout = sys.stdout
-    redirected_output = io.StringIO()
-    sys.stdout = redirected_output
-    
-    # Close any existing figures
-    plt.close('all')
-    
-    figures = []
-    error_flag = False
-    
-    try:
-        # Execute the code
-        exec(code, analysis_namespace)
-        
-        # Collect figures
-        for i in plt.get_fignums():
-            fig = plt.figure(i)
-            figures.append(fig)
-    
-    except Exception as e:
-        error_flag = True
-        print(str(e))
+def build_text_part(text, MODEL_NAME):
+    if MODEL_NAME.startswith('gemini'):
+        return types.Part.from_text(text=text)
+    return {"type": "text", "text": text}
+
+def build_image_part(fig_content, MODEL_NAME):
+    """Prompt part of a figure from the conversation history, or None if it cannot be found."""
+
+    # If the content is a matplotlib figure
+    if isinstance(fig_content, plt.Figure):
+        base64_img = fig_to_base64(fig_content)
     
-    finally:
-        # Get the captured output
-        sys.stdout = old_stdout
-        output_text = redirected_output.getvalue()
-        
-        # If no output was generated
-        if len(output_text) == 0 and len(figures) == 0:
-            output_text = "Please make sure your code prints something to stdout or generates some figures."
+    # If the content is a base64 string already
+    elif isinstance(fig_content, str) and fig_content.startswith("data:image"):
+        base64_img = fig_content
+
+    # If the content is a figure in the figure store
+    elif figure_hash_from_url(fig_content):
+        base64_img = figure_data_url(fig_content)
+        if base64_img is None:
+            return None
+
+    else:
+        return None
     
-    # Send results back through the pipe
-    pipe_conn.send((output_text, figures, None, error_flag, dill.dumps(analysis_namespace)))
-    pipe_conn.close()
+    if MODEL_NAME.startswith('claude'):
+        if base64_img.startswith("data:image"):
+            return {
+                "type": "image",
+                "source":{
+                    "type": "base64",
+                    "media_type": extract_media_type_from_data_url(base64_img),
+                    "data": extract_base64_from_data_url(base64_img)
+                }
+            }
+        else:
+            return {
+                "type": "image",
+                "source":{
+                    "type": "base64",
+                    "media_type":"image/png",
+                    "data": base64_img
+                }
+            }
+
+    elif MODEL_NAME.startswith('gemini'):
+        return types.Part.from_bytes(
+                mime_type = extract_media_type_from_data_url(base64_img),
+                data = base64.b64decode(extract_base64_from_data_url(base64_img))
+            )
+
+    else:
+        if base64_img.startswith("data:image"):
+            return {
+                "type": "image_url",
+                "image_url": {
+                    "url": base64_img
+                }
+            }
+        else:
+            return {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/png;base64,{base64_img}"
+                }
+            }
 
 ###############################################################################
 # Capture matplotlib figures
@@ -472,7 +883,7 @@ def safe_json_loads(json_str):
 ###############################################################################
 # Actual LLM call to parse response
 ###############################################################################
-def call_llm_and_parse(client, prompt, MODEL_NAME, response_type):
+def call_llm_and_parse(client, prompt, MODEL_NAME, response_type, on_text=None, on_request=None):
     """
     Calls the LLM client to parse the response into LLMResponse
     using the JSON schema automatically.
@@ -482,15 +893,61 @@ def call_llm_and_parse(client, prompt, MODEL_NAME, response_type):
         prompt: List of content parts for the prompt
         MODEL_NAME: Name of the model to use
         response_type: Type of response to expect (text, code, feedback, both)
+        on_text: Optional callback; if given, plain text responses are streamed
+                 and passed to it as they arrive (see stream_llm_response)
+        on_request: Optional callback, called just before a request is sent to
+                    the provider (not if the response is cached, see llm_cache.py)
     
     Returns:
         LLMResponse: Parsed response from the LLM
         or just the response content if we don't need the JSON structured response
     """
     
+    key = prompt_key(MODEL_NAME, response_type, prompt) if llm_cache.enabled else None
+    response_content = llm_cache.get(key) if key else None
+    if response_content is None and llm_cache.mode == 'replay':
+        raise LLMCacheMiss(f"No cached {MODEL_NAME} response for this prompt")
+
+    if response_content is None:
+        if on_request is not None:
+            on_request()
+        if on_text is not None and response_type != "both":
+            response_content = stream_llm_response(client, prompt, MODEL_NAME, response_type, on_text)
+        else:
+            response_content = send_llm_request(client, prompt, MODEL_NAME, response_type)
+        if key:
+            llm_cache.put(key, response_content, model=MODEL_NAME, response_type=response_type)
+    elif on_text is not None and response_type != "both":
+        replay_llm_response(response_content, response_type, on_text)
+
+    if response_type == "both":
+        try:
+            parsed_response = safe_json_loads(response_content)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse LLM response: {e}")
+            if "Invalid \escape" in str(e):
+                parsed_response = {"text_summary":"Invalid escape sequence found in JSON response. Please correct this."}
+            else:
+                parsed_response = {"text_summary":"JSONDecodeError. Please correct this."}
+                logger.error(f"Raw response: {response_content}")
+        
+        # Convert to LLMResponse
+        llm_response = LLMResponse(
+            text_summary=parsed_response.get("text_summary", ""),
+            python_code=parsed_response.get("python_code", "")
+        )
+        # Return the parsed LLMResponse object
+        return llm_response
+    
+    else:
+        return response_content
+
+def send_llm_request(client, prompt, MODEL_NAME, response_type):
+    """Request a complete (not streamed) response from the LLM. Returns its text."""
+
     if MODEL_NAME.startswith('claude'):
         messages = [
-            {"role": "user", "content": prompt}
+            {"role": "user", "content": mark_cache_breakpoints(prompt)}
         ]
         completion = client.messages.create(
             model=MODEL_NAME,
@@ -502,6 +959,7 @@ def call_llm_and_parse(client, prompt, MODEL_NAME, response_type):
             messages=messages,
             max_tokens=5000
         )
+        record_anthropic_usage(completion.usage)
         response_content = completion.content[0].text
 
         if response_type == "both":
@@ -509,35 +967,15 @@ def call_llm_and_parse(client, prompt, MODEL_NAME, response_type):
             response_content = extract_json_dict(response_content)
 
     elif MODEL_NAME.startswith('gemini'):
-        text = prompt[0]["text"]
-        parts = [types.Part.from_text(text=text)]
-        for msg in prompt[1:]:
-            parts.append(msg)
-
-        contents = types.Content(
-            role = "user",
-            parts = parts
-        )
-
-        if response_type == "both":
-            gen_config = types.GenerateContentConfig(
-                response_mime_type="application/json",
-                system_instruction=[
-                    types.Part.from_text(text=SYSTEM_PROMPT),
-                ],
-            )
-        else:
-            gen_config = types.GenerateContentConfig(
-                system_instruction=[
-                    types.Part.from_text(text=SYSTEM_PROMPT),
-                ],
-            )
+        cached = gemini_caches.get(client, MODEL_NAME, prompt)
+        contents, gen_config = build_gemini_request(prompt, response_type, cached)
         
         response = client.models.generate_content(
             model=MODEL_NAME,
             contents=contents,
             config=gen_config
         )
+        record_gemini_usage(response.usage_metadata)
         response_content = response.text
 
     else:
@@ -558,29 +996,120 @@ def call_llm_and_parse(client, prompt, MODEL_NAME, response_type):
                 messages = messages
             )
         
+        record_openai_usage(completion.usage)
         response_content = completion.choices[0].message.content
     
+    return response_content
+
+def build_gemini_request(prompt, response_type, cached=None):
+    """
+    Contents and config of a Gemini request for a prompt. If cached is given,
+    as (cache name, number of parts), the system prompt and the first parts of
+    the prompt come from that context cache (see GeminiCacheRegistry).
+    """
+    parts = [types.Part.from_text(text=part["text"]) if isinstance(part, dict) else part for part in prompt]
+
+    config = {}
+    if cached:
+        name, length = cached
+        parts = parts[length:]
+        config["cached_content"] = name
+    else:
+        config["system_instruction"] = [types.Part.from_text(text=SYSTEM_PROMPT)]
     if response_type == "both":
-        try:
-            parsed_response = safe_json_loads(response_content)
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse LLM response: {e}")
-            if "Invalid \escape" in str(e):
-                parsed_response = {"text_summary":"Invalid escape sequence found in JSON response. Please correct this."}
-            else:
-                parsed_response = {"text_summary":"JSONDecodeError. Please correct this."}
-                logger.error(f"Raw response: {response_content}")
-        
-        # Convert to LLMResponse
-        llm_response = LLMResponse(
-            text_summary=parsed_response.get("text_summary", ""),
-            python_code=parsed_response.get("python_code", "")
+        config["response_mime_type"] = "application/json"
+
+    contents = types.Content(
+        role = "user",
+        parts = parts
+    )
+    return contents, types.GenerateContentConfig(**config)
+
+###############################################################################
+# Streaming LLM responses
+###############################################################################
+def iter_llm_text(client, prompt, MODEL_NAME, response_type):
+    """Generate the text of a plain text LLM response in chunks, as the provider sends them."""
+
+    if MODEL_NAME.startswith('claude'):
+        stream = client.messages.create(
+            model=MODEL_NAME,
+            system=[{
+                "type": "text",
+                "text": SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}
+                }],
+            messages=[{"role": "user", "content": mark_cache_breakpoints(prompt)}],
+            max_tokens=5000,
+            stream=True
         )
-        # Return the parsed LLMResponse object
-        return llm_response
-    
+        usage, output_tokens = None, 0
+        for event in stream:
+            if event.type == "content_block_delta" and event.delta.type == "text_delta":
+                yield event.delta.text
+            elif event.type == "message_start":
+                usage = event.message.usage
+            elif event.type == "message_delta":
+                output_tokens = usage_value(event.usage, 'output_tokens')
+        record_anthropic_usage(usage, output_tokens)
+
+    elif MODEL_NAME.startswith('gemini'):
+        cached = gemini_caches.get(client, MODEL_NAME, prompt)
+        contents, gen_config = build_gemini_request(prompt, response_type, cached)
+        usage = None
+        for chunk in client.models.generate_content_stream(model=MODEL_NAME, contents=contents, config=gen_config):
+            usage = getattr(chunk, 'usage_metadata', None) or usage
+            if chunk.text:
+                yield chunk.text
+        record_gemini_usage(usage)
+
     else:
-        return response_content
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+        usage = None
+        for chunk in client.chat.completions.create(model=MODEL_NAME, messages=messages, stream=True,
+                                                    extra_body={"stream_options": {"include_usage": True}}):
+            # The last chunk carries the usage and no choices
+            usage = getattr(chunk, 'usage', None) or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        record_openai_usage(usage)
+
+def stream_llm_response(client, prompt, MODEL_NAME, response_type, on_text):
+    """
+    Streaming variant of call_llm_and_parse for plain text responses. Text is
+    passed to on_text as it arrives, with code fences stripped as far as can be
+    told before the response is complete (see ResponseFilter).
+
+    Returns:
+        str: The complete response, to be post-processed by process_llm_response
+    """
+    started = time.time()
+    response_filter = ResponseFilter(response_type)
+    chunks = []
+    for chunk in iter_llm_text(client, prompt, MODEL_NAME, response_type):
+        if not chunks:
+            metrics.observe('llm.first_token_seconds', time.time() - started)
+        chunks.append(chunk)
+        text = response_filter.feed(chunk)
+        if text:
+            on_text(text)
+
+    text = response_filter.finish()
+    if text:
+        on_text(text)
+    metrics.observe('llm.stream_seconds', time.time() - started)
+    return "".join(chunks)
+
+def replay_llm_response(response, response_type, on_text):
+    """Pass a complete (e.g. cached) response to on_text as stream_llm_response would."""
+    response_filter = ResponseFilter(response_type)
+    text = response_filter.feed(response) + response_filter.finish()
+    if text:
+        on_text(text)
+    return response
 
 ###############################################################################
 # Function to process LLM response
@@ -608,6 +1137,68 @@ def process_llm_response(response, response_type):
     
     return response
 
+class ResponseFilter:
+    """
+    Incremental version of the code fence handling in process_llm_response,
+    for streamed responses.
+
+    For code, text is passed on from the opening ```python fence (or all of
+    it at the end, if there turns out to be no fence), and a closing fence is
+    held back. For text, everything before a ```python fence is passed on.
+    """
+    FENCE = "```python"
+
+    def __init__(self, response_type):
+        self.response_type = response_type
+        self.buffer = ""
+        self.in_code = False        # the opening fence has been seen
+
+    def feed(self, chunk):
+        """Add a chunk of the response. Returns the text that can be passed on."""
+        self.buffer += chunk
+        if self.response_type == "code":
+            if not self.in_code:
+                index = self.buffer.find(self.FENCE)
+                # Like process_llm_response, also drop the character after the fence
+                if index < 0 or len(self.buffer) <= index + len(self.FENCE):
+                    return ""
+                self.in_code = True
+                self.buffer = self.buffer[index + len(self.FENCE) + 1:]
+            return self._take(self._closing_fence_start())
+
+        elif self.response_type == "text" or self.response_type == "feedback":
+            if self.in_code:
+                return ""
+            index = self.buffer.find(self.FENCE)
+            if index >= 0:
+                self.in_code = True
+                return self._take(index)
+            # Hold back an end that may be the start of a fence
+            held = next((n for n in range(len(self.FENCE) - 1, 0, -1) if self.buffer.endswith(self.FENCE[:n])), 0)
+            return self._take(len(self.buffer) - held)
+
+        return self._take(len(self.buffer))
+
+    def finish(self):
+        """Returns the rest of the text once the response is complete."""
+        text, self.buffer = self.buffer, ""
+        if self.response_type == "code":
+            if text.endswith("```") or text.endswith("```\n"):
+                text = text.rsplit("```", 1)[0]
+        elif self.in_code:
+            return ""
+        return text
+
+    def _take(self, length):
+        text, self.buffer = self.buffer[:length], self.buffer[length:]
+        return text
+
+    def _closing_fence_start(self):
+        index = self.buffer.rfind("```")
+        if index >= 0 and not self.buffer[index + 3:].strip():
+            return index
+        return len(self.buffer.rstrip("`"))
+
 ###############################################################################
 # Process files uploaded mid-session (called in the feedback route)
 ###############################################################################
@@ -663,6 +1254,9 @@ def API_error_handler(e, model_name):
             
     logger.error(f"Error getting analysis: {str(e)}")
 
+    if isinstance(e, CircuitOpenError):                                 # failing fast (see llm_resilience.py)
+        return f"{str(e)}. Please try again later or switch model.", 503
+
     if model_name == "claude":                                          # Anthropic API Error codes
         if "429" in str(e):
             return "API rate limit exceeded. Please try again later or switch model.", 429
@@ -698,7 +1292,7 @@ def API_error_handler(e, model_name):
 # Functions to get LLM clients
 ###############################################################################
 def get_client(model_name, api_key=None):
-    """Returns the appropriate client based on the model name"""
+    """Returns the appropriate client based on the model name (shared, see llm_clients.py)"""
 
     if not api_key:
         api_key = get_api_key(model_name)
@@ -706,17 +1300,10 @@ def get_client(model_name, api_key=None):
             logger.error("No API key provided")
             raise ValueError("API_KEY is required")
     
-    if model_name=="gpt" or model_name=="o1":
-        return openai.OpenAI(api_key=api_key)
-    elif model_name=="claude":
-        client = anthropic.Anthropic(api_key=api_key)
-        return client
-    elif model_name=="gemini":
-        client = genai.Client(api_key=api_key)
-        return client
-    else:
+    if model_name not in MODEL_PROVIDERS:
         logger.error(f"Invalid model name: {model_name}")
         raise ValueError("Invalid model name - choose gpt, o1, gemini or claude")
+    return client_registry.get(MODEL_PROVIDERS[model_name], api_key)
 
 ###############################################################################
 # Function to get API key from environment variables